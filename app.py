@@ -1,19 +1,41 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
 import calendar
+import sqlite3
+import uuid
 import openpyxl
 from docx import Document
 from docx.shared import Inches
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from lxml import etree
 import re
 import io
 import zipfile
 import os
 from pathlib import Path
 import tempfile
+import shutil
+import subprocess
+import sys
+import signal
+import atexit
+import copy
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import base64
+import hashlib
+import json
+import threading
+import weakref
+import functools
+import itertools
+import bisect
+from collections import OrderedDict
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -21,6 +43,7 @@ warnings.filterwarnings('ignore')
 import config
 
 # Helper function for logo
+@st.cache_data(show_spinner=False)
 def get_base64_of_image(path):
     """Convert image to base64 string for embedding in HTML"""
     try:
@@ -29,12 +52,47 @@ def get_base64_of_image(path):
     except Exception as e:
         return ""
 
-# Try to import docx2pdf for PDF generation
+# Try to import docx2pdf for PDF generation (drives MS Word on Windows/macOS)
 try:
     from docx2pdf import convert
-    PDF_AVAILABLE = True
+    DOCX2PDF_AVAILABLE = True
 except ImportError:
-    PDF_AVAILABLE = False
+    DOCX2PDF_AVAILABLE = False
+
+# st.dataframe (virtualized table with row selection) and the Arrow dataset files need pyarrow
+try:
+    import pyarrow
+    import pyarrow.ipc
+    ARROW_AVAILABLE = True
+except ImportError:
+    ARROW_AVAILABLE = False
+
+# DuckDB is an optional analytics backend (config.ANALYTICS_BACKEND = "duckdb")
+try:
+    import duckdb
+    DUCKDB_AVAILABLE = True
+except ImportError:
+    DUCKDB_AVAILABLE = False
+
+# Headless LibreOffice works on Linux servers without MS Word
+SOFFICE_PATH = config.SOFFICE_PATH or shutil.which('soffice') or shutil.which('libreoffice')
+
+# Pick PDF backend: "docx2pdf", "soffice" or None when PDF output is unavailable
+if config.PDF_BACKEND == 'auto':
+    if DOCX2PDF_AVAILABLE and sys.platform in ('win32', 'darwin'):
+        PDF_BACKEND = 'docx2pdf'
+    elif SOFFICE_PATH:
+        PDF_BACKEND = 'soffice'
+    else:
+        PDF_BACKEND = None
+elif config.PDF_BACKEND == 'docx2pdf' and DOCX2PDF_AVAILABLE:
+    PDF_BACKEND = 'docx2pdf'
+elif config.PDF_BACKEND == 'soffice' and SOFFICE_PATH:
+    PDF_BACKEND = 'soffice'
+else:
+    PDF_BACKEND = None
+
+PDF_AVAILABLE = PDF_BACKEND is not None
 
 # Configure Streamlit page
 st.set_page_config(
@@ -433,13 +491,166 @@ setInterval(hideCreatedByElements, 500);
 </script>
 """, unsafe_allow_html=True)
 
+# ========================= SHARED OBJECT CACHE =========================
+
+class SharedObjectCache:
+    """
+    Process-wide cache of read-only objects (datasets, compiled templates)
+    shared by every session of this server
+    Entries are keyed by content fingerprint and reference counted; once the
+    memory budget is exceeded, unreferenced entries are evicted least recently used first
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> {'value', 'size', 'refs'}
+        self._load_locks = {}
+        self._total_bytes = 0
+
+    def acquire(self, key, loader, sizer):
+        """
+        Return the shared object for key (loading it once) and take a reference
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                load_lock = self._load_locks.setdefault(key, threading.Lock())
+            else:
+                entry['refs'] += 1
+                self._entries.move_to_end(key)
+                return entry['value']
+        
+        # Concurrent sessions asking for the same key wait for a single load
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry['refs'] += 1
+                    self._entries.move_to_end(key)
+                    return entry['value']
+            
+            value = loader()
+            size = sizer(value)
+            with self._lock:
+                self._entries[key] = {'value': value, 'size': size, 'refs': 1}
+                self._total_bytes += size
+                self._load_locks.pop(key, None)
+                self._evict()
+            return value
+
+    def release(self, key):
+        """
+        Drop a reference taken by acquire
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['refs'] = max(0, entry['refs'] - 1)
+                self._evict()
+
+    def get(self, key, loader, sizer):
+        """
+        Return the shared object without holding a reference to it
+        """
+        value = self.acquire(key, loader, sizer)
+        self.release(key)
+        return value
+
+    def _evict(self):
+        # Called with the lock held; referenced entries are never evicted
+        for key in list(self._entries):
+            if self._total_bytes <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if entry['refs'] == 0:
+                del self._entries[key]
+                self._total_bytes -= entry['size']
+
+    def stats(self):
+        """
+        Entry count, bytes held and entries currently referenced
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'referenced': sum(1 for entry in self._entries.values() if entry['refs'])
+            }
+
+class SessionLeases:
+    """
+    References one session holds in the shared cache, one per slot
+    Switching a slot to another key releases the old one, and everything is
+    released when the session state is dropped
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+        self._held = {}  # slot -> key
+        weakref.finalize(self, SessionLeases._release_all, cache, self._held)
+
+    @staticmethod
+    def _release_all(cache, held):
+        for key in list(held.values()):
+            cache.release(key)
+        held.clear()
+
+    def acquire(self, slot, key, loader, sizer):
+        """
+        Shared object for key, keeping one reference per slot
+        """
+        if self._held.get(slot) == key:
+            # Already referenced by this session: a cheap lookup that refreshes LRU order
+            return self._cache.get(key, loader, sizer)
+        
+        value = self._cache.acquire(key, loader, sizer)
+        previous = self._held.get(slot)
+        self._held[slot] = key
+        if previous is not None:
+            self._cache.release(previous)
+        return value
+
+@st.cache_resource
+def get_shared_cache():
+    """
+    Shared object cache of this server process
+    """
+    return SharedObjectCache(config.SHARED_CACHE_MAX_MB * 1024 * 1024)
+
+def get_session_leases():
+    """
+    Shared-cache references of the current session
+    """
+    if 'shared_cache_leases' not in st.session_state:
+        st.session_state['shared_cache_leases'] = SessionLeases(get_shared_cache())
+    return st.session_state['shared_cache_leases']
+
+def dataframe_size(df):
+    """
+    Memory footprint of a DataFrame in bytes
+    """
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+def load_shared_sheet(file_path, workbook_hash, sheet, slot=None):
+    """
+    Parsed sheet from the shared cache, keyed by the sheet's own content fingerprint
+    so a new workbook version only re-parses the months that changed
+    With a slot the current session keeps a reference to it
+    """
+    sheet_hash = get_sheet_fingerprint(file_path, workbook_hash, sheet)
+    key = ('dataset', sheet_hash)
+    loader = lambda: load_sheet_dataset(file_path, sheet_hash, sheet)
+    if slot is None:
+        return get_shared_cache().get(key, loader, dataframe_size)
+    return get_session_leases().acquire(slot, key, loader, dataframe_size)
+
 # ========================= DATA LOADING FUNCTIONS =========================
 
-@st.cache_data
 def load_excel_data(file_path, month_sheet=None):
     """
     Load Excel data from specified file and sheet
-    Returns DataFrame with course data
+    Returns DataFrame with course data (cached through load_shared_sheet)
     """
     try:
         if month_sheet:
@@ -470,16 +681,27 @@ def load_excel_data(file_path, month_sheet=None):
             # Keep rows where at least 3 columns have data
             df = df[df.count(axis=1) >= 3]
         
+        # Worksheet row of every kept row (the header is row 1), for writing values back
+        excel_rows = (df.index + 2).tolist()
+        
+        # Reset index after filtering
+        df = df.reset_index(drop=True)
+        
         # Ensure date columns are properly parsed
+        # Values that cannot be parsed are kept in attrs for the validation report
+        unparseable_dates = {}
         date_columns = [col for col in df.columns if 'تاريخ' in str(col).lower() or 'date' in str(col).lower()]
         for col in date_columns:
             try:
-                df[col] = pd.to_datetime(df[col], errors='coerce')
+                raw_values = df[col]
+                df[col] = pd.to_datetime(raw_values, errors='coerce')
+                lost = raw_values.notna() & df[col].isna() & (raw_values.astype(str).str.strip() != '')
+                if lost.any():
+                    unparseable_dates[col] = raw_values[lost].astype(str).str.strip().to_dict()
             except:
                 pass
-        
-        # Reset index after filtering
-        df = df.reset_index(drop=True)
+        df.attrs['unparseable_dates'] = unparseable_dates
+        df.attrs['excel_rows'] = excel_rows
         
         return df
     except Exception as e:
@@ -491,416 +713,2801 @@ def get_available_sheets(file_path):
     Get list of available sheets in Excel file
     """
     try:
-        wb = openpyxl.load_workbook(file_path, read_only=True)
-        sheets = wb.sheetnames
-        wb.close()
-        return sheets
+        # Header scan is cached per workbook content, so reruns don't reopen the file
+        return list(read_workbook_headers(get_file_content_hash(file_path), file_path))
     except Exception as e:
         st.error(f"خطأ في قراءة أوراق العمل: {str(e)}")
         return []
 
-# ========================= WORD TEMPLATE FUNCTIONS =========================
+class SessionUploads:
+    """
+    Uploaded files the current session works with, one per slot
+    """
 
-def extract_placeholders_from_word(docx_path):
+    def __init__(self):
+        self.paths = {}  # slot -> path
+
+@st.cache_resource
+def get_upload_leases():
     """
-    Extract all placeholders from Word document
-    Returns list of placeholders found
-    Safe version that handles table errors gracefully
+    SessionUploads of every live session (dropped with the session state)
     """
-    try:
-        doc = Document(docx_path)
-        placeholders = set()
-        
-        # Extract from paragraphs (safe)
-        for para in doc.paragraphs:
-            try:
-                matches = re.findall(r'\{\{([^}]+)\}\}', para.text)
-                placeholders.update(matches)
-            except Exception as para_error:
-                continue
-        
-        # Extract from tables with enhanced error handling
-        try:
-            for table_idx, table in enumerate(doc.tables):
-                try:
-                    for row_idx, row in enumerate(table.rows):
-                        try:
-                            for cell_idx, cell in enumerate(row.cells):
-                                try:
-                                    # Safely access cell text
-                                    cell_text = cell.text
-                                    matches = re.findall(r'\{\{([^}]+)\}\}', cell_text)
-                                    placeholders.update(matches)
-                                except Exception as cell_error:
-                                    # Skip problematic cells (like grid_offset errors)
-                                    continue
-                        except Exception as row_error:
-                            # Skip problematic rows
-                            continue
-                except Exception as table_error:
-                    # Skip problematic tables
-                    continue
-        except Exception as tables_error:
-            # If table processing fails completely, continue with paragraphs only
-            st.warning("⚠️ تخطي معالجة الجداول بسبب خطأ في التنسيق")
-        
-        return list(placeholders)
-    except Exception as e:
-        st.error(f"خطأ في قراءة قالب Word: {str(e)}")
-        return []
+    return weakref.WeakSet()
 
-def build_mapping(row, df_columns):
+def leased_upload_paths():
     """
-    Build mapping between Excel columns and Word Content Control tags
-    Content Control Tags available:
-    - اسم البرنامج, اسم الدورة, الفئة المستهدفة, طريقة الطرح
-    - العدد المتوقع, وقت الدورة/البرنامج, تاريخ التنفيذ, مدتها
-    - اســــم الــمــدرب, الـــمـتـطــلــبــات, تنفيذ البرنامج/الدورة, مقر التنفيذ
+    Upload paths referenced by any live session
     """
-    mapping = {}
+    paths = set()
+    for session_uploads in list(get_upload_leases()):
+        paths.update(os.path.abspath(path) for path in list(session_uploads.paths.values()))
+    return paths
+
+def save_uploaded_file(uploaded_file, suffix, slot=None):
+    """
+    Store an upload under its content hash and return the path
+    The same upload keeps the same path across reruns, so path-keyed caches stay warm;
+    the session keeps a lease on it (per slot, default the suffix) so pruning never
+    removes a file another session is still working with
+    """
+    data = uploaded_file.getvalue()
+    os.makedirs(config.UPLOADS_DIR, exist_ok=True)
+    path = os.path.join(config.UPLOADS_DIR, f"{hashlib.sha256(data).hexdigest()}{suffix}")
     
-    # Define Excel to Content Control tag mappings
-    excel_to_tag_mapping = {
-        # Excel Column Name -> Content Control Tag
-        'اسم الدورة بالعربي': 'اسم الدورة',
-        'الفئة المستهدفة': 'الفئة المستهدفة',
-        'طريقة الطرح': 'طريقة الطرح',
-        'اسم المدرب': 'اســــم الــمــدرب',
-        'مكان الانعقاد ': 'مقر التنفيذ',  # Fixed: exact match with trailing space
-        'مكان الانعقاد': 'مقر التنفيذ',   # Alternative without space
-        'الوقت': 'وقت الدورة/البرنامج',
-        'عدد الايام': 'مدتها',
-        'تاريخ بداية الدورة بالميلادي': 'تاريخ التنفيذ',
-        'تاريخ بداية الدورة بالهجري': 'تاريخ التنفيذ',
-        'تحتاج لمعمل؟': 'استخدام معمل الحاسب',  # Fixed: lab field mapping
-        
-        # Additional mappings for other available fields
-        'جهة التدريب': 'تنفيذ البرنامج/الدورة',
-        'اسم جهة التدريب': 'تنفيذ البرنامج/الدورة',
-    }
+    if 'uploaded_files' not in st.session_state:
+        st.session_state['uploaded_files'] = SessionUploads()
+        get_upload_leases().add(st.session_state['uploaded_files'])
+    st.session_state['uploaded_files'].paths[slot or suffix] = path
     
-    # Build mapping from Excel data to Content Control tags
-    for excel_col, tag_name in excel_to_tag_mapping.items():
-        value = ""
-        
-        # Try exact match first
-        if excel_col in df_columns:
-            value = str(row[excel_col]) if pd.notna(row[excel_col]) else ""
-        else:
-            # Try similar column names (with space variations)
-            excel_col_clean = excel_col.strip().lower()
-            found_match = False
-            
-            # Special handling for location field with extensive matching
-            if 'مكان الانعقاد' in excel_col:
-                for col in df_columns:
-                    # Check for exact match (with or without trailing space)
-                    if col == 'مكان الانعقاد ' or col == 'مكان الانعقاد':
-                        value = str(row[col]) if pd.notna(row[col]) else ""
-                        found_match = True
-                        break
-                    # Also check if column contains the location keywords
-                    elif 'مكان' in str(col) and 'انعقاد' in str(col):
-                        value = str(row[col]) if pd.notna(row[col]) else ""
-                        found_match = True
-                        break
-            
-            # Special handling for lab field
-            elif 'تحتاج لمعمل' in excel_col or 'معمل' in excel_col:
-                for col in df_columns:
-                    if col == 'تحتاج لمعمل؟' or 'تحتاج لمعمل' in str(col):
-                        value = str(row[col]) if pd.notna(row[col]) else ""
-                        found_match = True
-                        break
-            else:
-                # Regular matching for other fields
-                for col in df_columns:
-                    col_clean = str(col).strip().lower()
-                    if excel_col_clean == col_clean or excel_col_clean in col_clean or col_clean in excel_col_clean:
-                        value = str(row[col]) if pd.notna(row[col]) else ""
-                        found_match = True
-                        break
-        
-        # Clean up the value
-        if value and str(value).lower() not in ['nan', 'none', 'nat']:
-            value = str(value).strip()
-        else:
-            value = ""
-        
-        # Special formatting for specific fields
-        if value and tag_name == 'مدتها':
-            # Add "يوم" after the number for duration field
-            try:
-                # Try to extract number and add "يوم"
-                number = str(value).strip()
-                if number.isdigit() or number.replace('.', '').isdigit():
-                    value = f"{number} يوم"
-                elif number:
-                    # If it's not a pure number, just add "يوم" if not already present
-                    if 'يوم' not in number:
-                        value = f"{number} يوم"
-            except:
-                # If any error, just use the original value
-                pass
-        
-        # Map to Content Control tag name (only if we have data)
-        if value:
-            mapping[tag_name] = value
+    if os.path.exists(path):
+        os.utime(path)
+        return path
     
-    return mapping
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    
+    # Remove uploads unused for longer than the retention period, unless a live session holds them
+    cutoff = datetime.now().timestamp() - config.UPLOADS_MAX_AGE_HOURS * 3600
+    leased = leased_upload_paths()
+    for entry in os.scandir(config.UPLOADS_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff and os.path.abspath(entry.path) not in leased:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+    return path
 
-def generate_docx_from_template(template_path, mapping, output_name):
+@st.cache_data(max_entries=8, show_spinner=False)
+def check_template_file(template_hash, _template_path):
     """
-    Generate Word document from template using Content Controls
-    With complete error recovery and safe table handling
+    Test that a Word template opens (cached per template content)
+    Returns error message or None
     """
     try:
-        # Load template with extreme caution
-        try:
-            doc = Document(template_path)
-        except Exception as load_error:
-            st.error(f"❌ خطأ في تحميل القالب: {str(load_error)}")
-            return None
-        
-        replacements_made = 0
-        
-        # Method 1: Safe Content Controls processing
-        try:
-            # Use safe iteration to avoid table errors
-            content_controls_found = []
-            
-            # Find all content controls first without processing tables
-            try:
-                for element in doc.element.body.iter():
-                    try:
-                        if element.tag.endswith('sdt'):  # Structured Document Tag
-                            try:
-                                tag_element = element.find('.//{http://schemas.openxmlformats.org/wordprocessingml/2006/main}tag')
-                                if tag_element is not None:
-                                    tag_value = tag_element.get('{http://schemas.openxmlformats.org/wordprocessingml/2006/main}val')
-                                    if tag_value:
-                                        content_controls_found.append((element, tag_value))
-                            except Exception as cc_find_error:
-                                # Skip problematic content controls
-                                continue
-                    except Exception as element_error:
-                        # Skip problematic elements
-                        continue
-                
-                # Now process the found content controls
-                for element, tag_value in content_controls_found:
-                    try:
-                        if tag_value.strip() in mapping:
-                            data_value = mapping[tag_value.strip()]
-                            
-                            if data_value:
-                                # Find text elements within the content control
-                                try:
-                                    text_elements = element.findall('.//{http://schemas.openxmlformats.org/wordprocessingml/2006/main}t')
-                                    
-                                    if text_elements:
-                                        # Clear existing text
-                                        for text_elem in text_elements:
-                                            try:
-                                                text_elem.text = ""
-                                            except Exception:
-                                                continue
-                                        
-                                        # Set new text (data only)
-                                        if len(text_elements) > 0:
-                                            try:
-                                                text_elements[0].text = data_value
-                                                replacements_made += 1
-                                            except Exception:
-                                                continue
-                                except Exception as text_error:
-                                    # Skip if text element access fails
-                                    continue
-                    except Exception as cc_update_error:
-                        continue
-                        
-            except Exception as cc_method_error:
-                # Method 2: Safe text replacement fallback (avoid tables completely)
-                try:
-                    # Only process paragraphs, avoid tables to prevent grid_offset error
-                    for paragraph in doc.paragraphs:
-                        try:
-                            original_text = paragraph.text
-                            for tag_name, data_value in mapping.items():
-                                try:
-                                    if tag_name in paragraph.text and data_value:
-                                        paragraph.text = paragraph.text.replace(tag_name, data_value)
-                                        replacements_made += 1
-                                except Exception:
-                                    continue
-                        except Exception as para_error:
-                            continue
-                            
-                except Exception as fallback_error:
-                    st.error(f"❌ فشل في معالجة المستند: {str(fallback_error)}")
-        
-        except Exception as processing_error:
-            st.error(f"❌ خطأ في معالجة المستند: {str(processing_error)}")
-        
-        # Show success message only if replacements were made
-        if replacements_made > 0:
-            st.success(f"✅ تم تحديث {replacements_made} عنصر بنجاح")
-        else:
-            st.warning("⚠️ لم يتم العثور على عناصر للتحديث")
-        
-        # Save to BytesIO
-        try:
-            doc_buffer = io.BytesIO()
-            doc.save(doc_buffer)
-            doc_buffer.seek(0)
-            return doc_buffer
-        except Exception as save_error:
-            st.error(f"❌ خطأ في حفظ المستند: {str(save_error)}")
-            return None
-        
-    except Exception as e:
-        st.error(f"❌ خطأ عام في توليد المستند: {str(e)}")
+        # Just test if we can open the document without processing its content
+        test_doc = Document(_template_path)
+        # Test basic access without table iteration
+        _ = len(test_doc.paragraphs)
         return None
+    except Exception as e:
+        return str(e)
 
-def convert_docx_to_pdf(docx_buffer, output_name):
+def resolve_dataset(handle):
     """
-    Convert DOCX to PDF using docx2pdf
+    Resolve the data handle published by the sidebar into the course DataFrame
+    Every step is cached, so each fragment can resolve it on its own reruns
     """
-    if not PDF_AVAILABLE:
-        return None
+    if not handle or not handle.get('excel_path') or not handle.get('sheet'):
+        return pd.DataFrame()
     
-    try:
-        # Create temporary files
-        with tempfile.NamedTemporaryFile(suffix='.docx', delete=False) as temp_docx:
-            temp_docx.write(docx_buffer.getvalue())
-            temp_docx_path = temp_docx.name
-        
-        temp_pdf_path = temp_docx_path.replace('.docx', '.pdf')
-        
-        # Convert to PDF
-        convert(temp_docx_path, temp_pdf_path)
-        
-        # Read PDF content
-        with open(temp_pdf_path, 'rb') as pdf_file:
-            pdf_content = pdf_file.read()
-        
-        # Cleanup
-        os.unlink(temp_docx_path)
-        os.unlink(temp_pdf_path)
-        
-        return pdf_content
-    except Exception as e:
-        st.warning(f"فشل في تحويل PDF: {str(e)}")
-        return None
+    # One read-only copy per workbook/sheet is shared by all sessions
+    df = load_shared_sheet(handle['excel_path'], handle['workbook_hash'], handle['sheet'], slot='dataset')
+    if handle.get('drop_duplicates') and not df.empty:
+        duplicates = get_workbook_duplicates(handle['workbook_hash'], handle['excel_path'])
+        duplicate_rows = duplicates.loc[duplicates['duplicate'] & (duplicates['sheet'] == handle['sheet']), 'row']
+        df = df.drop(index=duplicate_rows, errors='ignore')
+    return df
 
-# ========================= ENHANCED DASHBOARD FUNCTIONS =========================
+def resolve_dataset_fingerprint(handle):
+    """
+    Identity of the frame resolve_dataset returns, without hashing the frame:
+    the sheet's content fingerprint, plus the workbook's when duplicates found
+    across its sheets are dropped
+    """
+    if not handle or not handle.get('excel_path') or not handle.get('sheet'):
+        return dataset_fingerprint(pd.DataFrame())
+    parts = [get_sheet_fingerprint(handle['excel_path'], handle['workbook_hash'], handle['sheet'])]
+    if handle.get('drop_duplicates'):
+        parts.append(handle['workbook_hash'])
+    return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
 
-def get_status_from_approval_column(status_text):
+# ========================= ARROW DATASET FILES =========================
+
+# Bumped when load_excel_data output or the file layout changes, so files published by older versions are rebuilt
+ARROW_DATASET_FORMAT = '3'
+
+def arrow_dataset_path(sheet_hash):
     """
-    Determine course status from "حالة الاعتماد" column values
+    Arrow file path of one sheet version, named by its content fingerprint so
+    unchanged months are reused by every later version (and upload) of the workbook
     """
-    if pd.isna(status_text):
-        return 'unknown'
-    
-    status_text = str(status_text).strip().lower()
-    
-    # Map the specific values from your Excel (handle different spellings)
-    if 'مؤكد' in status_text or 'موكد' in status_text:
-        return 'confirmed'
-    elif 'تاجيل' in status_text or 'تأجيل' in status_text or 'مؤجل' in status_text:
-        return 'postponed'
-    elif 'تحت الاجراء' in status_text or 'اجراء' in status_text or 'إجراء' in status_text:
-        return 'in_progress'
-    elif 'ملغ' in status_text or 'الغاء' in status_text or 'إلغاء' in status_text:
-        return 'cancelled'
-    else:
-        return 'unknown'
+    return os.path.join(config.ARROW_DATASETS_DIR, f"{sheet_hash}.arrow")
 
-def get_delivery_method_from_notes(notes_text):
+def prune_arrow_datasets():
     """
-    Determine delivery method from "ملاحظات" column
-    Only "عن بعد" is considered remote, everything else is on-site
+    Keep only the most recently used Arrow files
     """
-    if pd.isna(notes_text):
-        return 'in_person'
+    try:
+        datasets = sorted(
+            (entry for entry in os.scandir(config.ARROW_DATASETS_DIR) if entry.name.endswith('.arrow')),
+            key=lambda entry: entry.stat().st_mtime,
+            reverse=True
+        )
+    except OSError:
+        return
+    for entry in datasets[config.ARROW_DATASETS_MAX_FILES:]:
+        try:
+            os.unlink(entry.path)
+        except OSError:
+            pass
+
+def write_arrow_dataset(df, path, sheet_hash):
+    """
+    Publish a cleaned sheet as an Arrow IPC file: written to a temp file,
+    then renamed over the old one so readers never see a partial file
+    """
+    arrow_df = df
+    for col in df.columns:
+        if df[col].dtype == object:
+            try:
+                pyarrow.array(df[col], from_pandas=True)
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+                # Mixed-type columns (e.g. numbers and text) are stored as text
+                if arrow_df is df:
+                    arrow_df = df.copy()
+                arrow_df[col] = df[col].astype(str).where(df[col].notna())
     
-    notes_text = str(notes_text).lower().strip()
+    table = pyarrow.Table.from_pandas(arrow_df, preserve_index=True)
+    # Store columns in layouts the reader can map without copying: floats keep
+    # NaN as a value (no null bitmap), dates go in as int64 with NaT as its sentinel
+    date_columns = {}
+    for position in range(len(arrow_df.columns)):
+        values = arrow_df.iloc[:, position].to_numpy()
+        if not isinstance(arrow_df.dtypes.iloc[position], np.dtype):
+            continue
+        if values.dtype.kind == 'f':
+            table = table.set_column(position, table.field(position),
+                                     pyarrow.array(values, from_pandas=False))
+        elif values.dtype.kind == 'M':
+            date_columns[position] = str(values.dtype)
+            table = table.set_column(position, pyarrow.field(table.field(position).name, pyarrow.int64()),
+                                     pyarrow.array(values.view('int64')))
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        b'sheet_hash': sheet_hash.encode('utf-8'),
+        b'format': ARROW_DATASET_FORMAT.encode('utf-8'),
+        b'attrs': json.dumps(df.attrs, ensure_ascii=False, default=str).encode('utf-8'),
+        b'date_columns': json.dumps(date_columns).encode('utf-8')
+    })
     
-    if 'عن بعد' in notes_text or 'عن بُعد' in notes_text:
-        return 'remote'
-    else:
-        return 'in_person'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with pyarrow.OSFile(temp_path, 'wb') as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
 
-def calculate_comprehensive_stats(df, selected_period='all', selected_year=None, selected_month=None, selected_date=None):
+def read_arrow_dataset(path, sheet_hash):
     """
-    Calculate comprehensive statistics using actual column names from your Excel
+    Memory-map a published sheet; None when missing or not built from this sheet version.
+    Number and date columns (and text columns on pandas 3) are views into the mapped
+    file, shared through the page cache by every process; other columns are copied
     """
-    stats = {
-        'total_courses': 0,
-        'confirmed_courses': 0,
-        'postponed_courses': 0,
-        'in_progress_courses': 0,
-        'cancelled_courses': 0,
-        'unknown_courses': 0,
-        'remote_courses': 0,
-        'in_person_courses': 0,
-        'hybrid_courses': 0,
-        'total_participants': 0,
-        'total_training_hours': 0,
-        'total_training_days': 0,
-        'period_label': ''
-    }
+    try:
+        with pyarrow.memory_map(path, 'r') as source:
+            reader = pyarrow.ipc.open_file(source)
+            metadata = reader.schema.metadata or {}
+            if (metadata.get(b'sheet_hash') != sheet_hash.encode('utf-8')
+                    or metadata.get(b'format') != ARROW_DATASET_FORMAT.encode('utf-8')):
+                return None
+            df = reader.read_all().to_pandas(split_blocks=True)
+        # Mark as recently used so pruning keeps it
+        os.utime(path)
+    except (OSError, pyarrow.ArrowInvalid):
+        return None
     
-    if df.empty:
-        return stats
+    attrs = json.loads(metadata.get(b'attrs', b'{}'))
+    # JSON object keys are strings; row labels are ints
+    attrs['unparseable_dates'] = {
+        col: {int(label): value for label, value in values.items()}
+        for col, values in attrs.get('unparseable_dates', {}).items()
+    }
+    df.attrs = attrs
     
-    # Find relevant columns - exact matching
-    start_date_col = None
-    approval_status_col = None
-    notes_col = None
-    participants_col = None
-    hours_col = None
-    days_col = None
+    for position, dtype in json.loads(metadata.get(b'date_columns', b'{}')).items():
+        col = df.columns[int(position)]
+        # Assigning a Series (not an array) keeps the view instead of copying it
+        df[col] = pd.Series(df[col].to_numpy().view(dtype), index=df.index, copy=False)
+    return df
+
+def load_sheet_dataset(file_path, sheet_hash, sheet):
+    """
+    Cleaned sheet from its Arrow file, parsing the workbook only when this sheet
+    version was never published (then publishing it for the other processes)
+    """
+    if not ARROW_AVAILABLE:
+        return load_excel_data(file_path, sheet)
     
-    for col in df.columns:
-        col_str = str(col).strip()  # Remove trailing spaces
-        if col_str == 'تاريخ بداية الدورة بالميلادي':
-            start_date_col = col
-        elif col_str == 'حالة الاعتماد':
-            approval_status_col = col
-        elif col_str == 'ملاحظات':
-            notes_col = col
-        elif 'عدد' in col_str and ('متدرب' in col_str or 'مشارك' in col_str):
-            participants_col = col
-        elif 'ساعة' in col_str or 'ساعات' in col_str:
-            hours_col = col
-        elif col_str == 'عدد الايام':
-            days_col = col
+    path = arrow_dataset_path(sheet_hash)
+    df = read_arrow_dataset(path, sheet_hash)
+    if df is not None:
+        return df
     
-    # Filter data based on selected period
-    filtered_df = df.copy()
+    df = load_excel_data(file_path, sheet)
+    # A frame without columns means loading failed; don't publish it
+    if len(df.columns):
+        try:
+            write_arrow_dataset(df, path, sheet_hash)
+            prune_arrow_datasets()
+        except (OSError, pyarrow.ArrowException):
+            pass
+    return df
+
+# ========================= WORKBOOK CHANGE DETECTION =========================
+
+SPREADSHEET_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+RELATIONSHIP_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PACKAGE_RELATIONSHIP_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+def resolve_workbook_part(target):
+    """
+    Zip member name of a part referenced from xl/_rels/workbook.xml.rels
+    """
+    if target.startswith('/'):
+        return target.lstrip('/')
+    return os.path.normpath(os.path.join('xl', target)).replace(os.sep, '/')
+
+def read_workbook_parts(xlsx):
+    """
+    Workbook XML, related part names by relationship type and the worksheet part of every sheet
+    xlsx: open zipfile.ZipFile of an .xlsx package
+    """
+    workbook = etree.fromstring(xlsx.read('xl/workbook.xml'))
+    relationships = etree.fromstring(xlsx.read('xl/_rels/workbook.xml.rels'))
+    targets = {}
+    for rel in relationships.iter(f'{{{PACKAGE_RELATIONSHIP_NS}}}Relationship'):
+        targets.setdefault(rel.get('Type').rsplit('/', 1)[-1], {})[rel.get('Id')] = resolve_workbook_part(rel.get('Target'))
     
-    if start_date_col and selected_period != 'all':
-        # Convert dates - handle multiple formats
-        def parse_date_flexible(date_str):
-            if pd.isna(date_str):
-                return pd.NaT
+    sheet_parts = {}
+    for sheet in workbook.iter(f'{{{SPREADSHEET_NS}}}sheet'):
+        part = targets.get('worksheet', {}).get(sheet.get(f'{{{RELATIONSHIP_NS}}}id'))
+        if part is not None:
+            sheet_parts[sheet.get('name')] = part
+    return workbook, targets, sheet_parts
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def read_sheet_fingerprints(workbook_hash, _file_path):
+    """
+    Fingerprint every sheet's XML part inside the .xlsx ZIP (cached by workbook content hash)
+    Only cell values are hashed, with shared strings and styles resolved to their
+    text and number format rather than their index, so rows added to one month
+    (or a new selection saved by Excel) leave the other months' fingerprints unchanged
+    Returns {sheet name: fingerprint}; empty when the file is not an .xlsx package
+    """
+    try:
+        with zipfile.ZipFile(_file_path) as xlsx:
+            workbook, targets, sheet_parts = read_workbook_parts(xlsx)
             
-            date_str = str(date_str).strip()
+            # The 1904 date system affects every sheet
+            common = hashlib.sha256()
+            workbook_pr = workbook.find(f'{{{SPREADSHEET_NS}}}workbookPr')
+            if workbook_pr is not None and workbook_pr.get('date1904') in ('1', 'true'):
+                common.update(b'date1904')
             
-            # Try different date formats
-            for fmt in ['%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y', '%m/%d/%Y']:
-                try:
-                    return pd.to_datetime(date_str, format=fmt)
-                except:
-                    continue
+            # Cell style index -> number format code (decides what is read as a date)
+            cell_formats = []
+            for part in targets.get('styles', {}).values():
+                styles = etree.fromstring(xlsx.read(part))
+                format_codes = {
+                    num_fmt.get('numFmtId'): num_fmt.get('formatCode')
+                    for num_fmt in styles.iter(f'{{{SPREADSHEET_NS}}}numFmt')
+                }
+                cell_xfs = styles.find(f'{{{SPREADSHEET_NS}}}cellXfs')
+                if cell_xfs is not None:
+                    cell_formats = [
+                        format_codes.get(xf.get('numFmtId'), xf.get('numFmtId'))
+                        for xf in cell_xfs.iter(f'{{{SPREADSHEET_NS}}}xf')
+                    ]
             
-            # Fallback to pandas auto-parsing
-            try:
-                return pd.to_datetime(date_str, dayfirst=True)
-            except:
-                return pd.NaT
-        
+            shared_strings = shared_string_texts(xlsx, targets)
+            
+            fingerprints = {}
+            for sheet, part in sheet_parts.items():
+                root = etree.fromstring(xlsx.read(part))
+                sheet_data = root.find(f'{{{SPREADSHEET_NS}}}sheetData')
+                hasher = common.copy()
+                cells = sheet_data.iter(f'{{{SPREADSHEET_NS}}}c') if sheet_data is not None else ()
+                for cell in cells:
+                    # Hash what pandas reads, not how the file stores it: text stored as a
+                    # shared or an inline string (as openpyxl saves it) hashes the same
+                    family, value = cell_value(cell, shared_strings)
+                    if value == '':
+                        continue
+                    style = cell.get('s', '0')
+                    number_format = cell_formats[int(style)] if style.isdigit() and int(style) < len(cell_formats) else style
+                    if family != 'n':
+                        number_format = ''
+                    hasher.update(f"{cell.get('r')}\0{family}\0{number_format}\0{value}\0".encode('utf-8'))
+                fingerprints[sheet] = hasher.hexdigest()
+            return fingerprints
+    except (zipfile.BadZipFile, KeyError, etree.XMLSyntaxError):
+        return {}
+
+def get_sheet_fingerprint(file_path, workbook_hash, sheet):
+    """
+    Content fingerprint of one sheet; falls back to the whole workbook's hash
+    when the sheet parts cannot be read (e.g. legacy .xls files)
+    """
+    fingerprint = read_sheet_fingerprints(workbook_hash, file_path).get(sheet)
+    if fingerprint is None:
+        fingerprint = hashlib.sha256(f"{workbook_hash}\0{sheet}".encode('utf-8')).hexdigest()
+    return fingerprint
+
+def row_content_hashes(df, index=True):
+    """
+    64-bit hash of every row, for row-level change detection
+    index: include the row label; leave it out to match rows that only moved
+    """
+    # Object columns mixing types are hashed through their string form
+    hashable = df.apply(lambda col: col.astype(str) if col.dtype == object else col)
+    return pd.util.hash_pandas_object(hashable, index=index)
+
+# ========================= STATUS WRITE-BACK =========================
+
+STATUS_COLUMN = 'حالة الاعتماد'
+XML_SPACE_ATTRIBUTE = '{http://www.w3.org/XML/1998/namespace}space'
+
+def string_item_text(item):
+    """
+    Plain text of a shared (si) or inline (is) string: rich-text runs joined, phonetic hints skipped
+    """
+    phonetic_tag = f'{{{SPREADSHEET_NS}}}rPh'
+    return ''.join(t.text or '' for t in item.iter(f'{{{SPREADSHEET_NS}}}t') if t.getparent().tag != phonetic_tag)
+
+def shared_string_texts(xlsx, targets):
+    """
+    Plain text of every shared string
+    """
+    texts = []
+    for part in targets.get('sharedStrings', {}).values():
+        sst = etree.fromstring(xlsx.read(part))
+        texts = [string_item_text(si) for si in sst.iter(f'{{{SPREADSHEET_NS}}}si')]
+    return texts
+
+def cell_text(cell, shared_strings):
+    """
+    Displayed text of a worksheet cell element
+    """
+    cell_type = cell.get('t')
+    if cell_type == 'inlineStr':
+        inline = cell.find(f'{{{SPREADSHEET_NS}}}is')
+        return string_item_text(inline) if inline is not None else ''
+    value = cell.findtext(f'{{{SPREADSHEET_NS}}}v') or ''
+    if cell_type == 's' and value.isdigit() and int(value) < len(shared_strings):
+        return shared_strings[int(value)]
+    return value
+
+# Cell types by the kind of value pandas reads from them
+CELL_TYPE_FAMILIES = {'s': 't', 'inlineStr': 't', 'str': 't', 'b': 'b', 'e': 'e', 'd': 'd'}
+
+def cell_value(cell, shared_strings):
+    """
+    (type family, normalized value) of a worksheet cell element
+    Numbers are compared by value, so 45000 and 45000.0 are the same cell
+    """
+    family = CELL_TYPE_FAMILIES.get(cell.get('t'), 'n')
+    value = cell_text(cell, shared_strings)
+    if family == 'n' and value:
+        try:
+            value = repr(float(value))
+        except ValueError:
+            pass
+    return family, value
+
+def insert_in_order(parent, child, position, position_of):
+    """
+    Insert child before the first sibling with a larger position
+    """
+    for sibling in parent:
+        if position_of(sibling) > position:
+            sibling.addprevious(child)
+            return
+    parent.append(child)
+
+def patch_workbook_cells(file_path, sheet, column_name, values):
+    """
+    Copy of the workbook with cells of one column replaced, returned as bytes
+    values: {worksheet row number: text}
+    Only the sheet's XML part is rewritten (text stored as inline strings, keeping
+    each cell's style); every other part is copied as is
+    Returns (workbook bytes, row numbers skipped because their cell holds a formula)
+    """
+    with zipfile.ZipFile(file_path) as xlsx:
+        workbook, targets, sheet_parts = read_workbook_parts(xlsx)
+        part = sheet_parts[sheet]
+        root = etree.fromstring(xlsx.read(part))
+        sheet_data = root.find(f'{{{SPREADSHEET_NS}}}sheetData')
+        rows = {int(row.get('r')): row for row in sheet_data.iterchildren(f'{{{SPREADSHEET_NS}}}row')}
+        
+        # Column letter of the header cell in row 1
+        shared_strings = shared_string_texts(xlsx, targets)
+        header_cells = rows[1].iterchildren(f'{{{SPREADSHEET_NS}}}c') if 1 in rows else ()
+        column = next((
+            openpyxl.utils.cell.coordinate_from_string(cell.get('r'))[0]
+            for cell in header_cells if cell_text(cell, shared_strings).strip() == column_name.strip()
+        ), None)
+        if column is None:
+            raise KeyError(column_name)
+        column_index = openpyxl.utils.cell.column_index_from_string(column)
+        
+        skipped = []
+        for row_number, text in sorted(values.items()):
+            row = rows.get(row_number)
+            if row is None:
+                row = etree.Element(f'{{{SPREADSHEET_NS}}}row', r=str(row_number))
+                insert_in_order(sheet_data, row, row_number, lambda sibling: int(sibling.get('r', 0)))
+                rows[row_number] = row
+            
+            reference = f"{column}{row_number}"
+            cell = next((c for c in row.iterchildren(f'{{{SPREADSHEET_NS}}}c') if c.get('r') == reference), None)
+            if cell is None:
+                cell = etree.Element(f'{{{SPREADSHEET_NS}}}c', r=reference)
+                insert_in_order(
+                    row, cell, column_index,
+                    lambda sibling: openpyxl.utils.cell.column_index_from_string(
+                        openpyxl.utils.cell.coordinate_from_string(sibling.get('r', 'A1'))[0]
+                    )
+                )
+            elif cell.find(f'{{{SPREADSHEET_NS}}}f') is not None:
+                skipped.append(row_number)
+                continue
+            
+            for child in list(cell):
+                cell.remove(child)
+            if text:
+                cell.set('t', 'inlineStr')
+                inline = etree.SubElement(cell, f'{{{SPREADSHEET_NS}}}is')
+                text_element = etree.SubElement(inline, f'{{{SPREADSHEET_NS}}}t')
+                text_element.text = text
+                if text != text.strip():
+                    text_element.set(XML_SPACE_ATTRIBUTE, 'preserve')
+            else:
+                cell.attrib.pop('t', None)
+        
+        patched_parts = {part: etree.tostring(root, xml_declaration=True, encoding='UTF-8', standalone=True)}
+        
+        # Formulas elsewhere may depend on the status column: have Excel recalculate on open
+        if targets.get('calcChain'):
+            calc_pr = workbook.find(f'{{{SPREADSHEET_NS}}}calcPr')
+            if calc_pr is not None and calc_pr.get('fullCalcOnLoad') != '1':
+                calc_pr.set('fullCalcOnLoad', '1')
+                patched_parts['xl/workbook.xml'] = etree.tostring(
+                    workbook, xml_declaration=True, encoding='UTF-8', standalone=True
+                )
+        
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as patched:
+            for info in xlsx.infolist():
+                # Same entry metadata and compression for every part
+                patched.writestr(info, patched_parts.get(info.filename) or xlsx.read(info.filename))
+    return buffer.getvalue(), skipped
+
+@st.cache_resource
+def get_write_back_lock():
+    """
+    Serializes in-place workbook updates across sessions
+    """
+    return threading.Lock()
+
+def write_back_cells(file_path, sheet, column_name, values):
+    """
+    Patch cells of the workbook file in place (atomic rename)
+    Returns row numbers skipped because their cell holds a formula
+    """
+    with get_write_back_lock():
+        data, skipped = patch_workbook_cells(file_path, sheet, column_name, values)
+        temp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, file_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+    return skipped
+
+def show_status_write_back(df, handle):
+    """
+    Update the approval status of selected courses directly in the source workbook
+    The data file on the server is patched in place; an uploaded file is offered
+    as an updated copy to download
+    """
+    message = st.session_state.pop('status_write_back_message', None)
+    if message:
+        st.success(message)
+    
+    status_col = next((col for col in df.columns if str(col).strip() == STATUS_COLUMN), None)
+    if df.empty or status_col is None or not df.attrs.get('excel_rows') or not handle.get('excel_path'):
+        return
+    
+    excel_path = handle['excel_path']
+    in_place = not os.path.abspath(excel_path).startswith(os.path.abspath(config.UPLOADS_DIR) + os.sep)
+    name_col = find_column(df.columns, *COURSE_KEY_COLUMNS['name'])
+    
+    with st.expander("✏️ تحديث حالة الاعتماد في ملف Excel"):
+        selected_labels = st.multiselect(
+            "الدورات",
+            list(df.index),
+            format_func=lambda label: f"{label + 1} - {df.at[label, name_col]}" if name_col is not None else str(label + 1),
+            key="status_write_back_rows"
+        )
+        known_statuses = sorted(df[status_col].dropna().astype(str).str.strip().loc[lambda s: s != ''].unique())
+        new_status = st.selectbox("الحالة الجديدة", known_statuses + ["أخرى..."], key="status_write_back_value")
+        if new_status == "أخرى...":
+            new_status = st.text_input("اكتب الحالة", key="status_write_back_custom")
+        new_status = new_status.strip()
+        
+        if not selected_labels or not new_status:
+            return
+        
+        excel_rows = df.attrs['excel_rows']
+        values = {excel_rows[label]: new_status for label in selected_labels}
+        
+        if in_place:
+            if st.button(f"💾 حفظ الحالة في الملف ({len(values)} دورة)", key="status_write_back_save"):
+                try:
+                    skipped = write_back_cells(excel_path, handle['sheet'], str(status_col), values)
+                except Exception as e:
+                    st.error(f"تعذر تحديث الملف: {str(e)}")
+                    return
+                saved = len(values) - len(skipped)
+                message = f"✅ تم تحديث حالة {saved} دورة إلى: {new_status}"
+                if skipped:
+                    message += f" (تم تجاوز {len(skipped)} خلية تحتوي على معادلة)"
+                st.session_state['status_write_back_message'] = message
+                # The workbook changed: reload it (only this sheet is parsed again)
+                st.rerun()
+        else:
+            try:
+                data, skipped = patch_workbook_cells(excel_path, handle['sheet'], str(status_col), values)
+            except Exception as e:
+                st.error(f"تعذر تحديث الملف: {str(e)}")
+                return
+            if skipped:
+                st.warning(f"⚠️ تم تجاوز {len(skipped)} خلية تحتوي على معادلة")
+            st.download_button(
+                label=f"📥 تحميل الملف بعد تحديث {len(values) - len(skipped)} دورة",
+                data=data,
+                file_name=f"ملف_الخطة_محدث_{datetime.now().strftime('%Y%m%d')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                key="status_write_back_download"
+            )
+
+# ========================= DATA VALIDATION =========================
+
+# rule id -> (label, severity); "error" rules can block bulk generation
+VALIDATION_RULES = {
+    'missing_trainer': ("اسم المدرب غير موجود", 'warning'),
+    'missing_venue': ("مكان الانعقاد غير موجود", 'warning'),
+    'end_before_start': ("تاريخ النهاية قبل تاريخ البداية", 'error'),
+    'non_numeric_days': ("عدد الأيام ليس رقماً", 'warning'),
+    'unparseable_date': ("تاريخ غير قابل للقراءة", 'error'),
+    'unknown_status': ("حالة اعتماد غير معروفة", 'warning')
+}
+
+SEVERITY_LABELS = {'error': "❌ خطأ", 'warning': "⚠️ تنبيه"}
+
+def find_column(df_columns, keywords, exclude=()):
+    """
+    First column whose name contains any keyword and none of the excluded words
+    """
+    for keyword in keywords:
+        for col in df_columns:
+            col_name = str(col)
+            if keyword in col_name and not any(word in col_name for word in exclude):
+                return col
+    return None
+
+def is_blank(series):
+    """
+    Vectorized check for missing or whitespace-only values
+    """
+    return series.isna() | (series.astype(str).str.strip() == '')
+
+def validate_course_frame(df):
+    """
+    Run the data-quality rules column-wise over the loaded frame
+    Returns DataFrame with one row per issue
+    """
+    issue_frames = []
+    
+    def add_issues(rule_id, mask, column, values):
+        if not mask.any():
+            return
+        label, severity = VALIDATION_RULES[rule_id]
+        flagged = df.index[mask.to_numpy(dtype=bool)]
+        issue_frames.append(pd.DataFrame({
+            'الصف': flagged + 1,
+            'الخطورة': SEVERITY_LABELS[severity],
+            'المشكلة': label,
+            'العمود': str(column).strip(),
+            'القيمة': values.loc[flagged].astype(str).str.strip().to_numpy(),
+            'severity': severity,
+            'rule': rule_id
+        }))
+    
+    if df.empty:
+        return pd.DataFrame(columns=['الصف', 'الخطورة', 'المشكلة', 'العمود', 'القيمة', 'severity', 'rule'])
+    
+    # Cancelled courses do not need a trainer or a venue
+    status_col = find_column(df.columns, ['حالة الاعتماد'])
+    if status_col is not None:
+        statuses = classify_approval_status(df[status_col])
+        active = statuses != 'cancelled'
+        add_issues('unknown_status', (statuses == 'unknown') & ~is_blank(df[status_col]), status_col, df[status_col])
+    else:
+        active = pd.Series(True, index=df.index)
+    
+    trainer_col = find_column(df.columns, ['اسم المدرب', 'المدرب'], exclude=['ايميل', 'إيميل'])
+    if trainer_col is not None:
+        add_issues('missing_trainer', active & is_blank(df[trainer_col]), trainer_col, df[trainer_col].fillna(''))
+    
+    venue_col = find_column(df.columns, ['مكان الانعقاد', 'المكان', 'القاعة'])
+    if venue_col is not None:
+        add_issues('missing_venue', active & is_blank(df[venue_col]), venue_col, df[venue_col].fillna(''))
+    
+    days_col = find_column(df.columns, ['عدد الايام', 'عدد الأيام'])
+    if days_col is not None:
+        days = pd.to_numeric(df[days_col], errors='coerce')
+        add_issues('non_numeric_days', days.isna() & ~is_blank(df[days_col]), days_col, df[days_col])
+    
+    # Gregorian dates that cannot be read or have implausible years; Hijri columns hold
+    # Hijri text and are not checked. Values the loader could not parse are re-read
+    # with parse_date_flexible, which also accepts day-first and mixed formats
+    unparseable_dates = df.attrs.get('unparseable_dates', {})
+    date_columns = [col for col in df.columns if 'تاريخ' in str(col).lower() or 'date' in str(col).lower()]
+    hijri_first, hijri_last = config.VALIDATION_HIJRI_YEARS
+    for col in date_columns:
+        if 'هجري' in str(col):
+            continue
+        raw_values = pd.Series(unparseable_dates.get(col, {}), dtype=object)
+        # A filtered frame keeps the loader's attrs for all of its rows
+        raw_values = raw_values[raw_values.index.isin(df.index)]
+        reread = df.index.isin(raw_values.index)
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            values = df[col].dt.strftime(config.DATE_FORMAT).astype(object)
+            years = df[col].dt.year.astype(float)
+        else:
+            values = df[col].astype(object)
+            years = pd.Series(np.nan, index=df.index)
+        if reread.any():
+            values = values.where(~reread, raw_values.reindex(df.index))
+            years.loc[raw_values.index] = raw_values.map(lambda value: parse_date_flexible(value).year).astype(float)
+        
+        invalid = (reread & years.isna()) | (years < config.VALIDATION_MIN_YEAR)
+        if 'ميلادي' not in str(col):
+            # A column that doesn't name its calendar may hold Hijri dates
+            invalid &= ~years.between(hijri_first, hijri_last)
+        add_issues('unparseable_date', invalid, col, values)
+    
+    start_col = find_column(df.columns, ['تاريخ بداية الدورة بالميلادي', 'تاريخ بداية الدورة'], exclude=['هجري'])
+    end_col = find_column(df.columns, ['تاريخ نهاية الدورة بالميلادي', 'تاريخ نهاية الدورة'], exclude=['هجري'])
+    if start_col is not None and end_col is not None:
+        start_dates = pd.to_datetime(df[start_col], errors='coerce')
+        end_dates = pd.to_datetime(df[end_col], errors='coerce')
+        end_before_start = (end_dates < start_dates).fillna(False)
+        date_range_text = start_dates.dt.strftime('%d/%m/%Y') + ' ← ' + end_dates.dt.strftime('%d/%m/%Y')
+        add_issues('end_before_start', end_before_start, end_col, date_range_text)
+    
+    if not issue_frames:
+        return pd.DataFrame(columns=['الصف', 'الخطورة', 'المشكلة', 'العمود', 'القيمة', 'severity', 'rule'])
+    return pd.concat(issue_frames, ignore_index=True).sort_values(['الصف', 'severity'], kind='stable', ignore_index=True)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def get_validation_issues(fingerprint, _df):
+    """
+    validate_course_frame of a whole dataset, cached by dataset fingerprint
+    Rules only look at one row at a time, so a subset's issues are these issues' rows
+    """
+    return validate_course_frame(_df)
+
+def show_validation_report(issues_df):
+    """
+    Filterable issue table for the data-quality report
+    """
+    error_count = int((issues_df['severity'] == 'error').sum())
+    warning_count = int((issues_df['severity'] == 'warning').sum())
+    label = f"🩺 فحص جودة البيانات ({error_count} خطأ، {warning_count} تنبيه)"
+    
+    with st.expander(label, expanded=error_count > 0):
+        if issues_df.empty:
+            st.success("✅ لم يتم العثور على مشكلات في البيانات")
+            return
+        
+        filter_col1, filter_col2 = st.columns(2)
+        selected_severities = filter_col1.multiselect(
+            "الخطورة", list(SEVERITY_LABELS.values()), default=list(SEVERITY_LABELS.values()),
+            key="validation_severity_filter"
+        )
+        rule_labels = [label for label, _ in VALIDATION_RULES.values() if label in set(issues_df['المشكلة'])]
+        selected_rules = filter_col2.multiselect(
+            "المشكلة", rule_labels, default=rule_labels, key="validation_rule_filter"
+        )
+        
+        filtered = issues_df[
+            issues_df['الخطورة'].isin(selected_severities) & issues_df['المشكلة'].isin(selected_rules)
+        ]
+        st.write(f"عدد المشكلات المعروضة: {len(filtered)} من {len(issues_df)}")
+        # HTML table to avoid pyarrow dependency
+        st.markdown(
+            filtered.drop(columns=['severity', 'rule']).to_html(escape=True, index=False),
+            unsafe_allow_html=True
+        )
+
+# ========================= COLUMN PROFILER =========================
+
+INFERRED_TYPE_LABELS = {
+    'string': "نص",
+    'integer': "رقم صحيح",
+    'floating': "رقم",
+    'mixed-integer-float': "رقم",
+    'decimal': "رقم",
+    'boolean': "نعم/لا",
+    'datetime64': "تاريخ",
+    'datetime': "تاريخ",
+    'date': "تاريخ",
+    'timedelta64': "مدة",
+    'timedelta': "مدة",
+    'time': "وقت",
+    'mixed': "مختلط",
+    'mixed-integer': "مختلط",
+    'empty': "فارغ"
+}
+
+def dataset_fingerprint(df):
+    """
+    Content hash of a DataFrame (values, index and column names)
+    """
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps([str(col) for col in df.columns], ensure_ascii=False).encode('utf-8'))
+    if not df.empty:
+        hasher.update(row_content_hashes(df).to_numpy().tobytes())
+    return hasher.hexdigest()
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def profile_columns(fingerprint, _df, top_n=3):
+    """
+    Per-column statistics: null ratio, cardinality, top values, date range and inferred type
+    Cached by dataset fingerprint; returns DataFrame with one row per column
+    """
+    df = _df
+    row_count = len(df)
+    null_ratios = df.isna().mean() if row_count else pd.Series(0.0, index=df.columns)
+    cardinalities = df.nunique(dropna=True)
+    
+    profile_rows = []
+    for col in df.columns:
+        series = df[col]
+        inferred = 'empty' if null_ratios[col] == 1 else pd.api.types.infer_dtype(series, skipna=True)
+        
+        top_counts = series.value_counts(dropna=True).head(top_n)
+        if pd.api.types.is_datetime64_any_dtype(series):
+            top_labels = top_counts.index.strftime(config.DISPLAY_DATE_FORMAT)
+            non_null = series.dropna()
+            min_date = non_null.min().strftime(config.DISPLAY_DATE_FORMAT) if not non_null.empty else ''
+            max_date = non_null.max().strftime(config.DISPLAY_DATE_FORMAT) if not non_null.empty else ''
+        else:
+            top_labels = top_counts.index.astype(str).str.strip()
+            min_date = max_date = ''
+        
+        profile_rows.append({
+            'العمود': str(col).strip(),
+            'النوع': INFERRED_TYPE_LABELS.get(inferred, inferred),
+            'نسبة الفراغ': f"{null_ratios[col]:.0%}",
+            'القيم المختلفة': int(cardinalities[col]),
+            'الأكثر تكراراً': '، '.join(f"{label} ({count})" for label, count in zip(top_labels, top_counts.to_numpy())),
+            'أقدم تاريخ': min_date,
+            'أحدث تاريخ': max_date
+        })
+    
+    return pd.DataFrame(profile_rows)
+
+def show_column_profile(df, fingerprint=None):
+    """
+    Sidebar panel with the column profile of the loaded data
+    fingerprint: identity of df (resolve_dataset_fingerprint); hashed from df when omitted
+    """
+    if df.empty:
+        return
+    
+    with st.expander("🔬 ملف تعريف الأعمدة"):
+        if fingerprint is None:
+            fingerprint = dataset_fingerprint(df)
+        profile_df = profile_columns(fingerprint, df)
+        # HTML table to avoid pyarrow dependency
+        st.markdown(profile_df.to_html(escape=True, index=False), unsafe_allow_html=True)
+
+# ========================= DUPLICATE COURSE DETECTION =========================
+
+# Key parts of a course and the columns they are read from (first match wins)
+COURSE_KEY_COLUMNS = {
+    'name': (['اسم الدورة بالعربي', 'اسم الدورة باللغة العربية', 'اسم الدورة', 'الدورة'], ['تاريخ', 'نجليزي']),
+    'trainer': (['اسم المدرب', 'المدرب'], ['ايميل', 'إيميل']),
+    'start_date': (['تاريخ بداية الدورة بالميلادي', 'تاريخ بداية الدورة'], ['هجري']),
+    'venue': (['مكان الانعقاد', 'المكان', 'القاعة'], [])
+}
+
+def course_key_hashes(df):
+    """
+    Hash of the normalized (course name, trainer, start date, venue) key of every row
+    Rows with an empty key get no hash (NA)
+    """
+    key_parts = {}
+    for part, (keywords, exclude) in COURSE_KEY_COLUMNS.items():
+        col = find_column(df.columns, keywords, exclude=exclude)
+        if col is None:
+            key_parts[part] = pd.Series('', index=df.index)
+        elif part == 'start_date':
+            # Dates the loader could not parse are compared by their original text
+            raw_dates = pd.Series(df.attrs.get('unparseable_dates', {}).get(col, {}), dtype=object)
+            dates = pd.to_datetime(df[col], errors='coerce').dt.strftime(config.DATE_FORMAT)
+            key_parts[part] = dates.fillna(normalize_arabic_series(raw_dates.reindex(df.index)))
+        else:
+            key_parts[part] = normalize_arabic_series(df[col])
+    
+    keys = pd.DataFrame(key_parts, index=df.index)
+    hashes = pd.Series(pd.util.hash_pandas_object(keys, index=False).to_numpy(), index=df.index, dtype='UInt64')
+    return hashes.mask((keys == '').all(axis=1))
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def get_sheet_course_keys(sheet_hash, _df):
+    """
+    Course key hashes of one sheet version (cached by sheet fingerprint, so
+    only changed months are re-hashed when the workbook is edited)
+    """
+    return course_key_hashes(_df)
+
+def find_duplicate_courses(sheet_keys):
+    """
+    Detect repeated courses across ordered (sheet, course key hashes) pairs in one pass
+    The first occurrence is the original; later rows with the same key are duplicates
+    Returns DataFrame with sheet, row, duplicate flag and the original's sheet/row
+    """
+    key_frames = [
+        pd.DataFrame({'sheet': sheet, 'row': keys.index, 'key': keys.to_numpy()})
+        for sheet, keys in sheet_keys if not keys.empty
+    ]
+    if not key_frames:
+        return pd.DataFrame(columns=['sheet', 'row', 'key', 'duplicate', 'first_sheet', 'first_row'])
+    
+    keys = pd.concat(key_frames, ignore_index=True)
+    keys['duplicate'] = keys['key'].duplicated(keep='first') & keys['key'].notna()
+    originals = keys.loc[~keys['duplicate'] & keys['key'].notna()].set_index('key')
+    keys['first_sheet'] = keys['key'].map(originals['sheet'])
+    keys['first_row'] = keys['key'].map(originals['row'])
+    return keys
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def get_workbook_duplicates(workbook_hash, _file_path):
+    """
+    Duplicate courses over all month sheets of a workbook (in sheet order)
+    Cached by workbook content hash
+    """
+    sheet_keys = []
+    for sheet in get_available_sheets(_file_path):
+        df = load_shared_sheet(_file_path, workbook_hash, sheet)
+        sheet_keys.append((sheet, get_sheet_course_keys(get_sheet_fingerprint(_file_path, workbook_hash, sheet), df)))
+    return find_duplicate_courses(sheet_keys)
+
+def show_duplicate_courses(file_path, sheet):
+    """
+    Sidebar panel listing repeated courses
+    Returns True when the current sheet's duplicates should be dropped, so they
+    are neither counted nor generated twice
+    """
+    try:
+        duplicates = get_workbook_duplicates(get_file_content_hash(file_path), file_path)
+    except Exception as e:
+        st.warning(f"تعذر فحص الدورات المكررة: {str(e)}")
+        return False
+    
+    repeated = duplicates[duplicates['duplicate']]
+    sheet_duplicates = repeated[repeated['sheet'] == sheet]
+    
+    with st.expander(f"🧬 الدورات المكررة ({len(sheet_duplicates)} في هذا الشهر، {len(repeated)} في الملف)"):
+        if repeated.empty:
+            st.success("✅ لا توجد دورات مكررة")
+        else:
+            report_df = pd.DataFrame({
+                'الشهر': repeated['sheet'],
+                'الصف': repeated['row'] + 1,
+                'مكررة من الشهر': repeated['first_sheet'],
+                'مكررة من الصف': repeated['first_row'] + 1
+            })
+            # HTML table to avoid pyarrow dependency
+            st.markdown(report_df.to_html(escape=True, index=False), unsafe_allow_html=True)
+    
+    if sheet_duplicates.empty:
+        return False
+    
+    if st.checkbox("استبعاد الدورات المكررة من الإحصائيات والتوليد", key="drop_duplicate_courses"):
+        st.info(f"🧬 تم استبعاد {len(sheet_duplicates)} دورة مكررة")
+        return True
+    return False
+
+# ========================= GENERATOR QUERY INDEX =========================
+
+APPROVAL_STATUS_LABELS = {
+    'confirmed': 'مؤكدة',
+    'postponed': 'مؤجلة',
+    'in_progress': 'تحت الإجراء',
+    'cancelled': 'ملغاة',
+    'unknown': 'غير محددة'
+}
+
+class RowBitmapIndex:
+    """
+    Per-value row bitmaps (packed with numpy) for the generator filters
+    Values of one field are OR-ed, fields are AND-ed, and the result maps
+    back to row labels without scanning the frame's columns again
+    """
+
+    def __init__(self, df, fields):
+        self.labels = df.index
+        self.row_count = len(df)
+        self.bitmaps = {}
+        self.value_order = {}
+        for field, (values, value_order) in fields.items():
+            codes, uniques = pd.factorize(values, sort=False)
+            self.bitmaps[field] = {
+                value: np.packbits(codes == code) for code, value in enumerate(uniques)
+            }
+            self.value_order[field] = [value for value in value_order if value in self.bitmaps[field]]
+
+    def values(self, field):
+        """
+        Values of a field that occur in at least one row, in display order
+        """
+        return self.value_order.get(field, [])
+
+    def match(self, field, values):
+        """
+        Bitmap of rows whose field has any of the values
+        """
+        bitmaps = [self.bitmaps[field][value] for value in values if value in self.bitmaps[field]]
+        if not bitmaps:
+            return np.zeros((self.row_count + 7) // 8, dtype=np.uint8)
+        return np.bitwise_or.reduce(bitmaps)
+
+    def query(self, filters):
+        """
+        Row labels matching every field filter ({field: [values]}, empty = no filter)
+        """
+        result = None
+        for field, values in filters.items():
+            if not values:
+                continue
+            bitmap = self.match(field, values)
+            result = bitmap if result is None else result & bitmap
+        if result is None:
+            return self.labels
+        return self.labels[np.unpackbits(result, count=self.row_count).astype(bool)]
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def get_row_bitmap_index(fingerprint, _df):
+    """
+    Build the generator filter index once per dataset fingerprint
+    """
+    df = _df
+    fields = {}
+    
+    audience_col = find_column(df.columns, ['الفئة المستهدفة'])
+    if audience_col is not None:
+        audience = df[audience_col].astype(str).where(df[audience_col].notna())
+        fields['audience'] = (audience, sorted(audience.dropna().unique()))
+    
+    status_col = find_column(df.columns, ['حالة الاعتماد'])
+    if status_col is not None:
+        statuses = classify_approval_status(df[status_col]).map(APPROVAL_STATUS_LABELS)
+        fields['status'] = (statuses, list(APPROVAL_STATUS_LABELS.values()))
+    
+    for field, (keywords, exclude) in (('trainer', COURSE_KEY_COLUMNS['trainer']), ('venue', COURSE_KEY_COLUMNS['venue'])):
+        col = find_column(df.columns, keywords, exclude=exclude)
+        if col is not None:
+            values = df[col].astype(str).str.strip().where(~is_blank(df[col]))
+            fields[field] = (values, sorted(values.dropna().unique()))
+    
+    date_col = find_column(df.columns, ['تاريخ بداية الدورة بالميلادي'])
+    if date_col is not None:
+        # Parse all values to datetime, including string formats like '14/9/2025'
+        parsed_dates = pd.to_datetime(df[date_col].astype(str), errors='coerce', dayfirst=True)
+        days = parsed_dates.dt.strftime('%d/%m/%Y')
+        day_order = [day.strftime('%d/%m/%Y') for day in sorted(parsed_dates.dropna().dt.date.unique())]
+        fields['day'] = (days, day_order)
+    
+    return RowBitmapIndex(df, fields)
+
+SEARCH_TOKEN_PATTERN = re.compile(r'\w+')
+
+class CourseSearchIndex:
+    """
+    Inverted index of Arabic-normalized tokens -> row positions
+    Terms are kept sorted so prefix queries are a bisect plus a short scan;
+    tokens with the definite article "ال" are also indexed without it
+    """
+
+    def __init__(self, df, columns):
+        self.labels = df.index
+        token_frames = []
+        for col in columns:
+            tokens = normalize_arabic_series(df[col]).str.findall(SEARCH_TOKEN_PATTERN)
+            tokens.index = np.arange(len(df))
+            token_frames.append(tokens.explode().dropna())
+        
+        postings = {}
+        if token_frames:
+            tokens = pd.concat(token_frames)
+            without_article = tokens[tokens.str.startswith('ال') & (tokens.str.len() > 3)].str[2:]
+            tokens = pd.concat([tokens, without_article])
+            for term, positions in pd.Series(tokens.index).groupby(tokens.to_numpy()).agg(frozenset).items():
+                postings[term] = positions
+        self.postings = postings
+        self.terms = sorted(postings)
+
+    def prefix_postings(self, prefix):
+        """
+        Row positions of every term starting with prefix
+        """
+        start = bisect.bisect_left(self.terms, prefix)
+        matches = set()
+        for term in itertools.islice(self.terms, start, None):
+            if not term.startswith(prefix):
+                break
+            matches |= self.postings[term]
+        return matches
+
+    def search(self, query):
+        """
+        Row labels matching all query tokens (each as a prefix), in frame order
+        """
+        positions = None
+        for token in SEARCH_TOKEN_PATTERN.findall(normalize_arabic(query)):
+            matches = self.prefix_postings(token)
+            positions = matches if positions is None else positions & matches
+            if not positions:
+                break
+        if positions is None:
+            return self.labels
+        return self.labels[sorted(positions)]
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def get_course_search_index(fingerprint, _df):
+    """
+    Build the course search index (name, trainer, venue) once per dataset fingerprint
+    """
+    columns = [
+        find_column(_df.columns, keywords, exclude=exclude)
+        for keywords, exclude in (COURSE_KEY_COLUMNS['name'], COURSE_KEY_COLUMNS['trainer'], COURSE_KEY_COLUMNS['venue'])
+    ]
+    return CourseSearchIndex(_df, [col for col in columns if col is not None])
+
+# ========================= SCHEMA DRIFT REPORT =========================
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def read_workbook_headers(workbook_hash, _file_path):
+    """
+    Read only the header row of every sheet (openpyxl read-only mode)
+    Cached by workbook content hash; returns {sheet name: [column names]}
+    """
+    wb = openpyxl.load_workbook(_file_path, read_only=True)
+    try:
+        headers = {}
+        for ws in wb.worksheets:
+            first_row = next(ws.iter_rows(min_row=1, max_row=1, values_only=True), ())
+            # Same columns load_excel_data keeps (pandas names empty headers "Unnamed")
+            headers[ws.title] = [str(value) for value in first_row if value is not None and str(value).strip()]
+        return headers
+    finally:
+        wb.close()
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def build_schema_drift_report(workbook_hash, _file_path):
+    """
+    Diff every sheet's columns against the schema resolved over the whole workbook
+    The resolved schema is:
+    - for every template tag, the column most sheets feed it from (mapping plan)
+    - the columns present in at least half of the sheets (compared normalized)
+    Returns DataFrame with one row per sheet
+    """
+    headers = read_workbook_headers(workbook_hash, _file_path)
+    sheet_plans = {
+        sheet: {tag_name: source_col for source_col, tag_name in resolve_mapping_plan(tuple(columns))}
+        for sheet, columns in headers.items()
+    }
+    
+    # Modal source column per tag
+    tag_sources = {}
+    for plan in sheet_plans.values():
+        for tag_name, source_col in plan.items():
+            tag_sources.setdefault(tag_name, []).append(str(source_col).strip())
+    resolved_tags = {
+        tag_name: pd.Series(sources).mode().iloc[0] for tag_name, sources in tag_sources.items()
+    }
+    
+    # Columns shared by at least half of the sheets, keyed by normalized name
+    column_presence = {}
+    display_names = {}
+    for columns in headers.values():
+        for col in set(normalize_arabic(col) for col in columns):
+            column_presence[col] = column_presence.get(col, 0) + 1
+        for col in columns:
+            display_names.setdefault(normalize_arabic(col), col.strip())
+    reference_columns = {
+        col for col, count in column_presence.items() if count * 2 >= len(headers)
+    }
+    
+    report_rows = []
+    for sheet, columns in headers.items():
+        plan = sheet_plans[sheet]
+        normalized_columns = {normalize_arabic(col): col for col in columns}
+        
+        lost_fields = [tag_name for tag_name in EXCEL_TO_TAG_MAPPING.values() if tag_name in resolved_tags and tag_name not in plan]
+        lost_fields = list(dict.fromkeys(lost_fields))
+        changed_sources = [
+            f"{tag_name}: {str(plan[tag_name]).strip()} (بدلاً من {resolved_tags[tag_name]})"
+            for tag_name in resolved_tags
+            if tag_name in plan and str(plan[tag_name]).strip() != resolved_tags[tag_name]
+        ]
+        
+        missing = [col for col in reference_columns if col not in normalized_columns]
+        extra = [col for col in normalized_columns if col not in reference_columns]
+        
+        # Missing reference columns that look like one of this sheet's extra columns
+        renamed = []
+        if missing and extra:
+            matcher = get_column_matcher(tuple(extra))
+            for col in list(missing):
+                candidates = [
+                    (candidate, score) for candidate, score in matcher.rank(col, limit=len(extra))
+                    if candidate in extra
+                ]
+                if candidates and candidates[0][1] >= config.FUZZY_MATCH_THRESHOLD:
+                    renamed.append(f"{display_names[col]} ← {normalized_columns[candidates[0][0]].strip()}")
+                    missing.remove(col)
+                    extra.remove(candidates[0][0])
+        
+        if lost_fields:
+            status = "❌ ستفقد حقول"
+        elif changed_sources or missing or renamed:
+            status = "⚠️ اختلافات"
+        else:
+            status = "✅ مطابقة"
+        
+        report_rows.append({
+            'الورقة': sheet,
+            'الحالة': status,
+            'عدد الأعمدة': len(columns),
+            'حقول ستفقد': '، '.join(lost_fields),
+            'حقول من أعمدة مختلفة': '، '.join(changed_sources),
+            'أعمدة أعيدت تسميتها': '، '.join(renamed),
+            'أعمدة ناقصة': '، '.join(display_names[col] for col in sorted(missing)),
+            'أعمدة إضافية': '، '.join(normalized_columns[col].strip() for col in extra)
+        })
+    
+    return pd.DataFrame(report_rows)
+
+def show_schema_drift_report(file_path):
+    """
+    Sidebar panel listing which month sheets drift from the workbook schema
+    """
+    try:
+        report_df = build_schema_drift_report(get_file_content_hash(file_path), file_path)
+    except Exception as e:
+        st.warning(f"تعذر فحص أعمدة أوراق العمل: {str(e)}")
+        return
+    
+    losing = report_df[report_df['الحالة'] == "❌ ستفقد حقول"]
+    label = f"🧭 فحص اختلاف الأعمدة بين الأشهر ({len(losing)} ورقة ستفقد حقولاً)"
+    with st.expander(label, expanded=not losing.empty):
+        if not losing.empty:
+            st.warning("⚠️ أوراق ستفقد حقولاً عند التوليد: " + "، ".join(losing['الورقة']))
+        # HTML table to avoid pyarrow dependency
+        st.markdown(report_df.to_html(escape=True, index=False), unsafe_allow_html=True)
+
+# ========================= TEMPLATE REGISTRY =========================
+
+class CompiledTemplate:
+    """
+    A template parsed once: pristine copies of the parts a render edits (body,
+    headers, footers) and a few parsed packages ready for reuse
+    A reused package only gets fresh copies of those parts instead of a full
+    ZIP and XML parse; styles, numbering and media are never edited
+    """
+    POOL_SIZE = 4
+
+    def __init__(self, package):
+        self.package = package
+        document = Document(io.BytesIO(package))
+        self.text_parts = {
+            part.partname: copy.deepcopy(part.element) for part in iter_template_text_parts(document)
+        }
+        self._pool = [document]
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        A package holding the pristine template, for one render at a time
+        """
+        with self._lock:
+            document = self._pool.pop() if self._pool else None
+        if document is None:
+            return Document(io.BytesIO(self.package))
+        for part in iter_template_text_parts(document):
+            part._element = copy.deepcopy(self.text_parts[part.partname])
+        return document.part.document
+
+    def release(self, document):
+        """
+        Return a package once nothing uses it any more
+        """
+        with self._lock:
+            if len(self._pool) < self.POOL_SIZE:
+                self._pool.append(document)
+
+class CompiledTemplateCache:
+    """
+    Compiled templates keyed by template content hash, held in the shared object cache
+    """
+
+    def __init__(self, shared_cache):
+        self.shared_cache = shared_cache
+        self._owners = weakref.WeakKeyDictionary()  # document part -> CompiledTemplate
+
+    def get_copy(self, template_path):
+        """
+        Return a pristine, writable copy of the template at template_path
+        Pass it to release() when done so the next render can reuse it
+        """
+        key = ('template', get_file_content_hash(template_path))
+        # Sized by the whole package (media, headers, styles), not just document.xml
+        compiled = self.shared_cache.get(
+            key, lambda: CompiledTemplate(Path(template_path).read_bytes()), lambda template: len(template.package)
+        )
+        document = compiled.acquire()
+        self._owners[document.part] = compiled
+        return document
+
+    def release(self, document):
+        """
+        Hand a rendered document back once it has been saved or merged
+        """
+        compiled = self._owners.pop(document.part, None)
+        if compiled is not None:
+            compiled.release(document)
+
+@st.cache_resource
+def get_compiled_template_cache():
+    """
+    Compiled templates shared by all sessions of this server
+    """
+    return CompiledTemplateCache(get_shared_cache())
+
+def find_routing_column(df_columns, rule_column):
+    """
+    Find the Excel column named in a routing rule (ignoring surrounding spaces)
+    """
+    for col in df_columns:
+        if str(col).strip() == rule_column.strip():
+            return col
+    return None
+
+def route_templates(df, default_template_path):
+    """
+    Pick a template for every row using config.TEMPLATE_ROUTING_RULES
+    Rules are checked in order and the first match wins; rows matching no rule
+    (or rules whose template is missing) use default_template_path
+    Returns list of template paths aligned with df rows
+    """
+    routed = pd.Series(default_template_path, index=df.index, dtype=object)
+    if df.empty or not config.TEMPLATE_ROUTING_RULES:
+        return routed.tolist()
+    
+    unassigned = pd.Series(True, index=df.index)
+    for rule in config.TEMPLATE_ROUTING_RULES:
+        template_path = os.path.join(config.TEMPLATES_DIR, rule['template'])
+        source_col = find_routing_column(df.columns, rule['column'])
+        if source_col is None or not os.path.exists(template_path):
+            continue
+        
+        values = df[source_col].astype(str).str.strip()
+        matches = values.str.contains(rule['contains'].strip(), regex=False) & df[source_col].notna()
+        selected = unassigned & matches
+        routed[selected] = template_path
+        unassigned &= ~selected
+    
+    return routed.tolist()
+
+# ========================= ARABIC TEXT MATCHING =========================
+
+# Diacritics (harakat, tanween, shadda, sukun, dagger alef) and tatweel
+ARABIC_DIACRITICS_PATTERN = re.compile(r'[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED\u0640]')
+ARABIC_LETTER_VARIANTS = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ة': 'ه',
+    'ى': 'ي', 'ئ': 'ي',
+    'ؤ': 'و',
+    '_': ' ', '-': ' ', '/': ' ', '؟': ' ', '?': ' '
+})
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+def normalize_arabic(text):
+    """
+    Normalize Arabic text for matching: drop diacritics and tatweel, unify
+    hamza/alef forms, taa marbuta and alef maqsura, and collapse whitespace
+    e.g. "اســــم الــمــدرب" -> "اسم المدرب"
+    """
+    text = ARABIC_DIACRITICS_PATTERN.sub('', str(text))
+    text = text.translate(ARABIC_LETTER_VARIANTS).lower()
+    return WHITESPACE_PATTERN.sub(' ', text).strip()
+
+def normalize_arabic_series(series):
+    """
+    Vectorized normalize_arabic for a whole column (missing values become "")
+    """
+    text = series.astype(str).where(series.notna(), '')
+    text = text.str.replace(ARABIC_DIACRITICS_PATTERN, '', regex=True)
+    text = text.str.translate(ARABIC_LETTER_VARIANTS).str.lower()
+    return text.str.replace(WHITESPACE_PATTERN, ' ', regex=True).str.strip()
+
+def character_ngrams(text, n=3):
+    """
+    Character n-grams of normalized text, padded so word edges count
+    """
+    padded = f" {text} "
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+class ColumnMatcher:
+    """
+    Character n-gram index over Excel column names
+    Ranking only scores columns that share at least one n-gram with the query,
+    so wide sheets stay fast
+    """
+
+    def __init__(self, columns, n=3):
+        self.columns = list(columns)
+        self.n = n
+        self.normalized = [normalize_arabic(col) for col in self.columns]
+        self.gram_counts = []
+        self.index = {}  # n-gram -> list of column positions
+        for position, text in enumerate(self.normalized):
+            grams = character_ngrams(text, n)
+            self.gram_counts.append(len(grams))
+            for gram in grams:
+                self.index.setdefault(gram, []).append(position)
+
+    def rank(self, text, limit=3):
+        """
+        Rank columns by similarity to text (Dice coefficient over n-grams)
+        Returns list of (column, score) with score in [0, 1], best first
+        """
+        normalized = normalize_arabic(text)
+        grams = character_ngrams(normalized, self.n)
+        shared = {}
+        for gram in grams:
+            for position in self.index.get(gram, ()):
+                shared[position] = shared.get(position, 0) + 1
+        
+        scored = []
+        for position, common in shared.items():
+            if self.normalized[position] == normalized:
+                score = 1.0
+            else:
+                score = 2 * common / (len(grams) + self.gram_counts[position])
+            scored.append((score, -position))
+        scored.sort(reverse=True)
+        
+        return [(self.columns[-neg_position], round(score, 3)) for score, neg_position in scored[:limit]]
+
+@functools.lru_cache(maxsize=16)
+def get_column_matcher(columns):
+    """
+    Column matcher for a schema (columns must be a tuple)
+    """
+    return ColumnMatcher(columns)
+
+def get_confirmed_field_mapping(template_paths, df_columns):
+    """
+    Template field -> Excel column mappings confirmed in the comparison view
+    Merged over all given templates and limited to columns present in df_columns
+    """
+    confirmed = st.session_state.get('confirmed_field_mappings', {})
+    field_columns = {}
+    for path in template_paths:
+        try:
+            template_hash = get_file_content_hash(path)
+        except OSError:
+            continue
+        for field, column in confirmed.get(template_hash, {}).items():
+            if column in df_columns:
+                field_columns[field] = column
+    return field_columns
+
+# ========================= WORD TEMPLATE FUNCTIONS =========================
+
+PLACEHOLDER_PATTERN = re.compile(r'\{\{([^}]+)\}\}')
+
+# Document parts that can hold visible template text
+TEMPLATE_TEXT_PARTS = re.compile(r'^word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$')
+
+def iter_template_text_parts(doc):
+    """
+    Parsed XML parts of a document that hold text (body, headers, footers, notes)
+    """
+    for part in doc.part.package.iter_parts():
+        if TEMPLATE_TEXT_PARTS.match(str(part.partname).lstrip('/')) and hasattr(part, 'element'):
+            yield part
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def scan_template_fields(template_hash, _docx_path):
+    """
+    Scan every text part of a DOCX in one lxml pass per part
+    Cached by template content hash (_docx_path is only read on a cache miss)
+    Returns dict with 'placeholders' ({{}} names) and 'tags' (Content Control tags)
+    Covers body, tables, headers, footers, foot/endnotes and text boxes
+    """
+    placeholders = []
+    tags = []
+    seen_placeholders = set()
+    seen_tags = set()
+    
+    paragraph_tag = qn('w:p')
+    text_tag = qn('w:t')
+    sdt_tag_tag = qn('w:tag')
+    val_attr = qn('w:val')
+    
+    with zipfile.ZipFile(_docx_path) as docx_zip:
+        part_names = sorted(name for name in docx_zip.namelist() if TEMPLATE_TEXT_PARTS.match(name))
+        for part_name in part_names:
+            root = etree.fromstring(docx_zip.read(part_name))
+            
+            # Group text by its innermost paragraph so placeholders split across runs are found
+            paragraph_texts = {}
+            for element in root.iter(text_tag, sdt_tag_tag):
+                if element.tag == sdt_tag_tag:
+                    tag_value = (element.get(val_attr) or '').strip()
+                    if tag_value and tag_value not in seen_tags:
+                        seen_tags.add(tag_value)
+                        tags.append(tag_value)
+                elif element.text:
+                    paragraph = next(element.iterancestors(paragraph_tag), None)
+                    paragraph_texts.setdefault(paragraph, []).append(element.text)
+            
+            for texts in paragraph_texts.values():
+                for match in PLACEHOLDER_PATTERN.findall(''.join(texts)):
+                    if match not in seen_placeholders:
+                        seen_placeholders.add(match)
+                        placeholders.append(match)
+    
+    return {'placeholders': placeholders, 'tags': tags}
+
+def get_template_fields(docx_path):
+    """
+    Get placeholders and Content Control tags of a template (cached by content hash)
+    """
+    return scan_template_fields(get_file_content_hash(docx_path), docx_path)
+
+def extract_placeholders_from_word(docx_path):
+    """
+    Extract all placeholders from Word document
+    Returns list of placeholders found
+    """
+    try:
+        return list(get_template_fields(docx_path)['placeholders'])
+    except Exception as e:
+        st.error(f"خطأ في قراءة قالب Word: {str(e)}")
+        return []
+
+# Excel Column Name -> Content Control Tag
+# Later entries win over earlier ones for the same tag when both have data
+EXCEL_TO_TAG_MAPPING = {
+    'اسم الدورة بالعربي': 'اسم الدورة',
+    'الفئة المستهدفة': 'الفئة المستهدفة',
+    'طريقة الطرح': 'طريقة الطرح',
+    'اسم المدرب': 'اســــم الــمــدرب',
+    'مكان الانعقاد ': 'مقر التنفيذ',  # Fixed: exact match with trailing space
+    'مكان الانعقاد': 'مقر التنفيذ',   # Alternative without space
+    'الوقت': 'وقت الدورة/البرنامج',
+    'عدد الايام': 'مدتها',
+    'تاريخ بداية الدورة بالميلادي': 'تاريخ التنفيذ',
+    'تاريخ بداية الدورة بالهجري': 'تاريخ التنفيذ',
+    'تحتاج لمعمل؟': 'استخدام معمل الحاسب',  # Fixed: lab field mapping
+    
+    # Additional mappings for other available fields
+    'جهة التدريب': 'تنفيذ البرنامج/الدورة',
+    'اسم جهة التدريب': 'تنفيذ البرنامج/الدورة',
+}
+
+def find_source_column(excel_col, df_columns):
+    """
+    Find the Excel column that feeds a mapping entry
+    Returns the matching column name or None
+    """
+    # Try exact match first
+    if excel_col in df_columns:
+        return excel_col
+    
+    # Try similar column names (with space variations)
+    excel_col_clean = excel_col.strip().lower()
+    
+    # Special handling for location field with extensive matching
+    if 'مكان الانعقاد' in excel_col:
+        for col in df_columns:
+            # Check for exact match (with or without trailing space)
+            if col == 'مكان الانعقاد ' or col == 'مكان الانعقاد':
+                return col
+            # Also check if column contains the location keywords
+            elif 'مكان' in str(col) and 'انعقاد' in str(col):
+                return col
+    
+    # Special handling for lab field
+    elif 'تحتاج لمعمل' in excel_col or 'معمل' in excel_col:
+        for col in df_columns:
+            if col == 'تحتاج لمعمل؟' or 'تحتاج لمعمل' in str(col):
+                return col
+    else:
+        # Regular matching for other fields
+        for col in df_columns:
+            col_clean = str(col).strip().lower()
+            if excel_col_clean == col_clean or excel_col_clean in col_clean or col_clean in excel_col_clean:
+                return col
+    
+    return None
+
+@functools.lru_cache(maxsize=32)
+def resolve_mapping_plan(df_columns):
+    """
+    Resolve Excel columns to Content Control tags once per schema
+    df_columns must be a tuple; returns tuple of (source_column, tag_name) pairs
+    in mapping order, skipping entries with no matching column
+    """
+    plan = []
+    for excel_col, tag_name in EXCEL_TO_TAG_MAPPING.items():
+        source_col = find_source_column(excel_col, df_columns)
+        if source_col is not None:
+            plan.append((source_col, tag_name))
+    return tuple(plan)
+
+def clean_mapping_value(value, tag_name):
+    """
+    Convert a single cell value to the text written into the template
+    """
+    value = str(value) if pd.notna(value) else ""
+    
+    # Clean up the value
+    if value and value.lower() not in ['nan', 'none', 'nat']:
+        value = value.strip()
+    else:
+        value = ""
+    
+    # Add "يوم" after the duration unless it is already there
+    if value and tag_name == 'مدتها' and 'يوم' not in value:
+        value = f"{value} يوم"
+    
+    return value
+
+def clean_mapping_series(series, tag_name):
+    """
+    Vectorized version of clean_mapping_value for a whole column
+    """
+    present = series.notna()
+    if pd.api.types.is_datetime64_any_dtype(series):
+        # Same text as str(Timestamp) for naive timestamps
+        text = pd.Series(
+            np.datetime_as_string(series.to_numpy(dtype='datetime64[s]'), unit='s'),
+            index=series.index
+        ).str.replace('T', ' ', regex=False)
+    else:
+        text = series.astype(str)
+    
+    text = text.where(present, "")
+    text = text.where(~text.str.lower().isin(['nan', 'none', 'nat']), "").str.strip()
+    
+    if tag_name == 'مدتها':
+        needs_suffix = (text != "") & ~text.str.contains('يوم', regex=False)
+        text = text.where(~needs_suffix, text + " يوم")
+    
+    return text
+
+def build_mapping(row, df_columns, field_columns=None):
+    """
+    Build mapping between Excel columns and Word Content Control tags
+    Content Control Tags available:
+    - اسم البرنامج, اسم الدورة, الفئة المستهدفة, طريقة الطرح
+    - العدد المتوقع, وقت الدورة/البرنامج, تاريخ التنفيذ, مدتها
+    - اســــم الــمــدرب, الـــمـتـطــلــبــات, تنفيذ البرنامج/الدورة, مقر التنفيذ
+    field_columns: optional confirmed {template field: Excel column} that override the plan
+    """
+    mapping = {}
+    
+    for source_col, tag_name in resolve_mapping_plan(tuple(df_columns)):
+        value = clean_mapping_value(row[source_col], tag_name)
+        
+        # Map to Content Control tag name (only if we have data)
+        if value:
+            mapping[tag_name] = value
+    
+    for field, source_col in (field_columns or {}).items():
+        value = clean_mapping_value(row[source_col], field)
+        if value:
+            mapping[field] = value
+        else:
+            mapping.pop(field, None)
+    
+    return mapping
+
+def build_mappings_for_frame(df, field_columns=None):
+    """
+    Build the Content Control mapping for every row of df in one vectorized pass
+    field_columns: optional confirmed {template field: Excel column} that override the plan
+    Returns list of mapping dicts in row order (same output as build_mapping per row)
+    """
+    if df.empty:
+        return []
+    
+    # Clean each source column once, merging entries that feed the same tag
+    tag_values = {}
+    for source_col, tag_name in resolve_mapping_plan(tuple(df.columns)):
+        values = clean_mapping_series(df[source_col], tag_name)
+        if tag_name in tag_values:
+            values = values.where(values != "", tag_values[tag_name])
+        tag_values[tag_name] = values
+    
+    # Confirmed field mappings replace whatever the plan chose
+    for field, source_col in (field_columns or {}).items():
+        tag_values[field] = clean_mapping_series(df[source_col], field)
+    
+    if not tag_values:
+        return [{} for _ in range(len(df))]
+    
+    tag_names = list(tag_values.keys())
+    columns = [tag_values[tag_name].tolist() for tag_name in tag_names]
+    
+    return [
+        {tag_name: value for tag_name, value in zip(tag_names, row_values) if value}
+        for row_values in zip(*columns)
+    ]
+
+@functools.lru_cache(maxsize=64)
+def compile_mapping_pattern(mapping_keys):
+    """
+    Compile one regex matching {{key}} for every key in mapping_keys (a tuple)
+    Longer keys are tried first so overlapping names resolve to the longest one
+    """
+    alternatives = '|'.join(
+        re.escape(key) for key in sorted(mapping_keys, key=len, reverse=True)
+    )
+    return re.compile(r'\{\{\s*(' + alternatives + r')\s*\}\}')
+
+def substitute_placeholders_in_element(root, mapping, pattern):
+    """
+    Replace {{key}} placeholders inside one XML part, keeping run formatting
+    Text of each paragraph's runs is joined so placeholders split across runs
+    are found; replacements are written back into the original <w:t> nodes
+    Returns number of placeholders replaced
+    """
+    paragraph_tag = qn('w:p')
+    
+    # Group text nodes by their innermost paragraph in one pass
+    paragraph_nodes = {}
+    for text_node in root.iter(qn('w:t')):
+        paragraph = next(text_node.iterancestors(paragraph_tag), None)
+        paragraph_nodes.setdefault(paragraph, []).append(text_node)
+    
+    replacements_made = 0
+    for text_nodes in paragraph_nodes.values():
+        texts = [text_node.text or '' for text_node in text_nodes]
+        joined = ''.join(texts)
+        if '{{' not in joined:
+            continue
+        
+        matches = list(pattern.finditer(joined))
+        if not matches:
+            continue
+        
+        # Start offset of every node inside the joined paragraph text
+        node_starts = []
+        offset = 0
+        for text in texts:
+            node_starts.append(offset)
+            offset += len(text)
+        
+        # Work backwards so earlier offsets stay valid while editing
+        for match in reversed(matches):
+            value = mapping[match.group(1)]
+            start, end = match.span()
+            # Nodes holding the first and last character (empty nodes share the next node's start)
+            first = bisect.bisect_right(node_starts, start) - 1
+            last = bisect.bisect_right(node_starts, end - 1) - 1
+            
+            head = texts[first][:start - node_starts[first]]
+            tail = texts[last][end - node_starts[last]:]
+            if first == last:
+                texts[first] = head + value + tail
+            else:
+                texts[first] = head + value
+                for middle in range(first + 1, last):
+                    texts[middle] = ''
+                texts[last] = tail
+            replacements_made += 1
+        
+        for text_node, text in zip(text_nodes, texts):
+            if text_node.text != text and (text_node.text or text):
+                text_node.text = text
+                text_node.set('{http://www.w3.org/XML/1998/namespace}space', 'preserve')
+    
+    return replacements_made
+
+def substitute_placeholders(doc, mapping):
+    """
+    Replace {{key}} placeholders in a python-docx Document in one pass per part
+    Covers body and tables (document part) as well as headers and footers
+    Returns number of placeholders replaced
+    """
+    values = {key.strip(): str(value) for key, value in mapping.items() if key.strip() and value}
+    if not values:
+        return 0
+    pattern = compile_mapping_pattern(tuple(sorted(values)))
+    
+    replacements_made = 0
+    for part in iter_template_text_parts(doc):
+        replacements_made += substitute_placeholders_in_element(part.element, values, pattern)
+    return replacements_made
+
+def render_template_document(template_path, mapping):
+    """
+    Load template and fill its Content Controls and {{placeholders}} from mapping
+    Streamlit-free: problems are collected instead of shown
+    Returns dict with:
+    - document: filled python-docx Document (in memory) or None
+    - replacements: number of fields filled
+    - missing_tags: template fields with no value in mapping
+    - errors: list of error messages
+    """
+    result = {'document': None, 'replacements': 0, 'missing_tags': [], 'errors': []}
+    
+    # Start from a copy of the compiled template (parsed once per template content)
+    try:
+        doc = get_compiled_template_cache().get_copy(template_path)
+    except Exception as load_error:
+        result['errors'].append(f"خطأ في تحميل القالب: {str(load_error)}")
+        return result
+    
+    try:
+        template_fields = get_template_fields(template_path)
+    except Exception as scan_error:
+        template_fields = {'placeholders': [], 'tags': []}
+        result['errors'].append(f"خطأ في قراءة حقول القالب: {str(scan_error)}")
+    
+    result['missing_tags'] = [
+        field for field in template_fields['tags'] + template_fields['placeholders']
+        if not mapping.get(field)
+    ]
+    
+    # Method 1: Safe Content Controls processing (body only, avoids table objects)
+    try:
+        content_controls_found = []
+        for element in doc.element.body.iter(qn('w:sdt')):
+            try:
+                tag_element = element.find('.//' + qn('w:tag'))
+                if tag_element is not None:
+                    tag_value = tag_element.get(qn('w:val'))
+                    if tag_value:
+                        content_controls_found.append((element, tag_value))
+            except Exception:
+                # Skip problematic content controls
+                continue
+        
+        for element, tag_value in content_controls_found:
+            try:
+                data_value = mapping.get(tag_value.strip())
+                if not data_value:
+                    continue
+                
+                # Replace the control's text with the data only
+                text_elements = element.findall('.//' + qn('w:t'))
+                if text_elements:
+                    for text_elem in text_elements:
+                        text_elem.text = ""
+                    text_elements[0].text = data_value
+                    result['replacements'] += 1
+            except Exception:
+                continue
+    except Exception as processing_error:
+        result['errors'].append(f"خطأ في معالجة المستند: {str(processing_error)}")
+    
+    # Method 2: {{placeholder}} substitution across body, tables, headers and footers
+    try:
+        if template_fields['placeholders']:
+            result['replacements'] += substitute_placeholders(doc, mapping)
+    except Exception as substitution_error:
+        result['errors'].append(f"فشل في معالجة المستند: {str(substitution_error)}")
+    
+    result['document'] = doc
+    return result
+
+def render_docx(template_path, mapping):
+    """
+    Streamlit-free DOCX generation
+    Returns the render_template_document result with 'docx' bytes instead of 'document'
+    """
+    result = render_template_document(template_path, mapping)
+    doc = result.pop('document')
+    result['docx'] = None
+    
+    if doc is not None:
+        try:
+            doc_buffer = io.BytesIO()
+            doc.save(doc_buffer)
+            result['docx'] = doc_buffer.getvalue()
+        except Exception as save_error:
+            result['errors'].append(f"خطأ في حفظ المستند: {str(save_error)}")
+        finally:
+            get_compiled_template_cache().release(doc)
+    
+    return result
+
+def show_generation_messages(result):
+    """
+    Show the outcome of a single document generation in the UI
+    """
+    for error in result['errors']:
+        st.error(f"❌ {error}")
+    
+    # Show success message only if replacements were made
+    if result['replacements'] > 0:
+        st.success(f"✅ تم تحديث {result['replacements']} عنصر بنجاح")
+    else:
+        st.warning("⚠️ لم يتم العثور على عناصر للتحديث")
+
+def generate_docx_from_template(template_path, mapping, output_name):
+    """
+    Generate Word document from template and report the outcome in the UI
+    Returns BytesIO with the DOCX content or None
+    """
+    result = render_docx(template_path, mapping)
+    show_generation_messages(result)
+    
+    if result['docx'] is None:
+        return None
+    return io.BytesIO(result['docx'])
+
+def convert_docx_to_pdf(docx_buffer, output_name):
+    """
+    Convert DOCX to PDF using the configured backend (docx2pdf or LibreOffice)
+    """
+    if not PDF_AVAILABLE:
+        return None
+    
+    if PDF_BACKEND == 'soffice':
+        pdf_content = get_pdf_pool().convert_many([docx_buffer.getvalue()])[0]
+        if pdf_content is None:
+            st.warning("فشل في تحويل PDF عبر LibreOffice")
+        return pdf_content
+    
+    try:
+        # Create temporary files
+        with tempfile.NamedTemporaryFile(suffix='.docx', delete=False) as temp_docx:
+            temp_docx.write(docx_buffer.getvalue())
+            temp_docx_path = temp_docx.name
+        
+        temp_pdf_path = temp_docx_path.replace('.docx', '.pdf')
+        
+        # Convert to PDF
+        convert(temp_docx_path, temp_pdf_path)
+        
+        # Read PDF content
+        with open(temp_pdf_path, 'rb') as pdf_file:
+            pdf_content = pdf_file.read()
+        
+        # Cleanup
+        os.unlink(temp_docx_path)
+        os.unlink(temp_pdf_path)
+        
+        return pdf_content
+    except Exception as e:
+        st.warning(f"فشل في تحويل PDF: {str(e)}")
+        return None
+
+# ========================= PDF CONVERSION WORKER POOL =========================
+
+class SofficeWorker:
+    """
+    Headless LibreOffice worker with its own user profile
+    The profile stays warm between calls so only the first conversion pays the
+    profile setup cost; recycle() throws it away after a failure or too many jobs
+    """
+
+    def __init__(self, worker_id, soffice_path, base_dir):
+        self.worker_id = worker_id
+        self.soffice_path = soffice_path
+        self.profile_dir = os.path.join(base_dir, f"profile_{worker_id}")
+        self.jobs_done = 0
+
+    def convert_batch(self, docx_paths, output_dir, timeout):
+        """
+        Convert several DOCX files with a single soffice call
+        Raises subprocess.TimeoutExpired or subprocess.CalledProcessError on failure
+        """
+        command = [
+            self.soffice_path,
+            '--headless', '--norestore', '--nologo', '--nodefault', '--nolockcheck',
+            f"-env:UserInstallation={Path(self.profile_dir).as_uri()}",
+            '--convert-to', 'pdf',
+            '--outdir', output_dir,
+            *docx_paths
+        ]
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            start_new_session=(os.name != 'nt')
+        )
+        try:
+            _, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self._kill(process)
+            raise
+        
+        self.jobs_done += len(docx_paths)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command, stderr=stderr)
+
+    def recycle(self):
+        """
+        Drop the worker's profile so the next call starts from a clean one
+        """
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+        self.jobs_done = 0
+
+    @staticmethod
+    def _kill(process):
+        """
+        Kill soffice together with any helper processes it started
+        """
+        try:
+            if os.name != 'nt':
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except OSError:
+            pass
+        process.wait()
+
+class SofficePdfPool:
+    """
+    Pool of headless LibreOffice workers converting DOCX batches to PDF in parallel
+    """
+
+    def __init__(self, soffice_path, workers, batch_size, timeout, timeout_per_doc, max_jobs_per_worker):
+        self.batch_size = max(1, batch_size)
+        self.timeout = timeout
+        self.timeout_per_doc = timeout_per_doc
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.base_dir = tempfile.mkdtemp(prefix='soffice_pool_')
+        self._idle_workers = queue.Queue()
+        for worker_id in range(workers):
+            self._idle_workers.put(SofficeWorker(worker_id, soffice_path, self.base_dir))
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='soffice')
+        # Worker profiles live under base_dir; remove them when the server exits
+        atexit.register(self.shutdown)
+
+    def shutdown(self):
+        """
+        Stop the pool and delete the worker profiles and temporary files
+        """
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+
+    def convert_many(self, docx_documents):
+        """
+        Convert a list of DOCX bytes to PDF bytes
+        Returns list in the same order; failed documents are None
+        """
+        if not docx_documents:
+            return []
+        
+        # Spread the documents over all workers, but never exceed batch_size per call
+        per_batch = -(-len(docx_documents) // self.workers)
+        per_batch = max(1, min(self.batch_size, per_batch))
+        batches = [
+            docx_documents[start:start + per_batch]
+            for start in range(0, len(docx_documents), per_batch)
+        ]
+        
+        results = []
+        for batch_result in self._executor.map(self._convert_batch, batches):
+            results.extend(batch_result)
+        return results
+
+    def _convert_batch(self, docx_documents):
+        """
+        Run one batch on the next idle worker
+        """
+        worker = self._idle_workers.get()
+        try:
+            with tempfile.TemporaryDirectory(dir=self.base_dir) as work_dir:
+                input_paths = []
+                for position, docx_bytes in enumerate(docx_documents):
+                    input_path = os.path.join(work_dir, f"doc_{position:05d}.docx")
+                    with open(input_path, 'wb') as f:
+                        f.write(docx_bytes)
+                    input_paths.append(input_path)
+                
+                output_dir = os.path.join(work_dir, 'pdf')
+                os.makedirs(output_dir)
+                timeout = self.timeout + self.timeout_per_doc * len(input_paths)
+                try:
+                    worker.convert_batch(input_paths, output_dir, timeout)
+                except (subprocess.SubprocessError, OSError):
+                    # Hung or crashed soffice: start the next call from a fresh profile
+                    worker.recycle()
+                
+                results = []
+                for input_path in input_paths:
+                    pdf_path = os.path.join(output_dir, Path(input_path).stem + '.pdf')
+                    try:
+                        with open(pdf_path, 'rb') as pdf_file:
+                            results.append(pdf_file.read())
+                    except OSError:
+                        results.append(None)
+                return results
+        finally:
+            if worker.jobs_done >= self.max_jobs_per_worker:
+                worker.recycle()
+            self._idle_workers.put(worker)
+
+@st.cache_resource
+def get_pdf_pool():
+    """
+    Shared LibreOffice worker pool for all sessions of this server
+    """
+    return SofficePdfPool(
+        SOFFICE_PATH,
+        workers=config.PDF_WORKERS,
+        batch_size=config.PDF_BATCH_SIZE,
+        timeout=config.PDF_CONVERT_TIMEOUT,
+        timeout_per_doc=config.PDF_CONVERT_TIMEOUT_PER_DOC,
+        max_jobs_per_worker=config.PDF_WORKER_MAX_JOBS
+    )
+
+def convert_docx_batch_to_pdf(docx_documents):
+    """
+    Convert a list of DOCX bytes to PDF bytes (None for failures)
+    LibreOffice converts whole batches per call; docx2pdf converts one by one
+    """
+    if not PDF_AVAILABLE:
+        return [None] * len(docx_documents)
+    
+    if PDF_BACKEND == 'soffice':
+        return get_pdf_pool().convert_many(docx_documents)
+    
+    return [
+        convert_docx_to_pdf(io.BytesIO(docx_bytes), f"document_{position + 1}")
+        for position, docx_bytes in enumerate(docx_documents)
+    ]
+
+# ========================= GENERATED DOCUMENT CACHE =========================
+
+# Part of every cache key: bump whenever rendering changes the output for the
+# same template and row (substitution, numbering, stored summaries, PDF export),
+# so documents produced by older code are not served after a deploy
+DOCUMENT_RENDERER_VERSION = '4'
+
+@functools.lru_cache(maxsize=64)
+def _hash_file_contents(file_path, file_size, mtime_ns):
+    """
+    Hash file bytes (memoised on path, size and modification time)
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_file_content_hash(file_path):
+    """
+    Get SHA-256 of a file's content without re-reading unchanged files
+    """
+    file_stat = os.stat(file_path)
+    return _hash_file_contents(os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns)
+
+class GeneratedDocumentCache:
+    """
+    Disk-backed cache of generated DOCX/PDF files
+    Entries are keyed by hash(renderer version, template bytes, mapping) and evicted least recently used first
+    once the cache directory grows beyond max_bytes
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # file name -> size, oldest first
+        self._total_bytes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Rebuild LRU order from what previous runs left on disk
+        existing = []
+        for entry in os.scandir(cache_dir):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                entry_stat = entry.stat()
+                existing.append((entry_stat.st_mtime, entry.name, entry_stat.st_size))
+        for _, name, size in sorted(existing):
+            self._entries[name] = size
+            self._total_bytes += size
+        self._evict()
+
+    @staticmethod
+    def make_key(template_hash, mapping):
+        """
+        Build cache key from the renderer version, template content hash and the row mapping
+        """
+        payload = json.dumps(mapping, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(
+            f"{DOCUMENT_RENDERER_VERSION}\n{template_hash}\n{payload}".encode('utf-8')
+        ).hexdigest()
+
+    def get(self, key, kind):
+        """
+        Return cached bytes for key ('docx' or 'pdf'), or None on a miss
+        """
+        name = f"{key}.{kind}"
+        path = os.path.join(self.cache_dir, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # Keep LRU order across restarts
+        except OSError:
+            # Missing or evicted by another process
+            with self._lock:
+                size = self._entries.pop(name, None)
+                if size is not None:
+                    self._total_bytes -= size
+            return None
+
+        with self._lock:
+            if name not in self._entries:
+                self._entries[name] = len(data)
+                self._total_bytes += len(data)
+            self._entries.move_to_end(name)
+        return data
+
+    def put(self, key, kind, data):
+        """
+        Store bytes for key, evicting old entries when over the size cap
+        """
+        name = f"{key}.{kind}"
+        path = os.path.join(self.cache_dir, name)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            previous = self._entries.pop(name, None)
+            if previous is not None:
+                self._total_bytes -= previous
+            self._entries[name] = len(data)
+            self._total_bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        """
+        Remove least recently used files until the cache fits in max_bytes
+        """
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.unlink(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+
+@st.cache_resource
+def get_document_cache():
+    """
+    Shared generated-document cache for all sessions of this server
+    """
+    return GeneratedDocumentCache(
+        config.GENERATED_DOCS_CACHE_DIR,
+        config.GENERATED_DOCS_CACHE_MAX_MB * 1024 * 1024
+    )
+
+def generate_docx_cached(template_path, mapping, output_name):
+    """
+    Streamlit-free DOCX generation that renders the template only on a cache miss
+    Returns the render_docx result plus 'cache_key' and 'cached'; 'docx' is None on failure
+    """
+    cache = get_document_cache()
+    cache_key = cache.make_key(get_file_content_hash(template_path), mapping)
+
+    docx_bytes = cache.get(cache_key, 'docx')
+    summary = cache.get(cache_key, 'json')
+    if docx_bytes is not None and summary is not None:
+        result = json.loads(summary)
+        result.update({'docx': docx_bytes, 'cache_key': cache_key, 'cached': True})
+        return result
+
+    result = render_docx(template_path, mapping)
+    result.update({'cache_key': cache_key, 'cached': False})
+    if result['docx'] is not None:
+        cache.put(cache_key, 'docx', result['docx'])
+        cache.put(cache_key, 'json', json.dumps(
+            {key: result[key] for key in ('replacements', 'missing_tags', 'errors')},
+            ensure_ascii=False
+        ).encode('utf-8'))
+
+    return result
+
+def convert_docx_to_pdf_cached(cache_key, docx_bytes, output_name):
+    """
+    Get PDF bytes for a cached DOCX, converting only on a cache miss
+    """
+    cache = get_document_cache()
+    pdf_content = cache.get(cache_key, 'pdf')
+    if pdf_content is None:
+        pdf_content = convert_docx_to_pdf(io.BytesIO(docx_bytes), output_name)
+        if pdf_content:
+            cache.put(cache_key, 'pdf', pdf_content)
+    return pdf_content
+
+def convert_docx_batch_to_pdf_cached(documents):
+    """
+    Get PDF bytes for a list of (cache_key, docx_bytes) pairs
+    Cache misses are converted together in one batch call
+    """
+    cache = get_document_cache()
+    results = [cache.get(cache_key, 'pdf') for cache_key, _ in documents]
+    
+    missing = [position for position, pdf_content in enumerate(results) if pdf_content is None]
+    if missing and PDF_AVAILABLE:
+        converted = convert_docx_batch_to_pdf([documents[position][1] for position in missing])
+        for position, pdf_content in zip(missing, converted):
+            if pdf_content:
+                cache.put(documents[position][0], 'pdf', pdf_content)
+                results[position] = pdf_content
+    
+    return results
+
+# ========================= CERTIFICATE NUMBERS =========================
+
+CERTIFICATE_FIELD = 'رقم_الشهادة'
+
+def _open_certificate_db():
+    """
+    Open the certificate SQLite database (autocommit mode, explicit transactions)
+    """
+    db_dir = os.path.dirname(config.CERTIFICATE_DB_PATH)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(config.CERTIFICATE_DB_PATH, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS certificate_sequences (
+            name TEXT PRIMARY KEY,
+            next_number INTEGER NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS certificate_blocks (
+            block_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sequence TEXT NOT NULL,
+            job_id TEXT NOT NULL,
+            first_number INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            used_count INTEGER,
+            allocated_at TEXT NOT NULL,
+            completed_at TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_blocks_sequence ON certificate_blocks (sequence, first_number)")
+    return conn
+
+def current_certificate_sequence():
+    """
+    Name of the sequence numbers are drawn from (one per year)
+    """
+    return str(datetime.now().year)
+
+def format_certificate_number(sequence, number):
+    """
+    Format a certificate number for the template
+    """
+    return config.CERTIFICATE_NUMBER_FORMAT.format(year=sequence, number=number)
+
+def reserve_certificate_block(count, job_id, sequence=None):
+    """
+    Reserve count consecutive certificate numbers in one transaction
+    Safe across sessions and worker processes (SQLite write lock); the block is
+    logged so unused numbers can be audited later
+    Returns dict with block_id, sequence, first_number and count
+    """
+    sequence = sequence or current_certificate_sequence()
+    conn = _open_certificate_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT next_number FROM certificate_sequences WHERE name = ?", (sequence,)
+            ).fetchone()
+            first_number = row[0] if row else config.CERTIFICATE_FIRST_NUMBER
+            conn.execute(
+                "INSERT INTO certificate_sequences (name, next_number) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET next_number = excluded.next_number",
+                (sequence, first_number + count)
+            )
+            cursor = conn.execute(
+                "INSERT INTO certificate_blocks (sequence, job_id, first_number, count, allocated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (sequence, job_id, first_number, count, datetime.now().isoformat(timespec='seconds'))
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+    
+    return {'block_id': cursor.lastrowid, 'sequence': sequence, 'first_number': first_number, 'count': count}
+
+def complete_certificate_block(block_id, used_count):
+    """
+    Record how many numbers of a reserved block were actually issued
+    """
+    conn = _open_certificate_db()
+    try:
+        conn.execute(
+            "UPDATE certificate_blocks SET used_count = ?, completed_at = ? WHERE block_id = ?",
+            (used_count, datetime.now().isoformat(timespec='seconds'), block_id)
+        )
+    finally:
+        conn.close()
+
+def audit_certificate_numbers(sequence=None):
+    """
+    Check a sequence for overlapping blocks, numbers never reserved, and reserved numbers never issued
+    Returns dict with 'blocks' DataFrame, 'overlaps' and 'gaps' lists of (first, last)
+    number ranges, and 'unused' list of (block_id, numbers reserved but not issued)
+    """
+    sequence = sequence or current_certificate_sequence()
+    conn = _open_certificate_db()
+    try:
+        blocks = pd.read_sql_query(
+            "SELECT block_id, job_id, first_number, count, used_count, allocated_at, completed_at "
+            "FROM certificate_blocks WHERE sequence = ? ORDER BY first_number",
+            conn, params=(sequence,)
+        )
+    finally:
+        conn.close()
+    
+    overlaps, gaps, unused = [], [], []
+    expected_next = config.CERTIFICATE_FIRST_NUMBER
+    for block in blocks.itertuples(index=False):
+        last_number = block.first_number + block.count - 1
+        if block.first_number < expected_next:
+            overlaps.append((block.first_number, min(last_number, expected_next - 1)))
+        elif block.first_number > expected_next:
+            gaps.append((expected_next, block.first_number - 1))
+        if pd.notna(block.used_count) and block.used_count < block.count:
+            unused.append((block.block_id, block.count - int(block.used_count)))
+        expected_next = max(expected_next, last_number + 1)
+    
+    return {'blocks': blocks, 'overlaps': overlaps, 'gaps': gaps, 'unused': unused}
+
+def template_uses_certificate_numbers(template_path):
+    """
+    Whether the template has a certificate number placeholder or Content Control
+    """
+    template_fields = get_template_fields(template_path)
+    return CERTIFICATE_FIELD in template_fields['placeholders'] or CERTIFICATE_FIELD in template_fields['tags']
+
+def assign_certificate_numbers(mappings, template_paths, job_id):
+    """
+    Give every mapping whose template needs one a unique certificate number
+    All numbers for the job come from a single reserved block
+    Returns the reserved block dict, or None when no template needs numbers
+    """
+    needs_number = {
+        path: template_uses_certificate_numbers(path) for path in set(template_paths)
+    }
+    positions = [position for position, path in enumerate(template_paths) if needs_number[path]]
+    if not positions:
+        return None
+    
+    block = reserve_certificate_block(len(positions), job_id)
+    for offset, position in enumerate(positions):
+        mappings[position][CERTIFICATE_FIELD] = format_certificate_number(
+            block['sequence'], block['first_number'] + offset
+        )
+    return block
+
+# ========================= BULK GENERATION PIPELINE =========================
+
+_PIPELINE_DONE = object()
+
+def _pdf_conversion_stage(pdf_queue, write_queue, cache, pool, batch_size, errors):
+    """
+    Consumer: take rendered DOCX files from pdf_queue in batches and convert them
+    """
+    finished = False
+    while not finished:
+        item = pdf_queue.get()
+        if item is _PIPELINE_DONE:
+            break
+        batch = [item]
+        # Grab whatever else is already waiting, up to one full batch
+        while len(batch) < batch_size:
+            try:
+                item = pdf_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _PIPELINE_DONE:
+                finished = True
+                break
+            batch.append(item)
+        
+        try:
+            pdf_contents = [cache.get(cache_key, 'pdf') for _, cache_key, _ in batch]
+            missing = [position for position, pdf_content in enumerate(pdf_contents) if pdf_content is None]
+            if missing:
+                converted = pool.convert_many([batch[position][2] for position in missing])
+                for position, pdf_content in zip(missing, converted):
+                    if pdf_content:
+                        cache.put(batch[position][1], 'pdf', pdf_content)
+                        pdf_contents[position] = pdf_content
+            
+            for (output_name, _, _), pdf_content in zip(batch, pdf_contents):
+                if pdf_content:
+                    write_queue.put((f"{output_name}.pdf", pdf_content))
+                else:
+                    errors.append(f"{output_name}.pdf: فشل التحويل")
+        except Exception as e:
+            errors.extend(f"{output_name}.pdf: {str(e)}" for output_name, _, _ in batch)
+
+def _zip_writer_stage(write_queue, zip_file, written, errors):
+    """
+    Consumer: the only thread writing into the ZIP archive
+    """
+    while True:
+        item = write_queue.get()
+        if item is _PIPELINE_DONE:
+            break
+        arcname, data = item
+        try:
+            zip_file.writestr(arcname, data)
+            written.append(arcname)
+        except Exception as e:
+            errors.append(f"{arcname}: {str(e)}")
+
+def run_bulk_generation_pipeline(rendered_documents, zip_file, with_pdf):
+    """
+    Write rendered documents (and their PDFs) into zip_file with overlapping stages
+    rendered_documents yields (output_name, cache_key, docx_bytes) and is consumed
+    on the calling thread, so rendering keeps its Streamlit context. Rendered files
+    feed a bounded queue read by the PDF workers, and one writer thread fills the ZIP.
+    The bounded queues make a fast stage wait for a slow one instead of piling up memory.
+    Returns dict with written file names and error messages
+    """
+    written = []
+    errors = []
+    write_queue = queue.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+    writer = threading.Thread(
+        target=_zip_writer_stage, args=(write_queue, zip_file, written, errors), daemon=True
+    )
+    writer.start()
+    
+    # Overlap conversion only with LibreOffice; docx2pdf drives Word over COM on this thread
+    overlap_pdf = with_pdf and PDF_BACKEND == 'soffice'
+    pdf_queue = queue.Queue(maxsize=config.PIPELINE_QUEUE_SIZE)
+    converters = []
+    if overlap_pdf:
+        cache = get_document_cache()
+        pool = get_pdf_pool()
+        for _ in range(pool.workers):
+            converter = threading.Thread(
+                target=_pdf_conversion_stage,
+                args=(pdf_queue, write_queue, cache, pool, pool.batch_size, errors),
+                daemon=True
+            )
+            converter.start()
+            converters.append(converter)
+    
+    sequential_pdf_jobs = []
+    try:
+        for output_name, cache_key, docx_bytes in rendered_documents:
+            write_queue.put((f"{output_name}.docx", docx_bytes))
+            if overlap_pdf:
+                pdf_queue.put((output_name, cache_key, docx_bytes))
+            elif with_pdf:
+                sequential_pdf_jobs.append((output_name, cache_key, docx_bytes))
+    finally:
+        for _ in converters:
+            pdf_queue.put(_PIPELINE_DONE)
+        for converter in converters:
+            converter.join()
+        
+        if sequential_pdf_jobs:
+            pdf_contents = convert_docx_batch_to_pdf_cached(
+                [(cache_key, docx_bytes) for _, cache_key, docx_bytes in sequential_pdf_jobs]
+            )
+            for (output_name, _, _), pdf_content in zip(sequential_pdf_jobs, pdf_contents):
+                if pdf_content:
+                    write_queue.put((f"{output_name}.pdf", pdf_content))
+        
+        write_queue.put(_PIPELINE_DONE)
+        writer.join()
+    
+    return {'written': written, 'errors': errors}
+
+# ========================= MERGED PRINT OUTPUT =========================
+
+def _page_break_paragraph():
+    """
+    Build <w:p><w:r><w:br w:type="page"/></w:r></w:p>
+    """
+    paragraph = OxmlElement('w:p')
+    run = OxmlElement('w:r')
+    page_break = OxmlElement('w:br')
+    page_break.set(qn('w:type'), 'page')
+    run.append(page_break)
+    paragraph.append(run)
+    return paragraph
+
+def build_merged_document(documents):
+    """
+    Merge rendered documents into one, each starting on a new page
+    documents is an iterable of in-memory python-docx Documents rendered from the
+    same template; it is consumed in one pass and each body is moved (not copied)
+    into the first document. Returns the merged Document or None if empty
+    """
+    merged = None
+    merged_body = None
+    final_section = None
+    
+    for doc in documents:
+        if doc is None:
+            continue
+        
+        if merged is None:
+            merged = doc
+            merged_body = merged.element.body
+            final_section = merged_body.find(qn('w:sectPr'))
+            continue
+        
+        # Content control ids must stay unique; Word assigns new ones when missing
+        for sdt_id in doc.element.body.iter(qn('w:id')):
+            if sdt_id.getparent().tag == qn('w:sdtPr'):
+                sdt_id.getparent().remove(sdt_id)
+        
+        elements = [
+            element for element in doc.element.body.iterchildren()
+            if element.tag != qn('w:sectPr')
+        ]
+        elements.insert(0, _page_break_paragraph())
+        for element in elements:
+            if final_section is not None:
+                final_section.addprevious(element)
+            else:
+                merged_body.append(element)
+    
+    return merged
+
+def generate_merged_output(template_path, mappings, with_pdf, on_progress=None):
+    """
+    Render every mapping into one print-ready DOCX (and one PDF)
+    The result is cached as a whole, keyed by the template and all mappings
+    on_progress(done, total) is called after each rendered row
+    Returns (docx_bytes, pdf_bytes, row_results); bytes may be None and each
+    row result holds 'replacements', 'missing_tags' and 'errors'
+    """
+    cache = get_document_cache()
+    cache_key = cache.make_key(get_file_content_hash(template_path), {'merged': mappings})
+    
+    docx_bytes = cache.get(cache_key, 'docx')
+    summary = cache.get(cache_key, 'json')
+    if docx_bytes is not None and summary is not None:
+        row_results = json.loads(summary)
+    else:
+        row_results = []
+        template_cache = get_compiled_template_cache()
+        
+        def rendered_documents():
+            first = True
+            for mapping in mappings:
+                result = render_template_document(template_path, mapping)
+                document = result.pop('document')
+                row_results.append(result)
+                if on_progress:
+                    on_progress(len(row_results), len(mappings))
+                yield document
+                # The merge keeps the first document; later ones have had their body moved out
+                if document is not None:
+                    if not first:
+                        template_cache.release(document)
+                    first = False
+        
+        merged = build_merged_document(rendered_documents())
+        if merged is None:
+            return None, None, row_results
+        docx_buffer = io.BytesIO()
+        try:
+            merged.save(docx_buffer)
+        finally:
+            template_cache.release(merged)
+        docx_bytes = docx_buffer.getvalue()
+        cache.put(cache_key, 'docx', docx_bytes)
+        cache.put(cache_key, 'json', json.dumps(row_results, ensure_ascii=False).encode('utf-8'))
+    
+    pdf_bytes = None
+    if with_pdf:
+        # One conversion for the whole batch instead of one per form
+        pdf_bytes = convert_docx_batch_to_pdf_cached([(cache_key, docx_bytes)])[0]
+    
+    return docx_bytes, pdf_bytes, row_results
+
+# ========================= ENHANCED DASHBOARD FUNCTIONS =========================
+
+# Keywords of the "حالة الاعتماد" values in your Excel (handle different spellings)
+# Checked in order, the first matching status wins
+APPROVAL_STATUS_KEYWORDS = [
+    ('confirmed', ['مؤكد', 'موكد']),
+    ('postponed', ['تاجيل', 'تأجيل', 'مؤجل']),
+    ('in_progress', ['تحت الاجراء', 'اجراء', 'إجراء']),
+    ('cancelled', ['ملغ', 'الغاء', 'إلغاء'])
+]
+
+def get_status_from_approval_column(status_text):
+    """
+    Determine course status from "حالة الاعتماد" column values
+    """
+    if pd.isna(status_text):
+        return 'unknown'
+    
+    status_text = str(status_text).strip().lower()
+    
+    for status, keywords in APPROVAL_STATUS_KEYWORDS:
+        if any(keyword in status_text for keyword in keywords):
+            return status
+    return 'unknown'
+
+def classify_approval_status(series):
+    """
+    Vectorized get_status_from_approval_column for a whole "حالة الاعتماد" column
+    """
+    text = series.astype(str).str.strip().str.lower().where(series.notna(), '')
+    conditions = [
+        text.str.contains('|'.join(re.escape(keyword) for keyword in keywords), regex=True).to_numpy(dtype=bool)
+        for _, keywords in APPROVAL_STATUS_KEYWORDS
+    ]
+    statuses = [status for status, _ in APPROVAL_STATUS_KEYWORDS]
+    return pd.Series(np.select(conditions, statuses, default='unknown'), index=series.index)
+
+def get_delivery_method_from_notes(notes_text):
+    """
+    Determine delivery method from "ملاحظات" column
+    Only "عن بعد" is considered remote, everything else is on-site
+    """
+    if pd.isna(notes_text):
+        return 'in_person'
+    
+    notes_text = str(notes_text).lower().strip()
+    
+    if 'عن بعد' in notes_text or 'عن بُعد' in notes_text:
+        return 'remote'
+    else:
+        return 'in_person'
+
+def parse_date_flexible(date_str):
+    """
+    Parse a course date the way the dashboard always has (several formats, then day-first)
+    """
+    if pd.isna(date_str):
+        return pd.NaT
+    
+    date_str = str(date_str).strip()
+    # "8/4/2025م" (Gregorian marker) and "7 / 11 / 1446" (spaced separators)
+    date_str = re.sub(r'\s*([/-])\s*', r'\1', date_str.removesuffix('م').strip())
+    
+    # Try different date formats
+    for fmt in ['%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y', '%m/%d/%Y']:
+        try:
+            return pd.to_datetime(date_str, format=fmt)
+        except:
+            continue
+    
+    # Fallback to pandas auto-parsing
+    try:
+        return pd.to_datetime(date_str, dayfirst=True)
+    except:
+        return pd.NaT
+
+def calculate_comprehensive_stats(df, selected_period='all', selected_year=None, selected_month=None, selected_date=None):
+    """
+    Calculate comprehensive statistics using actual column names from your Excel
+    """
+    stats = {
+        'total_courses': 0,
+        'confirmed_courses': 0,
+        'postponed_courses': 0,
+        'in_progress_courses': 0,
+        'cancelled_courses': 0,
+        'unknown_courses': 0,
+        'remote_courses': 0,
+        'in_person_courses': 0,
+        'hybrid_courses': 0,
+        'total_participants': 0,
+        'total_training_hours': 0,
+        'total_training_days': 0,
+        'period_label': ''
+    }
+    
+    if df.empty:
+        return stats
+    
+    # Find relevant columns - exact matching
+    start_date_col = None
+    approval_status_col = None
+    notes_col = None
+    participants_col = None
+    hours_col = None
+    days_col = None
+    
+    for col in df.columns:
+        col_str = str(col).strip()  # Remove trailing spaces
+        if col_str == 'تاريخ بداية الدورة بالميلادي':
+            start_date_col = col
+        elif col_str == 'حالة الاعتماد':
+            approval_status_col = col
+        elif col_str == 'ملاحظات':
+            notes_col = col
+        elif 'عدد' in col_str and ('متدرب' in col_str or 'مشارك' in col_str):
+            participants_col = col
+        elif 'ساعة' in col_str or 'ساعات' in col_str:
+            hours_col = col
+        elif col_str == 'عدد الايام':
+            days_col = col
+    
+    # Filter data based on selected period
+    filtered_df = df.copy()
+    
+    if start_date_col and selected_period != 'all':
+        # Convert dates - handle multiple formats
         filtered_df['parsed_date'] = filtered_df[start_date_col].apply(parse_date_flexible)
         
         if selected_period == 'year' and selected_year:
@@ -1170,12 +3777,38 @@ def calculate_monthly_stats(df):
         'total_training_days': stats['total_training_days']
     }
 
-def build_enhanced_dashboard(df):
+def build_enhanced_dashboard(df, handle=None):
     """
     Build the enhanced dashboard that properly reads "حالة الاعتماد" data
+    With an analytics backend configured, statistics are computed as SQL
+    over the stored history instead of over df
     """
     st.header("📊 لوحة متابعة الدورات التدريبيه")
     
+    use_store = False
+    store_scope = None
+    if get_analytics_backend() and handle and handle.get('workbook_hash'):
+        try:
+            with st.spinner("جاري تحديث قاعدة البيانات التحليلية..."):
+                ingest_workbook(handle['excel_path'], handle['workbook_hash'], handle.get('source_name'))
+            use_store = True
+        except Exception as e:
+            st.warning(f"⚠️ تعذر استخدام قاعدة البيانات التحليلية، سيتم الحساب من البيانات المحملة: {str(e)}")
+    
+    if use_store:
+        data_scope = st.radio(
+            "نطاق البيانات",
+            ['sheet', 'history'],
+            format_func=lambda x: {
+                'sheet': f"الشهر المحدد ({handle['sheet']})",
+                'history': 'كامل السجل المخزن (آخر نسخة من كل ملف)'
+            }[x],
+            horizontal=True
+        )
+        store_scope = {'drop_duplicates': handle.get('drop_duplicates', False)}
+        if data_scope == 'sheet':
+            store_scope.update(workbook_hash=handle['workbook_hash'], sheet=handle['sheet'])
+    
     # Period selection controls
     st.subheader("🗓️ اختيار الفترة الزمنية")
     
@@ -1200,7 +3833,11 @@ def build_enhanced_dashboard(df):
     if period_type in ['year', 'month']:
         with col2:
             # Get available years from data
-            if not df.empty and 'تاريخ بداية الدورة بالميلادي' in df.columns:
+            if use_store:
+                available_years = [int(year) for year in query_course_values(store_scope, "substr(start_date, 1, 4)")]
+                if available_years:
+                    selected_year = st.selectbox("السنة", available_years, index=len(available_years)-1)
+            elif not df.empty and 'تاريخ بداية الدورة بالميلادي' in df.columns:
                 df_temp = df.copy()
                 df_temp['parsed_date'] = df_temp['تاريخ بداية الدورة بالميلادي'].apply(
                     lambda x: pd.to_datetime(str(x), errors='coerce', dayfirst=True) if pd.notna(x) else pd.NaT
@@ -1239,7 +3876,12 @@ def build_enhanced_dashboard(df):
             break
     
     selected_audience = 'الكل'
-    if audience_col and not df.empty:
+    if use_store:
+        audience_options = ['الكل'] + query_course_values(store_scope, "audience")
+        selected_audience = st.selectbox("اختر الفئة المستهدفة", audience_options)
+        if selected_audience != 'الكل':
+            st.info(f"📋 تم تطبيق الفلتر: {selected_audience}")
+    elif audience_col and not df.empty:
         audience_options = ['الكل'] + sorted([str(x) for x in df[audience_col].dropna().unique()])
         selected_audience = st.selectbox("اختر الفئة المستهدفة", audience_options)
         
@@ -1249,9 +3891,15 @@ def build_enhanced_dashboard(df):
             st.info(f"📋 تم تطبيق الفلتر: {selected_audience} ({len(df)} دورة)")
     
     # Calculate comprehensive statistics
-    stats = calculate_comprehensive_stats(
-        df, period_type, selected_year, selected_month, selected_date
-    )
+    if use_store:
+        stats = query_comprehensive_stats(
+            store_scope, period_type, selected_year, selected_month, selected_date,
+            None if selected_audience == 'الكل' else selected_audience
+        )
+    else:
+        stats = calculate_comprehensive_stats(
+            df, period_type, selected_year, selected_month, selected_date
+        )
     
     # Display period label
     if stats['period_label']:
@@ -1309,16 +3957,691 @@ def build_enhanced_dashboard(df):
             percentage = "-"
         summary_data['النسبة المئوية'].append(percentage)
     
-    summary_df = pd.DataFrame(summary_data)
+    summary_df = pd.DataFrame(summary_data)
+    
+    # Display with styling using HTML table to avoid pyarrow dependency
+    st.markdown(summary_df.to_html(escape=False, index=False), unsafe_allow_html=True)
+
+# ========================= ANALYTICS STORE =========================
+
+def get_analytics_backend():
+    """
+    Configured SQL backend ('sqlite' or 'duckdb'), or None for in-memory pandas
+    """
+    if config.ANALYTICS_BACKEND == 'duckdb' and DUCKDB_AVAILABLE:
+        return 'duckdb'
+    if config.ANALYTICS_BACKEND in ('sqlite', 'duckdb'):
+        return 'sqlite'
+    return None
+
+def store_table_columns(conn, backend, table):
+    """
+    Column names of a store table; empty when the table does not exist yet
+    """
+    if backend == 'duckdb':
+        # DuckDB's PRAGMA table_info raises on a missing table
+        query = "SELECT column_name FROM information_schema.columns WHERE table_name = ?"
+    else:
+        query = "SELECT name FROM pragma_table_info(?)"
+    return [row[0] for row in conn.execute(query, [table]).fetchall()]
+
+def _open_course_store():
+    """
+    Open the analytics database and create the course tables and indexes
+    """
+    backend = get_analytics_backend()
+    db_dir = os.path.dirname(config.ANALYTICS_DB_PATH)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+    
+    if backend == 'duckdb':
+        conn = duckdb.connect(f"{config.ANALYTICS_DB_PATH}.duckdb")
+    else:
+        conn = sqlite3.connect(f"{config.ANALYTICS_DB_PATH}.sqlite3", timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+    
+    # Stores created before row hashes or source names only hold derived data: rebuild them
+    course_columns = store_table_columns(conn, backend, 'courses')
+    workbook_columns = store_table_columns(conn, backend, 'ingested_workbooks')
+    if (course_columns and 'row_hash' not in course_columns) or (workbook_columns and 'source' not in workbook_columns):
+        for table in ('courses', 'ingested_workbooks', 'ingested_sheets'):
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+    
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ingested_workbooks (
+            workbook_hash TEXT PRIMARY KEY,
+            source TEXT NOT NULL,
+            ingested_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ingested_sheets (
+            source TEXT NOT NULL,
+            sheet TEXT NOT NULL,
+            sheet_hash TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS courses (
+            workbook_hash TEXT NOT NULL,
+            sheet TEXT NOT NULL,
+            row_number INTEGER NOT NULL,
+            start_date TEXT,
+            audience TEXT,
+            status TEXT NOT NULL,
+            delivery TEXT,
+            trainer TEXT,
+            days DOUBLE PRECISION,
+            participants DOUBLE PRECISION,
+            hours DOUBLE PRECISION,
+            duplicate INTEGER NOT NULL,
+            row_hash BIGINT NOT NULL
+        )
+    """)
+    for name, table, columns in (
+        ('idx_courses_scope', 'courses', 'workbook_hash, sheet'),
+        ('idx_courses_start_date', 'courses', 'start_date'),
+        ('idx_courses_audience', 'courses', 'audience'),
+        ('idx_courses_status', 'courses', 'status'),
+        ('idx_courses_trainer', 'courses', 'trainer'),
+        ('idx_ingested_sheets_source', 'ingested_sheets', 'source')
+    ):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+    return conn
+
+def build_course_records(df, workbook_hash, sheet, duplicate_rows):
+    """
+    Normalized course rows for the analytics store, classified the same way
+    calculate_comprehensive_stats classifies them
+    """
+    records = pd.DataFrame(index=df.index)
+    records['workbook_hash'] = workbook_hash
+    records['sheet'] = sheet
+    records['row_number'] = df.index.to_numpy() + 1
+    
+    columns = {str(col).strip(): col for col in df.columns}
+    
+    # Same date interpretation as the in-memory dashboard (parsed once, at ingest)
+    start_col = columns.get('تاريخ بداية الدورة بالميلادي')
+    if start_col is not None:
+        start_dates = pd.to_datetime(df[start_col].map(parse_date_flexible), errors='coerce')
+        iso_dates = np.datetime_as_string(start_dates.to_numpy(dtype='datetime64[D]'), unit='D')
+        records['start_date'] = pd.Series(iso_dates, index=df.index).where(start_dates.notna())
+    else:
+        records['start_date'] = None
+    
+    audience_col = find_column(df.columns, ['الفئة المستهدفة'])
+    records['audience'] = df[audience_col].astype(str).where(df[audience_col].notna()) if audience_col is not None else None
+    
+    status_col = columns.get('حالة الاعتماد')
+    records['status'] = classify_approval_status(df[status_col]) if status_col is not None else 'unknown'
+    
+    notes_col = columns.get('ملاحظات')
+    if notes_col is not None:
+        notes = df[notes_col].astype(str).str.lower().str.strip().where(df[notes_col].notna(), '')
+        remote = notes.str.contains('عن بعد', regex=False) | notes.str.contains('عن بُعد', regex=False)
+        records['delivery'] = np.where(remote, 'remote', 'in_person')
+    else:
+        records['delivery'] = None
+    
+    trainer_col = find_column(df.columns, *COURSE_KEY_COLUMNS['trainer'])
+    records['trainer'] = df[trainer_col].astype(str).str.strip().where(~is_blank(df[trainer_col])) if trainer_col is not None else None
+    
+    days_col = columns.get('عدد الايام')
+    participants_col = next((col for name, col in columns.items() if 'عدد' in name and ('متدرب' in name or 'مشارك' in name)), None)
+    hours_col = next((col for name, col in columns.items() if 'ساعة' in name or 'ساعات' in name), None)
+    for field, col in (('days', days_col), ('participants', participants_col), ('hours', hours_col)):
+        records[field] = pd.to_numeric(df[col], errors='coerce') if col is not None else np.nan
+    
+    records['duplicate'] = df.index.isin(duplicate_rows).astype(int)
+    # Identity of the stored row: its content only, without the version label, the
+    # position (a row inserted above must not change it) or the cross-sheet duplicate flag
+    records['row_hash'] = row_content_hashes(
+        records.drop(columns=['workbook_hash', 'row_number', 'duplicate']), index=False
+    ).to_numpy().view(np.int64)
+    return records
+
+def ingest_workbook(file_path, workbook_hash, source=None):
+    """
+    Load a workbook into the analytics store (once per workbook content)
+    source: stable name of the workbook (the uploaded file name; defaults to file_path).
+    A new version of the same source replaces the previous one as a diff: unchanged sheets
+    are only relabelled, and in changed sheets only added, edited or removed rows are written
+    """
+    conn = _open_course_store()
+    try:
+        if conn.execute("SELECT 1 FROM ingested_workbooks WHERE workbook_hash = ?", [workbook_hash]).fetchone():
+            return
+        
+        # Uploads are saved under their content hash, so the path changes with every version
+        source = source or os.path.abspath(file_path)
+        previous = conn.execute(
+            "SELECT workbook_hash FROM ingested_workbooks WHERE source = ?", [source]
+        ).fetchone()
+        previous_hash = previous[0] if previous else None
+        stored_sheets = dict(conn.execute(
+            "SELECT sheet, sheet_hash FROM ingested_sheets WHERE source = ?", [source]
+        ).fetchall())
+        
+        duplicates = get_workbook_duplicates(workbook_hash, file_path)
+        columns = ['workbook_hash', 'sheet', 'row_number', 'start_date', 'audience', 'status',
+                   'delivery', 'trainer', 'days', 'participants', 'hours', 'duplicate', 'row_hash']
+        sheet_hashes = {}
+        inserts = []
+        deletes = []
+        moves = []
+        for sheet in get_available_sheets(file_path):
+            sheet_hashes[sheet] = get_sheet_fingerprint(file_path, workbook_hash, sheet)
+            if previous_hash is not None and stored_sheets.get(sheet) == sheet_hashes[sheet]:
+                continue
+            
+            df = load_shared_sheet(file_path, workbook_hash, sheet)
+            records = (
+                build_course_records(df, workbook_hash, sheet, []) if not df.empty
+                else pd.DataFrame(columns=columns)
+            )
+            stored_rows = []
+            if previous_hash is not None:
+                stored_rows = conn.execute(
+                    "SELECT row_hash, row_number FROM courses WHERE workbook_hash = ? AND sheet = ? ORDER BY row_number",
+                    [previous_hash, sheet]
+                ).fetchall()
+            stored = pd.DataFrame(stored_rows, columns=['row_hash', 'row_number'], dtype='int64')
+            
+            # Pair stored and new rows by content; identical rows pair up in order
+            stored['occurrence'] = stored.groupby('row_hash').cumcount()
+            current = records[['row_hash', 'row_number']].astype('int64')
+            current['occurrence'] = current.groupby('row_hash').cumcount()
+            paired = stored.merge(current, on=['row_hash', 'occurrence'], how='outer',
+                                  suffixes=('_stored', ''), indicator=True)
+            
+            removed = paired.loc[paired['_merge'] == 'left_only', 'row_number_stored']
+            deletes.extend([previous_hash, sheet, int(row)] for row in removed)
+            kept = paired[paired['_merge'] == 'both']
+            shifted = kept[kept['row_number_stored'] != kept['row_number']]
+            moves.extend(
+                [sheet, int(new_row), int(old_row)]
+                for new_row, old_row in zip(shifted['row_number'], shifted['row_number_stored'])
+            )
+            added_rows = paired.loc[paired['_merge'] == 'right_only', 'row_number']
+            added = records[records['row_number'].isin(added_rows)][columns].astype(object)
+            inserts.extend(added.where(added.notna(), None).values.tolist())
+        
+        conn.execute("BEGIN")
+        if previous_hash is not None:
+            if deletes:
+                conn.executemany("DELETE FROM courses WHERE workbook_hash = ? AND sheet = ? AND row_number = ?", deletes)
+            # Rows of sheets that no longer exist
+            for sheet in set(stored_sheets) - set(sheet_hashes):
+                conn.execute("DELETE FROM courses WHERE workbook_hash = ? AND sheet = ?", [previous_hash, sheet])
+            conn.execute("UPDATE courses SET workbook_hash = ? WHERE workbook_hash = ?", [workbook_hash, previous_hash])
+            conn.execute("DELETE FROM ingested_workbooks WHERE workbook_hash = ?", [previous_hash])
+            # Rows that only moved get their new position, through negative numbers
+            # so a row never takes a position another row still holds
+            if moves:
+                conn.executemany(
+                    "UPDATE courses SET row_number = -? WHERE workbook_hash = ? AND sheet = ? AND row_number = ?",
+                    [[new_row, workbook_hash, sheet, old_row] for sheet, new_row, old_row in moves]
+                )
+                conn.execute(
+                    "UPDATE courses SET row_number = -row_number WHERE workbook_hash = ? AND row_number < 0", [workbook_hash]
+                )
+        if inserts:
+            conn.executemany(
+                f"INSERT INTO courses ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", inserts
+            )
+        
+        # Duplicate flags span sheets, so they are refreshed for the whole workbook
+        conn.execute("UPDATE courses SET duplicate = 0 WHERE workbook_hash = ? AND duplicate = 1", [workbook_hash])
+        repeated = duplicates[duplicates['duplicate']]
+        if not repeated.empty:
+            conn.executemany(
+                "UPDATE courses SET duplicate = 1 WHERE workbook_hash = ? AND sheet = ? AND row_number = ?",
+                [[workbook_hash, sheet, int(row) + 1] for sheet, row in zip(repeated['sheet'], repeated['row'])]
+            )
+        
+        conn.execute("DELETE FROM ingested_sheets WHERE source = ?", [source])
+        conn.executemany(
+            "INSERT INTO ingested_sheets (source, sheet, sheet_hash) VALUES (?, ?, ?)",
+            [[source, sheet, sheet_hash] for sheet, sheet_hash in sheet_hashes.items()]
+        )
+        conn.execute(
+            "INSERT INTO ingested_workbooks (workbook_hash, source, ingested_at) VALUES (?, ?, ?)",
+            [workbook_hash, source, datetime.now().isoformat(timespec='seconds')]
+        )
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+def course_scope_clause(scope):
+    """
+    WHERE conditions and parameters for a dashboard scope
+    scope: dict with workbook_hash and sheet (omitted = latest version of every stored workbook) and drop_duplicates
+    """
+    conditions = []
+    params = []
+    if scope and scope.get('workbook_hash'):
+        conditions.append("workbook_hash = ? AND sheet = ?")
+        params.extend([scope['workbook_hash'], scope['sheet']])
+    if scope and scope.get('drop_duplicates'):
+        conditions.append("duplicate = 0")
+    return conditions, params
+
+def query_course_values(scope, expression):
+    """
+    Distinct non-empty values of a column expression within a scope
+    """
+    conditions, params = course_scope_clause(scope)
+    conditions.append(f"{expression} IS NOT NULL")
+    conn = _open_course_store()
+    try:
+        rows = conn.execute(
+            f"SELECT DISTINCT {expression} FROM courses WHERE {' AND '.join(conditions)} ORDER BY 1", params
+        ).fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows]
+
+def query_comprehensive_stats(scope, selected_period='all', selected_year=None, selected_month=None,
+                              selected_date=None, selected_audience=None):
+    """
+    calculate_comprehensive_stats pushed down to the analytics store as one aggregate query
+    """
+    stats = calculate_comprehensive_stats(pd.DataFrame())
+    conditions, params = course_scope_clause(scope)
+    
+    if selected_audience:
+        conditions.append("audience = ?")
+        params.append(selected_audience)
+    
+    # Date ranges on ISO text use the start_date index
+    if selected_period == 'year' and selected_year:
+        conditions.append("start_date >= ? AND start_date < ?")
+        params.extend([f"{selected_year:04d}-01-01", f"{selected_year + 1:04d}-01-01"])
+        stats['period_label'] = f"سنة {selected_year}"
+    elif selected_period == 'month' and selected_year and selected_month:
+        next_year, next_month = (selected_year + 1, 1) if selected_month == 12 else (selected_year, selected_month + 1)
+        conditions.append("start_date >= ? AND start_date < ?")
+        params.extend([f"{selected_year:04d}-{selected_month:02d}-01", f"{next_year:04d}-{next_month:02d}-01"])
+        stats['period_label'] = f"{calendar.month_name[selected_month]} {selected_year}"
+    elif selected_period == 'day' and selected_date:
+        selected_date = pd.to_datetime(selected_date)
+        conditions.append("start_date = ?")
+        params.append(selected_date.strftime('%Y-%m-%d'))
+        stats['period_label'] = f"يوم {selected_date.strftime('%d/%m/%Y')}"
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    conn = _open_course_store()
+    try:
+        row = conn.execute(f"""
+            SELECT
+                COUNT(*),
+                SUM(CASE WHEN status = 'confirmed' THEN 1 ELSE 0 END),
+                SUM(CASE WHEN status = 'postponed' THEN 1 ELSE 0 END),
+                SUM(CASE WHEN status = 'in_progress' THEN 1 ELSE 0 END),
+                SUM(CASE WHEN status = 'cancelled' THEN 1 ELSE 0 END),
+                SUM(CASE WHEN status = 'unknown' THEN 1 ELSE 0 END),
+                SUM(CASE WHEN delivery = 'remote' THEN 1 ELSE 0 END),
+                SUM(CASE WHEN delivery = 'in_person' THEN 1 ELSE 0 END),
+                SUM(participants),
+                SUM(hours),
+                SUM(days)
+            FROM courses {where}
+        """, params).fetchone()
+    finally:
+        conn.close()
+    
+    for key, value in zip(
+        ['total_courses', 'confirmed_courses', 'postponed_courses', 'in_progress_courses', 'cancelled_courses',
+         'unknown_courses', 'remote_courses', 'in_person_courses', 'total_participants',
+         'total_training_hours', 'total_training_days'],
+        row
+    ):
+        stats[key] = int(value or 0)
+    return stats
+
+# ========================= FORM GENERATOR FUNCTIONS =========================
+
+def build_generation_summary(row_labels, row_results, pipeline_errors=()):
+    """
+    Build one summary table for a bulk run
+    row_results are render results in the same order as row_labels;
+    pipeline_errors are messages from PDF conversion / ZIP writing ("name.pdf: message")
+    """
+    extra_errors = {}
+    for error in pipeline_errors:
+        file_name, _, message = error.partition(': ')
+        extra_errors.setdefault(os.path.splitext(file_name)[0], []).append(f"{file_name}: {message}")
+    
+    summary_rows = []
+    for label, result in zip(row_labels, row_results):
+        errors = list(result['errors']) + extra_errors.get(label, [])
+        # Merged runs have no per-row 'docx'; a row failed if nothing could be filled
+        failed = result.get('docx', b'') is None or (errors and not result['replacements'])
+        if failed:
+            status = "❌ فشل"
+        elif errors or result['missing_tags']:
+            status = "⚠️ مع ملاحظات"
+        else:
+            status = "✅ تم"
+        summary_rows.append({
+            'النموذج': label,
+            'الحالة': status,
+            'عناصر محدثة': result['replacements'],
+            'حقول بدون بيانات': '، '.join(result['missing_tags']),
+            'الأخطاء': ' | '.join(errors)
+        })
+    
+    return pd.DataFrame(summary_rows, columns=['النموذج', 'الحالة', 'عناصر محدثة', 'حقول بدون بيانات', 'الأخطاء'])
+
+def show_generation_summary(summary_df):
+    """
+    Show bulk generation outcome as metrics plus a single table of rows needing attention
+    """
+    col1, col2, col3 = st.columns(3)
+    col1.metric("تم بنجاح", int((summary_df['الحالة'] == "✅ تم").sum()))
+    col2.metric("مع ملاحظات", int((summary_df['الحالة'] == "⚠️ مع ملاحظات").sum()))
+    col3.metric("فشل", int((summary_df['الحالة'] == "❌ فشل").sum()))
+    
+    attention_df = summary_df[summary_df['الحالة'] != "✅ تم"]
+    if not attention_df.empty:
+        with st.expander(f"📋 تفاصيل النماذج التي تحتاج مراجعة ({len(attention_df)})"):
+            # HTML table to avoid pyarrow dependency
+            st.markdown(attention_df.to_html(escape=True, index=False), unsafe_allow_html=True)
+
+def format_rows_for_display(rows):
+    """
+    Render rows as display strings (dates as DISPLAY_DATE_FORMAT, missing values empty)
+    """
+    display = pd.DataFrame(index=rows.index)
+    display['#'] = (rows.index + 1).astype(str)
+    for col in rows.columns:
+        values = rows[col]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            display[str(col)] = values.dt.strftime(config.DISPLAY_DATE_FORMAT).fillna('')
+        else:
+            display[str(col)] = values.astype(str).where(values.notna(), '')
+    return display
+
+def sort_row_labels(df, sort_by, descending):
+    """
+    Row labels of df in the requested order (None keeps the file order)
+    """
+    if sort_by is None:
+        return df.index[::-1] if descending else df.index
+    
+    values = df[sort_by]
+    if values.dtype == object:
+        # Mixed object columns are ordered by their text
+        values = values.astype(str).where(values.notna())
+    order = values.sort_values(ascending=not descending, na_position='last', kind='stable')
+    return order.index
+
+def build_row_browser(df, selection_scope=None):
+    """
+    Paged, sortable table of the rows with multi-row selection
+    Only the current page is sent to the browser, as one table element
+    The selection is kept in session state, so it survives paging, sorting and
+    filtering; it is reset when selection_scope (the dataset) changes
+    Returns (selected row labels, label of the row opened for details or None)
+    """
+    sort_col1, sort_col2, sort_col3 = st.columns([2, 1, 1])
+    sort_by = sort_col1.selectbox(
+        "ترتيب حسب", [None] + list(df.columns),
+        format_func=lambda col: "ترتيب الملف" if col is None else str(col).strip(),
+        key="row_browser_sort_by"
+    )
+    descending = sort_col2.checkbox("تنازلي", key="row_browser_descending")
+    items_per_page = sort_col3.selectbox(
+        "عدد العناصر في الصفحة", config.ITEMS_PER_PAGE_OPTIONS,
+        index=config.ITEMS_PER_PAGE_OPTIONS.index(config.DEFAULT_ITEMS_PER_PAGE)
+    )
+    
+    ordered_labels = sort_row_labels(df, sort_by, descending)
+    total_items = len(ordered_labels)
+    total_pages = (total_items - 1) // items_per_page + 1 if total_items > 0 else 1
+    
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col2:
+        current_page = st.number_input("الصفحة", min_value=1, max_value=total_pages, value=1)
+    
+    # Calculate start and end indices
+    start_idx = (current_page - 1) * items_per_page
+    page_labels = ordered_labels[start_idx:start_idx + items_per_page]
+    page_view = format_rows_for_display(df.loc[page_labels])
+    
+    st.subheader(f"البيانات (الصفحة {current_page} من {total_pages})")
+    
+    if st.session_state.get('row_browser_scope') != selection_scope:
+        st.session_state['row_browser_scope'] = selection_scope
+        st.session_state['row_browser_selected'] = set()
+    selected = st.session_state.setdefault('row_browser_selected', set())
+    
+    # Widgets are keyed by the page's rows (and a counter bumped when clearing),
+    # so a page's checkboxes are never applied to other rows
+    page_key = hashlib.md5(
+        f"{st.session_state.get('row_browser_generation', 0)}:{list(page_labels)}".encode()
+    ).hexdigest()
+    if ARROW_AVAILABLE:
+        editor_view = page_view.copy()
+        editor_view.insert(0, "تحديد", page_labels.isin(selected))
+        edited = st.data_editor(
+            editor_view, hide_index=True, disabled=list(page_view.columns),
+            column_config={"تحديد": st.column_config.CheckboxColumn()},
+            key=f"row_browser_{page_key}"
+        )
+        page_selected = page_labels[edited["تحديد"].to_numpy(dtype=bool)]
+    else:
+        # HTML table to avoid pyarrow dependency
+        st.markdown(page_view.to_html(escape=True, index=False), unsafe_allow_html=True)
+        page_selected = st.multiselect(
+            "تحديد استمارات", list(page_labels), default=[label for label in page_labels if label in selected],
+            format_func=lambda label: f"استماره طرح الدوره {label + 1}", key=f"row_browser_select_{page_key}"
+        )
+    
+    # Each page only adds or removes its own rows
+    selected.difference_update(page_labels)
+    selected.update(page_selected)
+    
+    # Rows hidden by the current filters stay selected but are not returned
+    selected_labels = [label for label in df.index if label in selected]
+    if selected:
+        count_col, clear_col = st.columns([3, 1])
+        count_col.caption(f"✅ المحدد: {len(selected_labels)} دورة" + (
+            f" (و {len(selected) - len(selected_labels)} خارج نتائج البحث الحالية)" if len(selected) > len(selected_labels) else ""
+        ))
+        if clear_col.button("إلغاء التحديد", key="row_browser_clear"):
+            selected.clear()
+            st.session_state['row_browser_generation'] = st.session_state.get('row_browser_generation', 0) + 1
+            st.rerun()
+    
+    opened_label = st.selectbox(
+        "عرض تفاصيل الدورة", [None] + list(page_labels),
+        format_func=lambda label: "—" if label is None else f"استماره طرح الدوره {label + 1}",
+        key="row_browser_opened"
+    )
+    return selected_labels, opened_label
+
+def show_row_details(df, label, row_template, field_columns):
+    """
+    Details and single-form generation for one row, rendered only when the row is opened
+    """
+    row = df.loc[label]
+    
+    with st.container(border=True):
+        st.markdown(f"**استماره طرح الدوره {label + 1}**")
+        col1, col2 = st.columns([3, 1])
+        
+        with col1:
+            # Display row data as one table
+            details = format_rows_for_display(df.loc[[label]]).drop(columns=['#']).T
+            details.columns = ['القيمة']
+            st.markdown(details.to_html(escape=True), unsafe_allow_html=True)
+        
+        with col2:
+            if st.button(f"⬇️ اصدار استمارة الطرح", key=f"generate_{label}"):
+                # Generate mapping
+                mapping = build_mapping(row, df.columns.tolist(), field_columns)
+                
+                # Generate DOCX (served from cache when the row is unchanged)
+                output_name = f"استماره_طرح_الدوره_{label + 1}"
+                certificate_block = assign_certificate_numbers([mapping], [row_template], output_name)
+                result = generate_docx_cached(row_template, mapping, output_name)
+                show_generation_messages(result)
+                if certificate_block:
+                    complete_certificate_block(certificate_block['block_id'], int(result['docx'] is not None))
+                docx_bytes, cache_key = result['docx'], result['cache_key']
+                
+                if docx_bytes:
+                    # Download DOCX
+                    st.download_button(
+                        label="📄 تحميل Word",
+                        data=docx_bytes,
+                        file_name=f"{output_name}.docx",
+                        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                        key=f"download_docx_{label}"
+                    )
+                    
+                    # Generate PDF if available
+                    if PDF_AVAILABLE:
+                        pdf_content = convert_docx_to_pdf_cached(cache_key, docx_bytes, output_name)
+                        if pdf_content:
+                            st.download_button(
+                                label="📄 تحميل PDF",
+                                data=pdf_content,
+                                file_name=f"{output_name}.pdf",
+                                mime="application/pdf",
+                                key=f"download_pdf_{label}"
+                            )
+
+def run_bulk_generation(df, template_paths, field_columns, output_mode):
+    """
+    Generate forms for every row of df (template_paths aligned with its rows)
+    as a ZIP of separate files or one merged print file per template
+    """
+    # Build all row mappings in one vectorized pass
+    mappings = build_mappings_for_frame(df, field_columns)
+    row_labels = [f"استماره_طرح_الدوره_{idx + 1}" for idx in df.index]
+    
+    # Reserve all certificate numbers of this run in one transaction
+    certificate_block = assign_certificate_numbers(mappings, template_paths, f"bulk-{uuid.uuid4().hex[:12]}")
+    if certificate_block:
+        first_number = certificate_block['first_number']
+        last_number = first_number + certificate_block['count'] - 1
+        st.info(
+            f"🔢 أرقام الشهادات المحجوزة: "
+            f"{format_certificate_number(certificate_block['sequence'], first_number)} - "
+            f"{format_certificate_number(certificate_block['sequence'], last_number)}"
+        )
+    
+    # One progress bar for the whole run instead of a message per document
+    progress_bar = st.progress(0.0, text="جاري توليد النماذج...")
+    
+    def report_progress(done, total):
+        progress_bar.progress(done / max(total, 1), text=f"جاري توليد النماذج... ({done}/{total})")
+    
+    if output_mode == 'merged':
+        # One merged file per template, since bodies can only be merged within a template
+        template_groups = OrderedDict()
+        for position, row_template in enumerate(template_paths):
+            template_groups.setdefault(row_template, []).append(position)
+        
+        merged_outputs = []
+        summary_labels = []
+        summary_results = []
+        issued_positions = []
+        rows_done = 0
+        for row_template, positions in template_groups.items():
+            merged_docx, merged_pdf, row_results = generate_merged_output(
+                row_template, [mappings[position] for position in positions], PDF_AVAILABLE,
+                on_progress=lambda done, total: report_progress(rows_done + done, len(mappings))
+            )
+            rows_done += len(positions)
+            merged_outputs.append((row_template, merged_docx, merged_pdf))
+            summary_labels.extend(row_labels[position] for position in positions)
+            summary_results.extend(row_results)
+            # A row is in the merged file unless its own render failed
+            if merged_docx is not None:
+                issued_positions.extend(
+                    position for position, result in zip(positions, row_results)
+                    if not (result['errors'] and not result['replacements'])
+                )
+        
+        progress_bar.empty()
+        if certificate_block:
+            # Only rows that were given a number from the block count towards it
+            complete_certificate_block(
+                certificate_block['block_id'],
+                sum(1 for position in issued_positions if CERTIFICATE_FIELD in mappings[position])
+            )
+        show_generation_summary(build_generation_summary(summary_labels, summary_results))
+        
+        for group_idx, (row_template, merged_docx, merged_pdf) in enumerate(merged_outputs):
+            suffix = "" if len(merged_outputs) == 1 else f"_{Path(row_template).stem}"
+            if merged_docx:
+                st.download_button(
+                    label=f"🖨️ تحميل الملف المدمج (Word){suffix.replace('_', ' - ')}",
+                    data=merged_docx,
+                    file_name=f"جميع_النماذج_مدمجة{suffix}.docx",
+                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                    key=f"merged_docx_{group_idx}"
+                )
+            if merged_pdf:
+                st.download_button(
+                    label=f"🖨️ تحميل الملف المدمج (PDF){suffix.replace('_', ' - ')}",
+                    data=merged_pdf,
+                    file_name=f"جميع_النماذج_مدمجة{suffix}.pdf",
+                    mime="application/pdf",
+                    key=f"merged_pdf_{group_idx}"
+                )
+        return
+    
+    zip_buffer = io.BytesIO()
+    row_results = []
+    
+    def render_rows():
+        for output_name, mapping, row_template in zip(row_labels, mappings, template_paths):
+            try:
+                # Generate DOCX (unchanged rows and identical mappings come from cache)
+                result = generate_docx_cached(row_template, mapping, output_name)
+            except Exception as e:
+                result = {'docx': None, 'replacements': 0, 'missing_tags': [], 'errors': [str(e)]}
+            row_results.append(result)
+            report_progress(len(row_results), len(mappings))
+            
+            if result['docx']:
+                yield output_name, result['cache_key'], result['docx']
     
-    # Display with styling using HTML table to avoid pyarrow dependency
-    st.markdown(summary_df.to_html(escape=False, index=False), unsafe_allow_html=True)
-
-# ========================= FORM GENERATOR FUNCTIONS =========================
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        # Rendering, PDF conversion and ZIP writing run as overlapping stages
+        pipeline_result = run_bulk_generation_pipeline(render_rows(), zip_file, PDF_AVAILABLE)
+    
+    progress_bar.empty()
+    if certificate_block:
+        numbered_rows = [
+            result for result, mapping in zip(row_results, mappings) if CERTIFICATE_FIELD in mapping
+        ]
+        complete_certificate_block(
+            certificate_block['block_id'],
+            sum(1 for result in numbered_rows if result['docx'] is not None)
+        )
+    show_generation_summary(
+        build_generation_summary(row_labels, row_results, pipeline_result['errors'])
+    )
+    
+    zip_buffer.seek(0)
+    
+    st.download_button(
+        label="📦 تحميل جميع النماذج (ZIP)",
+        data=zip_buffer.getvalue(),
+        file_name="جميع_النماذج.zip",
+        mime="application/zip"
+    )
 
-def build_form_generator(df, template_path):
+def build_form_generator(df, template_path, fingerprint=None):
     """
     Build the accreditation form generator interface
+    fingerprint: identity of df (resolve_dataset_fingerprint); hashed from df when omitted
     """
     st.header("📄 اصدار استمارة طرح الدوره")
     
@@ -1331,138 +4654,102 @@ def build_form_generator(df, template_path):
         return
     
 
+    # --- SEARCH ---
+    if fingerprint is None:
+        fingerprint = dataset_fingerprint(df)
+    dataset = df
+    search_query = st.text_input(
+        "🔎 بحث عن دورة", placeholder="اسم الدورة أو المدرب أو مكان الانعقاد", key="generator_search"
+    )
+    
     # --- FILTERS ---
-    filter_col1, filter_col2 = st.columns(2)
-    # Filter by audience
-    audience_col = None
-    for col in df.columns:
-        if 'الفئة المستهدفة' in str(col):
-            audience_col = col
-            break
-    if audience_col:
-        audience_options = ['الكل'] + sorted([str(x) for x in df[audience_col].dropna().unique()])
-        selected_audience = filter_col1.selectbox("فلترة حسب الفئة المستهدفة", audience_options)
-        if selected_audience != 'الكل':
-            df = df[df[audience_col] == selected_audience]
-
-    # Filter by course start date (day)
-    date_col = None
-    for col in df.columns:
-        if 'تاريخ بداية الدورة بالميلادي' in str(col):
-            date_col = col
-            break
-    selected_day = None
-    if date_col:
-        # Parse all values to datetime, including string formats like '14/9/2025'
-        parsed_dates = pd.to_datetime(df[date_col].astype(str), errors='coerce', dayfirst=True)
-        days = parsed_dates.dropna().dt.date.unique()
-        day_options = ['الكل'] + [day.strftime('%d/%m/%Y') for day in sorted(days)]
-        selected_day = filter_col2.selectbox("فلترة حسب يوم بداية الدورة", day_options)
-        if selected_day != 'الكل':
-            # Filter by selected day (string format)
-            df = df[pd.to_datetime(df[date_col].astype(str), errors='coerce', dayfirst=True).dt.strftime('%d/%m/%Y') == selected_day]
-
-    # Pagination settings
-    items_per_page = st.selectbox("عدد العناصر في الصفحة", [5, 10, 20, 50], index=1)
-
-    total_items = len(df)
-    total_pages = (total_items - 1) // items_per_page + 1 if total_items > 0 else 1
-
-    col1, col2, col3 = st.columns([1, 2, 1])
-    with col2:
-        current_page = st.number_input("الصفحة", min_value=1, max_value=total_pages, value=1)
-
-    # Calculate start and end indices
-    start_idx = (current_page - 1) * items_per_page
-    end_idx = min(start_idx + items_per_page, total_items)
+    # Values within a filter are OR-ed, filters are AND-ed (over precomputed row bitmaps)
+    row_index = get_row_bitmap_index(fingerprint, df)
+    filter_fields = [
+        ('audience', "فلترة حسب الفئة المستهدفة"),
+        ('day', "فلترة حسب يوم بداية الدورة"),
+        ('status', "فلترة حسب حالة الاعتماد"),
+        ('trainer', "فلترة حسب المدرب"),
+        ('venue', "فلترة حسب مكان الانعقاد")
+    ]
+    filter_cols = st.columns(3)
+    filters = {}
+    for position, (field, label) in enumerate(field for field in filter_fields if row_index.values(field[0])):
+        filters[field] = filter_cols[position % 3].multiselect(
+            label, row_index.values(field), placeholder="الكل", key=f"generator_filter_{field}"
+        )
+    matching_labels = row_index.query(filters)
+    if search_query.strip():
+        search_labels = get_course_search_index(fingerprint, df).search(search_query)
+        matching_labels = matching_labels[matching_labels.isin(search_labels)]
+        st.caption(f"نتائج البحث: {len(matching_labels)} دورة")
+    df = df.loc[matching_labels]
 
-    # Display current page data
-    page_df = df.iloc[start_idx:end_idx].copy() if total_items > 0 else pd.DataFrame()
-    page_df.reset_index(drop=True, inplace=True)
-    
-    # Display data with generate buttons
-    st.subheader(f"البيانات (الصفحة {current_page} من {total_pages})")
+    # Route rows to registry templates (an uploaded template is used for every row)
+    if template_path == config.TEMPLATE_FILE_PATH:
+        template_paths = route_templates(df, template_path)
+    else:
+        template_paths = [template_path] * len(df)
     
-    # Extract placeholders from template
-    placeholders = extract_placeholders_from_word(template_path)
+    # Field -> column mappings confirmed in the comparison tab
+    field_columns = get_confirmed_field_mapping(set(template_paths), df.columns)
     
-    # Show data table with generate buttons
-    for idx, row in page_df.iterrows():
-        with st.expander(f"استماره طرح الدوره {start_idx + idx + 1}"):
-            col1, col2 = st.columns([3, 1])
-            
-            with col1:
-                # Display row data
-                row_dict = row.to_dict()
-                for key, value in row_dict.items():
-                    st.text(f"{key}: {value}")
-            
-            with col2:
-                if st.button(f"⬇️ اصدار استمارة الطرح", key=f"generate_{start_idx + idx}"):
-                    # Generate mapping
-                    mapping = build_mapping(row, df.columns.tolist())
-                    
-                    # Generate DOCX
-                    output_name = f"استماره_طرح_الدوره_{start_idx + idx + 1}"
-                    docx_buffer = generate_docx_from_template(template_path, mapping, output_name)
-                    
-                    if docx_buffer:
-                        # Download DOCX
-                        st.download_button(
-                            label="📄 تحميل Word",
-                            data=docx_buffer.getvalue(),
-                            file_name=f"{output_name}.docx",
-                            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                            key=f"download_docx_{start_idx + idx}"
-                        )
-                        
-                        # Generate PDF if available
-                        if PDF_AVAILABLE:
-                            pdf_content = convert_docx_to_pdf(docx_buffer, output_name)
-                            if pdf_content:
-                                st.download_button(
-                                    label="📄 تحميل PDF",
-                                    data=pdf_content,
-                                    file_name=f"{output_name}.pdf",
-                                    mime="application/pdf",
-                                    key=f"download_pdf_{start_idx + idx}"
-                                )
+    template_counts = pd.Series(template_paths, dtype=object).map(os.path.basename).value_counts()
+    if len(template_counts) > 1:
+        st.info("📑 القوالب المستخدمة: " + "، ".join(f"{name} ({count})" for name, count in template_counts.items()))
+
+    # Paged, sortable row table; details are rendered only for the opened row
+    selected_labels, opened_label = build_row_browser(df, selection_scope=fingerprint)
+    if opened_label is not None:
+        show_row_details(df, opened_label, template_paths[df.index.get_loc(opened_label)], field_columns)
     
     # Bulk generation option
     st.subheader("📦 التوليد المجمع")
-    if st.button("اصدار جميع استمارات طرح الدوره"):
-        with st.spinner("جاري توليد النماذج..."):
-            zip_buffer = io.BytesIO()
-            
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                for idx, row in df.iterrows():
-                    try:
-                        # Generate mapping
-                        mapping = build_mapping(row, df.columns.tolist())
-                        
-                        # Generate DOCX
-                        output_name = f"استماره_طرح_الدوره_{idx + 1}"
-                        docx_buffer = generate_docx_from_template(template_path, mapping, output_name)
-                        
-                        if docx_buffer:
-                            zip_file.writestr(f"{output_name}.docx", docx_buffer.getvalue())
-                            
-                            # Add PDF if available
-                            if PDF_AVAILABLE:
-                                pdf_content = convert_docx_to_pdf(docx_buffer, output_name)
-                                if pdf_content:
-                                    zip_file.writestr(f"{output_name}.pdf", pdf_content)
-                    except Exception as e:
-                        st.warning(f"خطأ في اصدار استمارة الطرح للسطر {idx + 1}: {str(e)}")
-            
-            zip_buffer.seek(0)
-            
-            st.download_button(
-                label="📦 تحميل جميع النماذج (ZIP)",
-                data=zip_buffer.getvalue(),
-                file_name="جميع_النماذج.zip",
-                mime="application/zip"
-            )
+    
+    if any(template_uses_certificate_numbers(path) for path in set(template_paths)):
+        with st.expander("🔢 سجل أرقام الشهادات"):
+            audit = audit_certificate_numbers()
+            if audit['overlaps'] or audit['gaps']:
+                st.error(f"❌ تداخل: {audit['overlaps']} | فجوات: {audit['gaps']}")
+            else:
+                st.success("✅ لا يوجد تداخل أو فجوات في أرقام الشهادات")
+            if audit['unused']:
+                st.warning("⚠️ أرقام محجوزة لم تُستخدم (رقم الدفعة، العدد): " + "، ".join(str(item) for item in audit['unused']))
+            if not audit['blocks'].empty:
+                st.markdown(audit['blocks'].to_html(index=False), unsafe_allow_html=True)
+    output_mode = st.radio(
+        "شكل الإخراج",
+        ['zip', 'merged'],
+        format_func=lambda x: {
+            'zip': 'ملفات منفصلة (ZIP)',
+            'merged': 'ملف واحد مدمج للطباعة'
+        }[x],
+        horizontal=True
+    )
+    # Data-quality gate before bulk generation (the shown rows' issues)
+    issues_df = get_validation_issues(fingerprint, dataset)
+    issues_df = issues_df[issues_df['الصف'].isin(df.index + 1)].reset_index(drop=True)
+    show_validation_report(issues_df)
+    error_rows = issues_df.loc[issues_df['severity'] == 'error', 'الصف'].nunique()
+    bulk_blocked = False
+    if error_rows:
+        if config.VALIDATION_BLOCK_ON_ERRORS:
+            st.error(f"❌ توجد أخطاء في بيانات {error_rows} دورة، راجع فحص جودة البيانات قبل التوليد المجمع")
+            bulk_blocked = not st.checkbox("المتابعة رغم الأخطاء", key="ignore_validation_errors")
+        else:
+            st.warning(f"⚠️ توجد أخطاء في بيانات {error_rows} دورة، راجع فحص جودة البيانات")
+    selected_error_rows = issues_df['الصف'].isin(pd.Index(selected_labels) + 1) & (issues_df['severity'] == 'error')
+    selected_blocked = bulk_blocked and selected_error_rows.any()
+    
+    if st.button("اصدار جميع استمارات طرح الدوره", disabled=bulk_blocked):
+        run_bulk_generation(df, template_paths, field_columns, output_mode)
+    
+    if selected_labels and st.button(f"⬇️ اصدار الاستمارات المحددة ({len(selected_labels)})", disabled=selected_blocked):
+        selected_positions = df.index.get_indexer(selected_labels)
+        run_bulk_generation(
+            df.loc[selected_labels], [template_paths[position] for position in selected_positions],
+            field_columns, output_mode
+        )
 
 # ========================= COMPARISON FUNCTIONS =========================
 
@@ -1476,55 +4763,70 @@ def build_comparison_view(df, template_path):
         st.warning("يرجى رفع قالب Word أولاً")
         return
     
-    # Extract placeholders from Word template
-    placeholders = extract_placeholders_from_word(template_path)
+    # Template fields: {{placeholders}} and Content Control tags
+    try:
+        template_fields = get_template_fields(template_path)
+    except Exception as e:
+        st.error(f"خطأ في قراءة قالب Word: {str(e)}")
+        return
+    fields = [(f"{{{{{name}}}}}", name) for name in template_fields['placeholders']]
+    fields += [(f"[{name}]", name) for name in template_fields['tags']]
     
-    if not placeholders:
+    if not fields:
         st.warning("لم يتم العثور على أي عناصر نائبة في قالب Word")
         return
     
     # Get Excel columns
     excel_columns = df.columns.tolist() if not df.empty else []
+    matcher = get_column_matcher(tuple(excel_columns))
+    plan_columns = {tag_name: source_col for source_col, tag_name in resolve_mapping_plan(tuple(excel_columns))}
+    
+    template_hash = get_file_content_hash(template_path)
+    confirmed_mappings = st.session_state.setdefault('confirmed_field_mappings', {})
+    confirmed = confirmed_mappings.get(template_hash, {})
     
     # Build comparison data
     comparison_data = []
     matched_columns = set()
+    chosen_columns = {}
     
-    for placeholder in placeholders:
-        # Try to find exact match
-        if placeholder in excel_columns:
-            comparison_data.append({
-                "العنصر النائب في Word": f"{{{{{placeholder}}}}}",
-                "عمود Excel المطابق": placeholder,
-                "الحالة": "✅ مطابق"
-            })
-            matched_columns.add(placeholder)
+    for label, field in fields:
+        candidates = matcher.rank(field, limit=3)
+        best_column, best_score = candidates[0] if candidates else (None, 0.0)
+        
+        if confirmed.get(field) in excel_columns:
+            column, status = confirmed[field], "✅ مؤكد"
+        elif field in plan_columns:
+            column, status = plan_columns[field], "✅ مطابق"
+        elif best_score >= 1.0:
+            column, status = best_column, "✅ مطابق"
+        elif best_score >= config.FUZZY_MATCH_THRESHOLD:
+            column, status = best_column, "⚠️ مشابه"
         else:
-            # Try to find similar column
-            similar_cols = [col for col in excel_columns if placeholder.lower() in str(col).lower() or str(col).lower() in placeholder.lower()]
-            if similar_cols:
-                comparison_data.append({
-                    "العنصر النائب في Word": f"{{{{{placeholder}}}}}",
-                    "عمود Excel المطابق": similar_cols[0],
-                    "الحالة": "⚠️ مشابه"
-                })
-                matched_columns.add(similar_cols[0])
-            else:
-                comparison_data.append({
-                    "العنصر النائب في Word": f"{{{{{placeholder}}}}}",
-                    "عمود Excel المطابق": "غير موجود",
-                    "الحالة": "❌ مفقود"
-                })
-    
-    # Add unused Excel columns
-    unused_columns = set(excel_columns) - matched_columns
-    for col in unused_columns:
+            column, status = None, "❌ مفقود"
+        
+        chosen_columns[field] = column
+        if column is not None:
+            matched_columns.add(column)
         comparison_data.append({
-            "العنصر النائب في Word": "غير موجود",
-            "عمود Excel المطابق": col,
-            "الحالة": "⚠️ غير مستخدم"
+            "العنصر النائب في Word": label,
+            "عمود Excel المطابق": column if column is not None else "غير موجود",
+            "درجة التشابه": f"{best_score:.0%}" if candidates else "-",
+            "أقرب الأعمدة": "، ".join(f"{col} ({score:.0%})" for col, score in candidates),
+            "الحالة": status
         })
     
+    # Add unused Excel columns
+    for col in excel_columns:
+        if col not in matched_columns:
+            comparison_data.append({
+                "العنصر النائب في Word": "غير موجود",
+                "عمود Excel المطابق": col,
+                "درجة التشابه": "-",
+                "أقرب الأعمدة": "",
+                "الحالة": "⚠️ غير مستخدم"
+            })
+    
     # Display comparison table
     st.subheader("📊 جدول المقارنة")
     comparison_df = pd.DataFrame(comparison_data)
@@ -1550,7 +4852,7 @@ def build_comparison_view(df, template_path):
         st.metric("عناصر مطابقة", matched_count)
     
     with col2:
-        similar_count = len([item for item in comparison_data if "⚠️" in item["الحالة"] and "مشابه" in item["الحالة"]])
+        similar_count = len([item for item in comparison_data if "مشابه" in item["الحالة"]])
         st.metric("عناصر مشابهة", similar_count)
     
     with col3:
@@ -1568,6 +4870,34 @@ def build_comparison_view(df, template_path):
     if unused_count > 0:
         st.info(f"💡 يوجد {unused_count} عمود في Excel لا يستخدم في قالب Word")
     
+    # Confirm which column feeds each template field; generation reuses this mapping
+    st.subheader("🔗 تأكيد الربط بين الحقول والأعمدة")
+    no_column = "— بدون —"
+    with st.form("confirm_field_mapping"):
+        selections = {}
+        for label, field in fields:
+            options = [no_column] + excel_columns
+            current = chosen_columns.get(field)
+            selections[field] = st.selectbox(
+                label,
+                options,
+                index=options.index(current) if current in excel_columns else 0,
+                key=f"confirm_{template_hash[:12]}_{field}"
+            )
+        submitted = st.form_submit_button("✅ اعتماد الربط لاستخدامه في التوليد")
+    
+    if submitted:
+        # Only keep choices that differ from the built-in plan, so its fallbacks stay active
+        confirmed_mappings[template_hash] = {
+            field: column for field, column in selections.items()
+            if column != no_column and column != plan_columns.get(field)
+        }
+        st.success(f"تم اعتماد ربط {len(confirmed_mappings[template_hash])} حقل لهذا القالب")
+    
+    if confirmed_mappings.get(template_hash) and st.button("↩️ إلغاء الربط المعتمد"):
+        confirmed_mappings.pop(template_hash, None)
+        st.rerun()
+    
     # Export comparison report
     if st.button("📄 تصدير تقرير المقارنة"):
         excel_buffer = io.BytesIO()
@@ -1582,13 +4912,283 @@ def build_comparison_view(df, template_path):
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
 
+# ========================= WORKBOOK VERSION DIFF =========================
+
+CHANGE_TYPE_LABELS = {
+    'added': "دورة مضافة",
+    'cancelled': "دورة محذوفة",
+    'moved': "تغيير الموعد",
+    'reassigned': "تغيير المدرب",
+    'modified': "تعديل بيانات"
+}
+
+# Canonical names of the course key columns, so versions and months with
+# differently named columns are compared field by field
+COURSE_KEY_LABELS = {
+    'name': "اسم الدورة",
+    'trainer': "اسم المدرب",
+    'start_date': "تاريخ بداية الدورة",
+    'venue': "مكان الانعقاد"
+}
+
+def comparable_text(series):
+    """
+    Cell values as trimmed text ('' for missing), so 5 and 5.0 or a date and
+    its timestamp compare equal across versions
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        text = series.dt.strftime(config.DATE_FORMAT)
+    elif pd.api.types.is_float_dtype(series):
+        text = series.map(lambda value: str(int(value)) if float(value).is_integer() else str(value), na_action='ignore')
+    else:
+        text = series.astype(str).str.strip()
+    return text.where(series.notna(), '')
+
+def workbook_course_texts(file_path, workbook_hash):
+    """
+    Every course row of a workbook as comparable text, indexed by (sheet, row)
+    Key columns are renamed to their canonical labels; returns (texts, course name keys)
+    """
+    frames = {}
+    name_keys = {}
+    for sheet in get_available_sheets(file_path):
+        df = load_shared_sheet(file_path, workbook_hash, sheet)
+        if df.empty:
+            continue
+        renames = {}
+        for part, (keywords, exclude) in COURSE_KEY_COLUMNS.items():
+            col = find_column(df.columns, keywords, exclude=exclude)
+            if col is not None and COURSE_KEY_LABELS[part] not in df.columns:
+                renames[col] = COURSE_KEY_LABELS[part]
+        texts = df.rename(columns=renames).apply(comparable_text)
+        frames[sheet] = texts
+        name_col = COURSE_KEY_LABELS['name']
+        name_keys[sheet] = normalize_arabic_series(texts[name_col]) if name_col in texts.columns else pd.Series('', index=texts.index)
+    
+    if not frames:
+        return pd.DataFrame(index=pd.MultiIndex.from_tuples([], names=['sheet', 'row'])), pd.Series(dtype=object)
+    texts = pd.concat(frames, names=['sheet', 'row']).fillna('')
+    return texts, pd.concat(name_keys, names=['sheet', 'row'])
+
+def match_course_rows(old_keys, new_keys, on):
+    """
+    Pair rows with equal key columns; repeated keys are paired in row order
+    old_keys / new_keys: DataFrames with a 'position' column and the key columns
+    """
+    old_keys = old_keys.assign(occurrence=old_keys.groupby(on, sort=False).cumcount())
+    new_keys = new_keys.assign(occurrence=new_keys.groupby(on, sort=False).cumcount())
+    return old_keys.merge(new_keys, on=on + ['occurrence'], suffixes=('_old', '_new'))[['position_old', 'position_new']]
+
+def locate_course_rows(texts, positions):
+    """
+    Sheet, row label and course name at positions of workbook_course_texts (-1 = no row)
+    """
+    positions = np.asarray(positions, dtype=int)
+    valid = positions >= 0
+    picked = texts.iloc[positions[valid]]
+    result = pd.DataFrame(index=range(len(positions)), columns=['sheet', 'row', 'name'], dtype=object)
+    result.loc[valid, 'sheet'] = picked.index.get_level_values('sheet')
+    result.loc[valid, 'row'] = picked.index.get_level_values('row')
+    if COURSE_KEY_LABELS['name'] in picked.columns:
+        result.loc[valid, 'name'] = picked[COURSE_KEY_LABELS['name']].to_numpy()
+    result['row'] = result['row'].astype('Int64')
+    return result
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def diff_workbook_versions(old_hash, _old_path, new_hash, _new_path):
+    """
+    Course-level diff between two versions of the planning workbook
+    Rows are paired by row hash first (unchanged courses), then by normalized
+    course name; only the pairs whose hashes differ are compared field by field
+    All pairing is done with hash joins, so the diff is linear in the row count
+    Returns DataFrame with change type, course name, old/new sheet and row, and changed fields
+    """
+    old_texts, old_names = workbook_course_texts(_old_path, old_hash)
+    new_texts, new_names = workbook_course_texts(_new_path, new_hash)
+    
+    # Hash only the columns both versions have, so an added column doesn't flag every row
+    common = [col for col in new_texts.columns if col in set(old_texts.columns)]
+    old_keys = pd.DataFrame({
+        'position': np.arange(len(old_texts)),
+        'name': old_names.to_numpy(),
+        'row_hash': pd.util.hash_pandas_object(old_texts[common], index=False).to_numpy()
+    })
+    new_keys = pd.DataFrame({
+        'position': np.arange(len(new_texts)),
+        'name': new_names.to_numpy(),
+        'row_hash': pd.util.hash_pandas_object(new_texts[common], index=False).to_numpy()
+    })
+    
+    same = match_course_rows(old_keys, new_keys, ['name', 'row_hash'])
+    old_rest = old_keys[~old_keys['position'].isin(same['position_old'])]
+    new_rest = new_keys[~new_keys['position'].isin(same['position_new'])]
+    changed = match_course_rows(old_rest[old_rest['name'] != ''], new_rest[new_rest['name'] != ''], ['name'])
+    
+    # Field-level comparison of the changed pairs only
+    old_values = old_texts[common].to_numpy()[changed['position_old'].to_numpy()]
+    new_values = new_texts[common].to_numpy()[changed['position_new'].to_numpy()]
+    differs = old_values != new_values
+    old_sheets = old_texts.index.get_level_values('sheet')
+    new_sheets = new_texts.index.get_level_values('sheet')
+    
+    records = []
+    for pair, (old_position, new_position) in enumerate(changed.itertuples(index=False)):
+        changed_columns = np.flatnonzero(differs[pair])
+        changed_names = {common[i] for i in changed_columns}
+        if COURSE_KEY_LABELS['start_date'] in changed_names or old_sheets[old_position] != new_sheets[new_position]:
+            change = 'moved'
+        elif COURSE_KEY_LABELS['trainer'] in changed_names:
+            change = 'reassigned'
+        else:
+            change = 'modified'
+        records.append({
+            'change': change,
+            'old_position': old_position,
+            'new_position': new_position,
+            'fields': "، ".join(
+                f"{common[i]}: {old_values[pair, i] or '—'} ← {new_values[pair, i] or '—'}" for i in changed_columns
+            )
+        })
+    # Unchanged rows that only moved to another month sheet
+    for old_position, new_position in same.itertuples(index=False):
+        if old_sheets[old_position] != new_sheets[new_position]:
+            records.append({'change': 'moved', 'old_position': old_position, 'new_position': new_position, 'fields': ''})
+    
+    matched_old = set(same['position_old']) | set(changed['position_old'])
+    matched_new = set(same['position_new']) | set(changed['position_new'])
+    records.extend(
+        {'change': 'cancelled', 'old_position': position, 'new_position': -1, 'fields': ''}
+        for position in range(len(old_texts)) if position not in matched_old
+    )
+    records.extend(
+        {'change': 'added', 'old_position': -1, 'new_position': position, 'fields': ''}
+        for position in range(len(new_texts)) if position not in matched_new
+    )
+    
+    diff = pd.DataFrame(records, columns=['change', 'old_position', 'new_position', 'fields'])
+    old_rows = locate_course_rows(old_texts, diff['old_position'])
+    new_rows = locate_course_rows(new_texts, diff['new_position'])
+    return pd.DataFrame({
+        'change': diff['change'],
+        'name': new_rows['name'].fillna(old_rows['name']),
+        'old_sheet': old_rows['sheet'],
+        'old_row': old_rows['row'],
+        'new_sheet': new_rows['sheet'],
+        'new_row': new_rows['row'],
+        'fields': diff['fields']
+    })
+
+def show_workbook_diff(handle):
+    """
+    Diff between the current workbook and a previous version, with optional
+    form generation for the added and changed courses of the current month
+    """
+    st.header("🔄 مقارنة إصدارات ملف الخطة")
+    
+    if not handle or not handle.get('excel_path'):
+        st.warning("يرجى تحميل ملف Excel أولاً")
+        return
+    
+    previous_file = st.file_uploader("رفع الإصدار السابق من ملف Excel", type=['xlsx'], key="diff_previous_workbook")
+    if not previous_file:
+        st.info("ارفع الإصدار السابق لعرض الدورات المضافة والمحذوفة والمعدلة مقارنة بالملف الحالي")
+        return
+    
+    previous_path = save_uploaded_file(previous_file, '.xlsx', slot='previous_workbook')
+    try:
+        diff = diff_workbook_versions(
+            get_file_content_hash(previous_path), previous_path, handle['workbook_hash'], handle['excel_path']
+        )
+    except Exception as e:
+        st.error(f"تعذرت مقارنة الإصدارين: {str(e)}")
+        return
+    
+    if diff.empty:
+        st.success("✅ لا توجد تغييرات بين الإصدارين")
+        return
+    
+    counts = diff['change'].value_counts()
+    metric_cols = st.columns(len(CHANGE_TYPE_LABELS))
+    for col, (change, label) in zip(metric_cols, CHANGE_TYPE_LABELS.items()):
+        col.metric(label, int(counts.get(change, 0)))
+    
+    selected_changes = st.multiselect(
+        "نوع التغيير", list(CHANGE_TYPE_LABELS), default=list(CHANGE_TYPE_LABELS),
+        format_func=CHANGE_TYPE_LABELS.get, key="diff_change_filter"
+    )
+    filtered = diff[diff['change'].isin(selected_changes)]
+    report_df = pd.DataFrame({
+        'التغيير': filtered['change'].map(CHANGE_TYPE_LABELS),
+        'الدورة': filtered['name'],
+        'الشهر السابق': filtered['old_sheet'],
+        'الصف السابق': filtered['old_row'] + 1,
+        'الشهر الحالي': filtered['new_sheet'],
+        'الصف الحالي': filtered['new_row'] + 1,
+        'الحقول المتغيرة': filtered['fields']
+    })
+    st.write(f"عدد التغييرات المعروضة: {len(report_df)} من {len(diff)}")
+    # HTML table to avoid pyarrow dependency
+    st.markdown(report_df.to_html(escape=True, index=False, na_rep=''), unsafe_allow_html=True)
+    
+    if st.button("📄 تصدير تقرير التغييرات"):
+        excel_buffer = io.BytesIO()
+        with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
+            report_df.to_excel(writer, sheet_name='التغييرات', index=False)
+        
+        excel_buffer.seek(0)
+        st.download_button(
+            label="📊 تحميل تقرير Excel",
+            data=excel_buffer.getvalue(),
+            file_name="تقرير_تغييرات_الخطة.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+    
+    # Regenerate forms only for the courses that changed in the current month
+    df = resolve_dataset(handle)
+    template_path = handle.get('template_path')
+    changed_rows = diff.loc[
+        diff['change'].isin(selected_changes) & (diff['change'] != 'cancelled') & (diff['new_sheet'] == handle['sheet']),
+        'new_row'
+    ]
+    changed_labels = df.index[df.index.isin(changed_rows.astype(int))]
+    if df.empty or not template_path or changed_labels.empty:
+        return
+    
+    st.subheader("📦 اصدار استمارات الدورات المتغيرة")
+    changed_df = df.loc[changed_labels]
+    if template_path == config.TEMPLATE_FILE_PATH:
+        template_paths = route_templates(changed_df, template_path)
+    else:
+        template_paths = [template_path] * len(changed_df)
+    field_columns = get_confirmed_field_mapping(set(template_paths), changed_df.columns)
+    output_mode = st.radio(
+        "شكل الإخراج",
+        ['zip', 'merged'],
+        format_func=lambda x: {
+            'zip': 'ملفات منفصلة (ZIP)',
+            'merged': 'ملف واحد مدمج للطباعة'
+        }[x],
+        horizontal=True,
+        key="diff_output_mode"
+    )
+    
+    error_rows = validate_course_frame(changed_df).query("severity == 'error'")['الصف'].nunique()
+    blocked = False
+    if error_rows:
+        st.warning(f"⚠️ توجد أخطاء في بيانات {error_rows} دورة من الدورات المتغيرة")
+        blocked = config.VALIDATION_BLOCK_ON_ERRORS and not st.checkbox(
+            "المتابعة رغم الأخطاء", key="diff_ignore_validation_errors"
+        )
+    
+    if st.button(f"⬇️ اصدار استمارات الدورات المتغيرة في {handle['sheet']} ({len(changed_df)})", disabled=blocked):
+        run_bulk_generation(changed_df, template_paths, field_columns, output_mode)
+
 # ========================= MAIN APPLICATION =========================
 
-def main():
+def render_header():
     """
-    Main application function
+    Page header with logo and gradient background
     """
-    # Beautiful header with logo and gradient background
     logo_path = "assets/logo.png"
     
     # Check if logo exists
@@ -1611,206 +5211,288 @@ def main():
             <p class="header-subtitle">Training Courses Management System</p>
         </div>
         """, unsafe_allow_html=True)
+
+def select_month_sheet(available_sheets, key_prefix=""):
+    """
+    Month selector that preselects September when the workbook has it
+    """
+    september_sheet = None
+    september_variations = ["سبتمبر", "September", "9", "09"]
     
-    # Sidebar for file uploads and settings
-    with st.sidebar:
-        # Enhanced sidebar header
-        st.markdown("""
-        <div style="text-align: center; padding: 1rem; background: linear-gradient(135deg, #6A3CBC 0%, #2EC4B6 100%); border-radius: 10px; margin-bottom: 1rem;">
-            <h2 style="color: white; margin: 0; font-size: 1.5rem;">⚙️ الإعدادات</h2>
-            <p style="color: rgba(255,255,255,0.8); margin: 0.5rem 0 0 0; font-size: 0.9rem;">إعدادات النظام والملفات</p>
-        </div>
-        """, unsafe_allow_html=True)
-        
-        # Check for default files first with complete error handling
-        try:
-            if hasattr(config, 'EXCEL_FILE_PATH') and hasattr(config, 'TEMPLATE_FILE_PATH'):
-                default_excel_path = config.EXCEL_FILE_PATH
-                default_template_path = config.TEMPLATE_FILE_PATH
-                
-                # Test template loading early to catch errors safely
-                try:
-                    # Just test if we can open the document without processing its content
-                    test_doc = Document(default_template_path)
-                    # Test basic access without table iteration
-                    _ = len(test_doc.paragraphs)
-                    st.success("✅ قالب Word تم تحميله بنجاح")
-                    # Don't test tables here to avoid grid_offset errors
-                except Exception as template_test_error:
-                    st.warning(f"⚠️ تحذير من قالب Word: {str(template_test_error)}")
-                    st.info("🔄 سيتم تجربة القالب مع التعامل الآمن مع الأخطاء")
-                    # Don't set to None - still try to use it with safe processing
+    for variation in september_variations:
+        if variation in available_sheets:
+            september_sheet = variation
+            break
+    
+    if september_sheet:
+        st.success(f"🗓️ تم تحديد شهر سبتمبر تلقائياً: '{september_sheet}'")
+        default_index = available_sheets.index(september_sheet)
+    else:
+        default_index = 0
+    
+    if key_prefix:
+        return st.selectbox("اختر الشهر (ورقة العمل)", available_sheets,
+                            index=default_index, key=f"{key_prefix}_sheet")
+    
+    if not september_sheet:
+        st.warning("لم يتم العثور على شهر سبتمبر، يرجى اختيار الشهر:")
+        return st.selectbox("اختر الشهر (ورقة العمل)", available_sheets)
+    
+    # Also show option to change if needed
+    if st.checkbox("تغيير الشهر", key="change_month"):
+        return st.selectbox("اختر الشهر (ورقة العمل)", available_sheets,
+                            index=default_index)
+    return september_sheet
+
+@st.fragment
+def sidebar_ingestion():
+    """
+    Sidebar: data and template selection, data checks and export
+    Runs as its own fragment; publishes a small data handle in session state
+    and reruns the whole app only when that handle changes
+    """
+    # Enhanced sidebar header
+    st.markdown("""
+    <div style="text-align: center; padding: 1rem; background: linear-gradient(135deg, #6A3CBC 0%, #2EC4B6 100%); border-radius: 10px; margin-bottom: 1rem;">
+        <h2 style="color: white; margin: 0; font-size: 1.5rem;">⚙️ الإعدادات</h2>
+        <p style="color: rgba(255,255,255,0.8); margin: 0.5rem 0 0 0; font-size: 0.9rem;">إعدادات النظام والملفات</p>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    # Check for default files first with complete error handling
+    try:
+        if hasattr(config, 'EXCEL_FILE_PATH') and hasattr(config, 'TEMPLATE_FILE_PATH'):
+            default_excel_path = config.EXCEL_FILE_PATH
+            default_template_path = config.TEMPLATE_FILE_PATH
+            
+            # Test template loading early to catch errors safely (cached per template content)
+            if os.path.exists(default_template_path):
+                template_error = check_template_file(get_file_content_hash(default_template_path), default_template_path)
+            else:
+                template_error = "الملف غير موجود"
+            if template_error is None:
+                st.success("✅ قالب Word تم تحميله بنجاح")
             else:
-                st.error("❌ خطأ في إعدادات الملفات")
-                default_excel_path = None
-                default_template_path = None
-        except Exception as config_error:
-            st.error(f"❌ خطأ في قراءة الإعدادات: {str(config_error)}")
+                st.warning(f"⚠️ تحذير من قالب Word: {template_error}")
+                st.info("🔄 سيتم تجربة القالب مع التعامل الآمن مع الأخطاء")
+                # Don't set to None - still try to use it with safe processing
+        else:
+            st.error("❌ خطأ في إعدادات الملفات")
             default_excel_path = None
             default_template_path = None
+    except Exception as config_error:
+        st.error(f"❌ خطأ في قراءة الإعدادات: {str(config_error)}")
+        default_excel_path = None
+        default_template_path = None
+    
+    excel_df = pd.DataFrame()
+    available_sheets = []
+    excel_path = None
+    source_name = None
+    selected_sheet = None
+    drop_duplicates = False
+    template_path = None
+    
+    # Try to load default Excel file if it exists
+    if default_excel_path and os.path.exists(default_excel_path):
+        st.info(f"📊 تم العثور على ملف البيانات: {os.path.basename(default_excel_path)}")
+        excel_path = default_excel_path
+        source_name = os.path.abspath(default_excel_path)
+        available_sheets = get_available_sheets(excel_path)
         
-        excel_df = pd.DataFrame()
-        available_sheets = []
-        excel_path = None
-        template_path = None
-        
-        # Try to load default Excel file if it exists
-        if default_excel_path and os.path.exists(default_excel_path):
-            st.info(f"📊 تم العثور على ملف البيانات: {os.path.basename(default_excel_path)}")
-            excel_path = default_excel_path
-            available_sheets = get_available_sheets(excel_path)
+        if available_sheets:
+            show_schema_drift_report(excel_path)
             
-            if available_sheets:
-                # Auto-select September sheet if available, otherwise show selector
-                september_sheet = None
-                september_variations = ["سبتمبر", "September", "9", "09"]
-                
-                for variation in september_variations:
-                    if variation in available_sheets:
-                        september_sheet = variation
-                        break
-                
-                if september_sheet:
-                    st.success(f"🗓️ تم تحديد شهر سبتمبر تلقائياً: '{september_sheet}'")
-                    selected_sheet = september_sheet
-                    # Also show option to change if needed
-                    if st.checkbox("تغيير الشهر", key="change_month"):
-                        selected_sheet = st.selectbox("اختر الشهر (ورقة العمل)", available_sheets, 
-                                                    index=available_sheets.index(september_sheet))
-                else:
-                    st.warning("لم يتم العثور على شهر سبتمبر، يرجى اختيار الشهر:")
-                    selected_sheet = st.selectbox("اختر الشهر (ورقة العمل)", available_sheets)
-                
-                excel_df = load_excel_data(excel_path, selected_sheet)
+            # Auto-select September sheet if available, otherwise show selector
+            selected_sheet = select_month_sheet(available_sheets)
+            drop_duplicates = show_duplicate_courses(excel_path, selected_sheet)
+            dataset_handle = {
+                'excel_path': excel_path,
+                'workbook_hash': get_file_content_hash(excel_path),
+                'sheet': selected_sheet,
+                'drop_duplicates': drop_duplicates
+            }
+            excel_df = resolve_dataset(dataset_handle)
+            
+            if not excel_df.empty:
+                st.success(f"تم تحميل {len(excel_df)} صف من بيانات شهر: {selected_sheet}")
                 
-                if not excel_df.empty:
-                    st.success(f"تم تحميل {len(excel_df)} صف من بيانات شهر: {selected_sheet}")
-                    
-                    # Show data summary
-                    st.info(f"📋 ملخص البيانات: {len(excel_df)} دورة في {selected_sheet}")
-        else:
-            st.warning("لم يتم العثور على ملف البيانات الافتراضي")
+                # Show data summary
+                st.info(f"📋 ملخص البيانات: {len(excel_df)} دورة في {selected_sheet}")
+                show_column_profile(excel_df, resolve_dataset_fingerprint(dataset_handle))
+    else:
+        st.warning("لم يتم العثور على ملف البيانات الافتراضي")
+    
+    # Excel file upload (alternative)
+    st.markdown("**أو قم برفع ملف Excel آخر:**")
+    excel_file = st.file_uploader("رفع ملف Excel", type=['xlsx', 'xls'])
+    
+    if excel_file:
+        # Save uploaded file under its content hash
+        excel_path = save_uploaded_file(excel_file, '.xlsx')
+        # Versions of the same upload share its original name
+        source_name = excel_file.name
         
-        # Excel file upload (alternative)
-        st.markdown("**أو قم برفع ملف Excel آخر:**")
-        excel_file = st.file_uploader("رفع ملف Excel", type=['xlsx', 'xls'])
+        # Get available sheets
+        available_sheets = get_available_sheets(excel_path)
         
-        if excel_file:
-            # Save uploaded file temporarily
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp:
-                tmp.write(excel_file.getvalue())
-                excel_path = tmp.name
+        if available_sheets:
+            show_schema_drift_report(excel_path)
             
-            # Get available sheets
-            available_sheets = get_available_sheets(excel_path)
+            # Auto-select September sheet if available
+            selected_sheet = select_month_sheet(available_sheets, key_prefix="uploaded")
+            drop_duplicates = show_duplicate_courses(excel_path, selected_sheet)
+            dataset_handle = {
+                'excel_path': excel_path,
+                'workbook_hash': get_file_content_hash(excel_path),
+                'sheet': selected_sheet,
+                'drop_duplicates': drop_duplicates
+            }
+            excel_df = resolve_dataset(dataset_handle)
             
-            if available_sheets:
-                # Auto-select September sheet if available
-                september_sheet = None
-                september_variations = ["سبتمبر", "September", "9", "09"]
+            if not excel_df.empty:
+                st.success(f"تم تحميل {len(excel_df)} صف من البيانات")
                 
-                for variation in september_variations:
-                    if variation in available_sheets:
-                        september_sheet = variation
-                        break
-                
-                if september_sheet:
-                    st.success(f"🗓️ تم تحديد شهر سبتمبر تلقائياً: '{september_sheet}'")
-                    default_index = available_sheets.index(september_sheet)
-                else:
-                    default_index = 0
+                # Show preview
+                st.subheader("📋 معاينة البيانات")
+                st.write(f"عدد الصفوف: {len(excel_df)}")
+                st.write(f"عدد الأعمدة: {len(excel_df.columns)}")
                 
-                selected_sheet = st.selectbox("اختر الشهر (ورقة العمل)", available_sheets, 
-                                            index=default_index, key="uploaded_sheet")
-                excel_df = load_excel_data(excel_path, selected_sheet)
+                # Display first few rows using HTML table to avoid pyarrow
+                html_table = excel_df.head().to_html(escape=False, index=False)
+                st.markdown("**أول 5 صفوف:**")
+                st.markdown(html_table, unsafe_allow_html=True)
                 
-                if not excel_df.empty:
-                    st.success(f"تم تحميل {len(excel_df)} صف من البيانات")
-                    
-                    # Show preview
-                    st.subheader("📋 معاينة البيانات")
-                    st.write(f"عدد الصفوف: {len(excel_df)}")
-                    st.write(f"عدد الأعمدة: {len(excel_df.columns)}")
-                    
-                    # Display first few rows using HTML table to avoid pyarrow
-                    html_table = excel_df.head().to_html(escape=False, index=False)
-                    st.markdown("**أول 5 صفوف:**")
-                    st.markdown(html_table, unsafe_allow_html=True)
-            
-            # Clean up temp file
-            try:
-                os.unlink(excel_path)
-            except:
-                pass
-        
-        # Check for default Word template
-        if default_template_path and os.path.exists(default_template_path):
-            st.info(f"📄 تم العثور على قالب Word: {os.path.basename(default_template_path)}")
-            template_path = default_template_path
-        
-        # Word template upload (alternative)
-        st.markdown("**أو قم برفع قالب Word آخر:**")
-        template_file = st.file_uploader("رفع قالب Word", type=['docx'])
+                show_column_profile(excel_df, resolve_dataset_fingerprint(dataset_handle))
+        else:
+            selected_sheet = None
+    
+    # Check for default Word template
+    if default_template_path and os.path.exists(default_template_path):
+        st.info(f"📄 تم العثور على قالب Word: {os.path.basename(default_template_path)}")
+        template_path = default_template_path
+    
+    # Word template upload (alternative)
+    st.markdown("**أو قم برفع قالب Word آخر:**")
+    template_file = st.file_uploader("رفع قالب Word", type=['docx'])
+    
+    if template_file:
+        # Save uploaded template under its content hash
+        template_path = save_uploaded_file(template_file, '.docx')
         
-        if template_file:
-            # Save uploaded template temporarily
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.docx') as tmp:
-                tmp.write(template_file.getvalue())
-                template_path = tmp.name
+        st.success("تم رفع قالب Word بنجاح")
+    
+    # Export options
+    st.markdown("---")
+    st.subheader("📤 خيارات التصدير")
+    
+    if not excel_df.empty:
+        # Monthly summary export
+        if st.button("تصدير الملخص الشهري"):
+            monthly_stats = calculate_monthly_stats(excel_df)
             
-            st.success("تم رفع قالب Word بنجاح")
-        
-        # Export options
-        st.markdown("---")
-        st.subheader("📤 خيارات التصدير")
-        
-        if not excel_df.empty:
-            # Monthly summary export
-            if st.button("تصدير الملخص الشهري"):
-                monthly_stats = calculate_monthly_stats(excel_df)
-                
-                summary_data = {
-                    'المؤشر': ['إجمالي الدورات المخططة', 'دورات منفذة', 'دورات ملغاة', 'دورات مؤجلة', 'إجمالي أيام التدريب'],
-                    'القيمة': [monthly_stats['total_planned'], monthly_stats['executed'], 
-                              monthly_stats['cancelled'], monthly_stats['postponed'], monthly_stats['total_training_days']]
-                }
-                
-                summary_df = pd.DataFrame(summary_data)
-                
-                excel_buffer = io.BytesIO()
-                with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
-                    summary_df.to_excel(writer, sheet_name='الملخص الشهري', index=False)
-                    excel_df.to_excel(writer, sheet_name='البيانات الكاملة', index=False)
-                
-                excel_buffer.seek(0)
-                st.download_button(
-                    label="📊 تحميل الملخص الشهري",
-                    data=excel_buffer.getvalue(),
-                    file_name=f"الملخص_الشهري_{datetime.now().strftime('%Y%m%d')}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
+            summary_data = {
+                'المؤشر': ['إجمالي الدورات المخططة', 'دورات منفذة', 'دورات ملغاة', 'دورات مؤجلة', 'إجمالي أيام التدريب'],
+                'القيمة': [monthly_stats['total_planned'], monthly_stats['executed'], 
+                          monthly_stats['cancelled'], monthly_stats['postponed'], monthly_stats['total_training_days']]
+            }
+            
+            summary_df = pd.DataFrame(summary_data)
+            
+            excel_buffer = io.BytesIO()
+            with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
+                summary_df.to_excel(writer, sheet_name='الملخص الشهري', index=False)
+                excel_df.to_excel(writer, sheet_name='البيانات الكاملة', index=False)
+            
+            excel_buffer.seek(0)
+            st.download_button(
+                label="📊 تحميل الملخص الشهري",
+                data=excel_buffer.getvalue(),
+                file_name=f"الملخص_الشهري_{datetime.now().strftime('%Y%m%d')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+    
+    shared_stats = get_shared_cache().stats()
+    st.caption(
+        f"🗄️ الذاكرة المشتركة بين المستخدمين: {shared_stats['entries']} عنصر "
+        f"({shared_stats['bytes'] / (1024 * 1024):.1f} MB)"
+    )
+    
+    # Publish the data handle; the tabs resolve it through the cached loaders
+    handle = {
+        'excel_path': excel_path if selected_sheet else None,
+        'workbook_hash': get_file_content_hash(excel_path) if excel_path and selected_sheet else None,
+        'source_name': source_name if selected_sheet else None,
+        'sheet': selected_sheet,
+        'drop_duplicates': drop_duplicates,
+        'template_path': template_path
+    }
+    if handle != st.session_state.get('dataset_handle'):
+        st.session_state['dataset_handle'] = handle
+        # A fragment-only rerun changed the data: refresh the tabs as well
+        if not st.session_state.get('app_run_in_progress'):
+            st.rerun()
+
+@st.fragment
+def dashboard_fragment(handle):
+    """
+    Dashboard tab; its filters rerun only this fragment
+    """
+    build_enhanced_dashboard(resolve_dataset(handle), handle)
+
+@st.fragment
+def generator_fragment(handle):
+    """
+    Form generator tab; its widgets rerun only this fragment
+    """
+    df = resolve_dataset(handle)
+    build_form_generator(df, handle.get('template_path'), resolve_dataset_fingerprint(handle))
+    show_status_write_back(df, handle)
+
+@st.fragment
+def comparison_fragment(handle):
+    """
+    Comparison tab; its widgets rerun only this fragment
+    """
+    build_comparison_view(resolve_dataset(handle), handle.get('template_path'))
+
+@st.fragment
+def version_diff_fragment(handle):
+    """
+    Workbook version diff tab; its widgets rerun only this fragment
+    """
+    show_workbook_diff(handle)
+
+def main():
+    """
+    Main application function
+    """
+    # Beautiful header with logo and gradient background
+    render_header()
+    
+    # Sidebar for file uploads and settings
+    st.session_state['app_run_in_progress'] = True
+    try:
+        with st.sidebar:
+            sidebar_ingestion()
+    finally:
+        st.session_state['app_run_in_progress'] = False
+    handle = st.session_state.get('dataset_handle', {})
     
     # Main content tabs
-    tab1, tab2 = st.tabs(["📊 لوحة الإحصائيات", "📄 اصدار الاستمارات"])
+    tab1, tab2, tab3, tab4 = st.tabs(["📊 لوحة الإحصائيات", "📄 اصدار الاستمارات", "🔍 المقارنة", "🔄 تغييرات الخطة"])
     
     with tab1:
-        build_enhanced_dashboard(excel_df)
+        dashboard_fragment(handle)
     
     with tab2:
-        build_form_generator(excel_df, template_path)
+        generator_fragment(handle)
     
-    # Cleanup temporary files (only if they were uploaded, not default files)
-    if excel_file and excel_path and excel_path != config.EXCEL_FILE_PATH:
-        try:
-            os.unlink(excel_path)
-        except:
-            pass
+    with tab3:
+        comparison_fragment(handle)
     
-    if template_file and template_path and template_path != config.TEMPLATE_FILE_PATH:
-        try:
-            os.unlink(template_path)
-        except:
-            pass
+    with tab4:
+        version_diff_fragment(handle)
 
 if __name__ == "__main__":
     main()
@@ -12,6 +12,25 @@ SAMPLE_DATA_DIR = "sample_data"
 EXCEL_FILE_PATH = "sample_data/النموذج-الموحد2025م.xlsx"
 TEMPLATE_FILE_PATH = os.path.join(SAMPLE_DATA_DIR, "نموذج-اعتماد2.docx")
 
+## Template Registry
+# Extra accreditation templates live in TEMPLATES_DIR; rows are routed to them by rules
+TEMPLATES_DIR = os.path.join(SAMPLE_DATA_DIR, "templates")
+# Checked in order, first match wins; rows matching no rule use TEMPLATE_FILE_PATH
+# "column" is an Excel column, "contains" is text searched for in that column's value
+# Example: {"column": "الفئة المستهدفة", "contains": "طالب", "template": "نموذج-اعتماد-طلاب.docx"}
+TEMPLATE_ROUTING_RULES = []
+
+## Shared Memory Cache
+# Parsed datasets and compiled templates are held once per server process and
+# shared by all sessions; unreferenced entries are evicted beyond this budget
+SHARED_CACHE_MAX_MB = 512
+
+# Cleaned sheets are also published as Arrow IPC files that every server
+# process on this host memory-maps instead of parsing the workbook again;
+# files are named by sheet content, so unchanged months survive workbook edits
+ARROW_DATASETS_DIR = os.path.join(".cache", "datasets")
+ARROW_DATASETS_MAX_FILES = 240  # least recently used sheet versions are removed beyond this
+
 ## Date Format Settings
 DATE_FORMAT = "%Y-%m-%d"
 DISPLAY_DATE_FORMAT = "%d/%m/%Y"
@@ -80,6 +99,26 @@ UI_TEXT = {
     }
 }
 
+## Comparison Settings
+FUZZY_MATCH_THRESHOLD = 0.5  # Minimum similarity (0-1) to suggest a column for a template field
+
+## Data Validation
+VALIDATION_BLOCK_ON_ERRORS = True  # Bulk generation needs explicit confirmation while error-level issues remain
+VALIDATION_MIN_YEAR = 1900  # Gregorian dates before this year are treated as unparseable (e.g. Hijri text)
+VALIDATION_HIJRI_YEARS = (1350, 1500)  # Years accepted as Hijri dates in date columns that don't name their calendar
+
+## Certificate Numbers
+# Issued from a SQLite sequence (one per year) in blocks reserved per generation job
+CERTIFICATE_DB_PATH = os.path.join("data", "certificates.sqlite3")
+CERTIFICATE_FIRST_NUMBER = 1
+CERTIFICATE_NUMBER_FORMAT = "{year}-{number:05d}"
+
+## Analytics Store
+# "pandas" computes dashboard statistics in memory; "sqlite" or "duckdb" ingests
+# every workbook into a local database and runs the aggregations as SQL
+ANALYTICS_BACKEND = "pandas"
+ANALYTICS_DB_PATH = os.path.join("data", "courses")  # .sqlite3 / .duckdb is appended
+
 ## Chart Colors
 CHART_COLORS = {
     "executed": "#28a745",    # Green
@@ -92,6 +131,27 @@ CHART_COLORS = {
 MAX_EXCEL_SIZE = 50
 MAX_TEMPLATE_SIZE = 10
 
+## PDF Conversion
+# "auto" uses docx2pdf (MS Word) on Windows/macOS and headless LibreOffice elsewhere
+PDF_BACKEND = "auto"
+SOFFICE_PATH = None  # None = look up soffice/libreoffice on PATH
+PDF_WORKERS = max(1, min(4, os.cpu_count() or 1))
+PDF_BATCH_SIZE = 20  # Documents converted per soffice call
+PDF_CONVERT_TIMEOUT = 60  # Seconds allowed per soffice call ...
+PDF_CONVERT_TIMEOUT_PER_DOC = 10  # ... plus this many seconds per document
+PDF_WORKER_MAX_JOBS = 200  # Recycle a worker's profile after this many documents
+PIPELINE_QUEUE_SIZE = 32  # Documents buffered between bulk generation stages
+
+## Generated Documents Cache
+# Rendered DOCX/PDF files are stored on disk keyed by hash(template bytes, mapping)
+GENERATED_DOCS_CACHE_DIR = os.path.join(".cache", "generated_documents")
+GENERATED_DOCS_CACHE_MAX_MB = 500
+
+## Uploaded Files
+# Uploads are stored by content hash so reruns reuse the same path (and caches)
+UPLOADS_DIR = os.path.join(".cache", "uploads")
+UPLOADS_MAX_AGE_HOURS = 24  # Uploads unused this long are removed unless a live session still uses them
+
 ## Pagination Settings
 DEFAULT_ITEMS_PER_PAGE = 10
 ITEMS_PER_PAGE_OPTIONS = [5, 10, 20, 50]
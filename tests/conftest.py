@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SAMPLE_WORKBOOK = os.path.join(ROOT, "sample_data", "النموذج-الموحد2025م.xlsx")
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """app with its on-disk caches and stores redirected to a temp directory"""
+    import app
+    import config
+
+    monkeypatch.setattr(config, "ARROW_DATASETS_DIR", str(tmp_path / "datasets"))
+    monkeypatch.setattr(config, "ANALYTICS_DB_PATH", str(tmp_path / "courses"))
+    return app
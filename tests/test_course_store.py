@@ -0,0 +1,70 @@
+import importlib.util
+import shutil
+
+import openpyxl
+import pandas as pd
+import pytest
+
+from conftest import SAMPLE_WORKBOOK
+
+BACKENDS = [
+    "sqlite",
+    pytest.param("duckdb", marks=pytest.mark.skipif(
+        importlib.util.find_spec("duckdb") is None, reason="duckdb is not installed")),
+]
+
+
+@pytest.fixture(params=BACKENDS)
+def store_app(request, app_module, monkeypatch):
+    import config
+
+    monkeypatch.setattr(config, "ANALYTICS_BACKEND", request.param)
+    assert app_module.get_analytics_backend() == request.param
+    return app_module
+
+
+def stored_courses(app):
+    conn = app._open_course_store()
+    try:
+        rows = conn.execute("SELECT * FROM courses ORDER BY sheet, row_number").fetchall()
+    finally:
+        conn.close()
+    return pd.DataFrame(rows)
+
+
+def test_fresh_store_opens(store_app):
+    conn = store_app._open_course_store()
+    try:
+        backend = store_app.get_analytics_backend()
+        assert "row_hash" in store_app.store_table_columns(conn, backend, "courses")
+        assert "source" in store_app.store_table_columns(conn, backend, "ingested_workbooks")
+        assert store_app.store_table_columns(conn, backend, "missing_table") == []
+    finally:
+        conn.close()
+
+
+def test_new_version_matches_full_rebuild(store_app, tmp_path, monkeypatch):
+    import config
+
+    first = tmp_path / "v1.xlsx"
+    shutil.copy(SAMPLE_WORKBOOK, first)
+    rows = store_app.load_excel_data(str(first), "اكتوبر").attrs["excel_rows"]
+
+    # A course inserted mid-sheet shifts every row below it
+    workbook = openpyxl.load_workbook(first)
+    sheet = workbook["اكتوبر"]
+    inserted = rows[len(rows) // 2]
+    sheet.insert_rows(inserted)
+    for col in range(1, sheet.max_column + 1):
+        sheet.cell(inserted, col).value = sheet.cell(inserted + 1, col).value
+    sheet.cell(inserted, 2).value = "دورة جديدة"
+    second = tmp_path / "v2.xlsx"
+    workbook.save(second)
+
+    for path in (first, second):
+        store_app.ingest_workbook(str(path), store_app.get_file_content_hash(str(path)), "plan.xlsx")
+    incremental = stored_courses(store_app)
+
+    monkeypatch.setattr(config, "ANALYTICS_DB_PATH", str(tmp_path / "rebuilt"))
+    store_app.ingest_workbook(str(second), store_app.get_file_content_hash(str(second)), "plan.xlsx")
+    assert incremental.equals(stored_courses(store_app))
@@ -0,0 +1,25 @@
+import io
+import zipfile
+
+from docx import Document
+
+import config
+from conftest import SAMPLE_WORKBOOK
+
+
+def package_parts(docx_bytes):
+    archive = zipfile.ZipFile(io.BytesIO(docx_bytes))
+    return {name: archive.read(name) for name in archive.namelist()}
+
+
+def test_reused_template_renders_like_a_fresh_parse(app_module, monkeypatch):
+    df = app_module.load_excel_data(SAMPLE_WORKBOOK, "سبتمبر")
+    mappings = app_module.build_mappings_for_frame(df)[:6]
+    template = config.TEMPLATE_FILE_PATH
+
+    # Several renders in a row reuse the same parsed packages
+    pooled = [package_parts(app_module.render_docx(template, mapping)["docx"]) for mapping in mappings]
+
+    monkeypatch.setattr(app_module.CompiledTemplateCache, "get_copy", lambda self, path: Document(path))
+    fresh = [package_parts(app_module.render_docx(template, mapping)["docx"]) for mapping in mappings]
+    assert pooled == fresh
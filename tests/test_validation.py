@@ -0,0 +1,35 @@
+import pytest
+
+from conftest import SAMPLE_WORKBOOK
+
+
+@pytest.mark.parametrize("sheet", ["يناير", "مارس", "يونيو", "اغسطس"])
+def test_sample_sheet_has_no_errors(app_module, sheet):
+    # Hijri text, day-first and "م"-suffixed dates are valid, not unparseable
+    issues = app_module.validate_course_frame(app_module.load_excel_data(SAMPLE_WORKBOOK, sheet))
+    assert issues[issues["severity"] == "error"].empty
+
+
+def test_only_mistyped_dates_are_unparseable(app_module):
+    flagged = set()
+    for sheet in app_module.get_available_sheets(SAMPLE_WORKBOOK):
+        issues = app_module.validate_course_frame(app_module.load_excel_data(SAMPLE_WORKBOOK, sheet))
+        flagged |= set(issues.loc[issues["rule"] == "unparseable_date", "القيمة"])
+    assert flagged == {"22/42025", "19-20/8/1446", "13/15/2025", "3/11/12025", "1025-01-10", "202-10-27"}
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("13/10/2025", "2025-10-13"),
+    ("8/4/2025م", "2025-04-08"),
+    ("7 / 11 / 1446", "1446-11-07"),
+])
+def test_parse_date_flexible_forms(app_module, text, expected):
+    assert app_module.parse_date_flexible(text).strftime("%Y-%m-%d") == expected
+
+
+def test_subset_issues_are_the_full_frame_issues_of_its_rows(app_module):
+    df = app_module.load_excel_data(SAMPLE_WORKBOOK, "اكتوبر")
+    issues = app_module.validate_course_frame(df)
+    subset = df.iloc[::3]
+    expected = issues[issues["الصف"].isin(subset.index + 1)].reset_index(drop=True)
+    assert app_module.validate_course_frame(subset).astype(str).equals(expected.astype(str))
@@ -0,0 +1,25 @@
+import openpyxl
+
+from conftest import SAMPLE_WORKBOOK
+
+
+def sheet_fingerprints(app, path):
+    return app.read_sheet_fingerprints(app.get_file_content_hash(str(path)), str(path))
+
+
+def test_resaved_workbook_keeps_its_fingerprints(app_module, tmp_path):
+    # openpyxl writes text as inline strings and rewrites styles and workbook properties
+    resaved = tmp_path / "resaved.xlsx"
+    openpyxl.load_workbook(SAMPLE_WORKBOOK).save(resaved)
+    assert sheet_fingerprints(app_module, resaved) == sheet_fingerprints(app_module, SAMPLE_WORKBOOK)
+
+
+def test_edit_changes_only_its_sheet(app_module, tmp_path):
+    workbook = openpyxl.load_workbook(SAMPLE_WORKBOOK)
+    workbook["مايو"]["B3"] = "دورة معدلة"
+    edited = tmp_path / "edited.xlsx"
+    workbook.save(edited)
+
+    before = sheet_fingerprints(app_module, SAMPLE_WORKBOOK)
+    after = sheet_fingerprints(app_module, edited)
+    assert [sheet for sheet in before if before[sheet] != after[sheet]] == ["مايو"]